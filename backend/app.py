@@ -1,19 +1,44 @@
 import os
 import re
 import json
+import atexit
+import base64
+import math
+import uuid
 import hashlib
+import hmac
+import shutil
+import tempfile
+import time
 import subprocess
+import threading
 import mimetypes
-from datetime import datetime, timedelta
+import codecs
+import selectors
+import zlib
+import random
+import signal
+import socket
+import struct
+import resource
+from array import array
+from collections import deque
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 from werkzeug.utils import secure_filename
-from flask import Flask, request, jsonify, send_file, render_template
+from werkzeug.http import http_date, parse_date, parse_etags, quote_etag, unquote_etag
+from flask import Flask, Request, request, jsonify, render_template, stream_with_context
+from flask import g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_jwt_extended import JWTManager, jwt_required, create_access_token, get_jwt_identity
 from flask_jwt_extended import decode_token
 from flask_cors import CORS
 import bcrypt
-from sqlalchemy import text
+from sqlalchemy import text, case, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.orm import Session as SessionBase
+from sqlalchemy.exc import IntegrityError
 try:
     import magic
 except ImportError:
@@ -22,6 +47,10 @@ try:
     from PIL import Image
 except ImportError:
     Image = None
+try:
+    import fcntl
+except ImportError:  # Windows: sem trava entre processos
+    fcntl = None
 import psutil
 
 app = Flask(__name__)
@@ -94,6 +123,210 @@ UPLOAD_FOLDER = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 's
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# Uploads são gravados em arquivos temporários dentro do próprio storage, para
+# que a promoção ao destino final seja um rename atômico (mesmo filesystem)
+UPLOAD_TMP_FOLDER = os.path.join(UPLOAD_FOLDER, '.tmp')
+UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', 1024 * 1024))  # 1MB
+# Bytes iniciais guardados durante o upload para detecção de MIME (libmagic)
+MIME_SNIFF_BYTES = 8192
+# Bloco de leitura/sendfile na entrega de arquivos (download/stream)
+FILE_SEND_BLOCK_SIZE = int(os.environ.get('FILE_SEND_BLOCK_SIZE', 1024 * 1024))
+# Máximo de intervalos em um Range multipart (acima disso o Range é ignorado)
+MAX_BYTE_RANGES = 16
+# Quem envia os bytes de download/stream/thumbnail: 'direct' (o próprio worker),
+# 'x-accel' (nginx, X-Accel-Redirect) ou 'x-sendfile' (Apache mod_xsendfile)
+FILE_DELIVERY_MODE = os.environ.get('FILE_DELIVERY_MODE', 'direct').lower()
+# Location interna do nginx apontando (alias) para o diretório storage/
+X_ACCEL_PREFIX = os.environ.get('X_ACCEL_PREFIX', '/_protected/')
+# Conteúdo dos arquivos fica em um store endereçado por SHA-256 (deduplicado)
+BLOB_FOLDER = os.path.join(UPLOAD_FOLDER, '.blobs')
+# Artefatos derivados dos blobs (thumbnails, imagens redimensionadas...), em um
+# cache limitado por bytes com evicção LRU (ou LFU)
+DERIVED_FOLDER = os.path.join(UPLOAD_FOLDER, '.derived')
+DERIVED_CACHE_MAX_BYTES = int(os.environ.get('DERIVED_CACHE_MAX_BYTES', 2 * 1024 ** 3))  # 2GB
+DERIVED_CACHE_POLICY = os.environ.get('DERIVED_CACHE_POLICY', 'lru')
+# Acessos são acumulados em memória e gravados no índice a cada N acessos/segundos
+DERIVED_CACHE_TOUCH_BATCH = 200
+DERIVED_CACHE_TOUCH_INTERVAL = 30
+# O total em bytes é mantido em memória por processo e reconferido no banco
+# (SUM) a cada N segundos, para incluir o que outros workers geraram
+DERIVED_CACHE_TOTAL_RESYNC = 60
+# Locks de geração: arquivos fixos (nunca apagados), um por faixa do hash da chave
+DERIVED_CACHE_LOCK_STRIPES = 256
+THUMBNAIL_SIZES = (64, 200, 800)
+THUMBNAIL_DEFAULT_SIZE = 200
+THUMBNAIL_QUALITY = 82
+# Máximo de thumbnails por resposta de /api/thumbnails
+THUMBNAIL_BATCH_MAX = 200
+# Imagens redimensionadas sob demanda (/api/image); formatos não rasterizáveis
+# (SVG) ou animados (GIF) são entregues como estão
+IMAGE_DIMENSION_STEP = 32
+IMAGE_MAX_DIMENSION = 4096
+IMAGE_DEFAULT_QUALITY = 80
+IMAGE_PASSTHROUGH_TYPES = {'image/svg+xml', 'image/gif'}
+# URLs com ?v=<hash> identificam o conteúdo e podem ser cacheadas para sempre
+IMMUTABLE_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+# Upload instantâneo por hash: 'user' (padrão) só reaproveita blobs que o próprio
+# usuário já possui; 'global' também aceita blobs de outros usuários, mas só depois
+# de o cliente provar a posse respondendo a um desafio sobre um trecho do conteúdo
+INSTANT_UPLOAD_SCOPE = os.environ.get('INSTANT_UPLOAD_SCOPE', 'user')
+INSTANT_UPLOAD_MAX_BATCH = 1000
+INSTANT_UPLOAD_PROOF_BYTES = 64 * 1024
+INSTANT_UPLOAD_PROOF_TTL = 600  # segundos de validade de um desafio
+# Folga para o overhead do multipart ao comparar Content-Length com a quota
+UPLOAD_FORM_OVERHEAD = 16 * 1024
+# Sessões de upload em partes (resumable)
+UPLOAD_SESSION_DEFAULT_CHUNK = 8 * 1024 * 1024  # 8MB
+UPLOAD_SESSION_MAX_CHUNK = 64 * 1024 * 1024  # 64MB
+UPLOAD_SESSION_TTL = timedelta(hours=24)
+# Sessão presa em 'finalizing' (worker morto no meio) por mais que isso é descartada
+UPLOAD_SESSION_FINALIZE_TIMEOUT = timedelta(minutes=30)
+# Relatório de armazenamento do admin: idade máxima antes de um refresh em background
+STORAGE_REPORT_TTL = timedelta(seconds=int(os.environ.get('STORAGE_REPORT_TTL', 600)))
+STORAGE_REPORT_LARGEST_FILES = 5
+# Listagens de pasta paginadas por cursor (keyset)
+LISTING_DEFAULT_LIMIT = 200
+LISTING_MAX_LIMIT = 1000
+# Contagem total é só uma dica: acima deste limite retornamos o teto
+LISTING_COUNT_HINT_CAP = 10000
+# Log de atividades: fila em memória gravada em lote por uma thread de background
+ACTIVITY_ASYNC = os.environ.get('ACTIVITY_ASYNC', '1') != '0'
+ACTIVITY_QUEUE_SIZE = int(os.environ.get('ACTIVITY_QUEUE_SIZE', 10000))
+ACTIVITY_FLUSH_EVENTS = int(os.environ.get('ACTIVITY_FLUSH_EVENTS', 500))
+ACTIVITY_FLUSH_INTERVAL = float(os.environ.get('ACTIVITY_FLUSH_INTERVAL_MS', 500)) / 1000
+ACTIVITY_COALESCE_WINDOW = timedelta(minutes=5)
+ACTIVITY_COALESCE_ACTIONS = {'stream'}
+# Retenção: eventos mais antigos que isso viram resumos diários (activity_rollup)
+ACTIVITY_RETENTION_DAYS = int(os.environ.get('ACTIVITY_RETENTION_DAYS', 90))
+ACTIVITY_FEED_DEFAULT_LIMIT = 50
+ACTIVITY_FEED_MAX_LIMIT = 500
+# Fila de jobs em background (tabela job, processada por worker.py)
+JOB_MAX_ATTEMPTS = 5
+JOB_BACKOFF_BASE = 5          # segundos; dobra a cada tentativa
+JOB_BACKOFF_MAX = 15 * 60
+# Job em execução há mais tempo que isso é considerado abandonado (worker morreu)
+JOB_LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', 10 * 60))
+JOB_RETENTION_DAYS = 7
+# Execução de scripts (/api/execute) como jobs: limites de concorrência (global e
+# por usuário) e de fila, aplicados na reserva dos jobs pelos workers
+EXECUTION_TIMEOUT = int(os.environ.get('EXECUTION_TIMEOUT', 30))
+EXECUTION_MAX_CONCURRENT = int(os.environ.get('EXECUTION_MAX_CONCURRENT', 4))
+EXECUTION_MAX_PER_USER = int(os.environ.get('EXECUTION_MAX_PER_USER', 1))
+EXECUTION_MAX_QUEUED_PER_USER = 10
+# Saída das execuções: vai comprimida para disco em segmentos (lidos ao vivo via
+# SSE); o banco guarda só o final de stdout/stderr. Passando do limite o
+# processo é encerrado
+EXECUTION_LOG_FOLDER = os.path.join(UPLOAD_FOLDER, '.executions')
+EXECUTION_OUTPUT_LIMIT = int(os.environ.get('EXECUTION_OUTPUT_LIMIT', 50 * 1024 * 1024))
+EXECUTION_SEGMENT_BYTES = 256 * 1024
+EXECUTION_TAIL_BYTES = 64 * 1024
+EXECUTION_READ_SIZE = 64 * 1024
+# Limites por execução, aplicados com setrlimit no processo do script: CPU,
+# memória (RLIMIT_DATA; RLIMIT_AS impede o node de iniciar, o V8 reserva muito
+# espaço de endereçamento) e tamanho dos arquivos que o script grava. Com
+# EXECUTION_CGROUP_ROOT (cgroup v2 delegado ao usuário do serviço, com os
+# controladores memory/pids/cpu habilitados) cada execução ganha seu cgroup
+EXECUTION_CPU_LIMIT = int(os.environ.get('EXECUTION_CPU_LIMIT', EXECUTION_TIMEOUT))
+EXECUTION_MEMORY_LIMIT = int(os.environ.get('EXECUTION_MEMORY_LIMIT', 512 * 1024 * 1024))
+EXECUTION_FILE_SIZE_LIMIT = int(os.environ.get('EXECUTION_FILE_SIZE_LIMIT', 100 * 1024 * 1024))
+EXECUTION_MAX_PROCESSES = int(os.environ.get('EXECUTION_MAX_PROCESSES', 64))
+EXECUTION_CGROUP_ROOT = os.environ.get('EXECUTION_CGROUP_ROOT')
+# Interpretadores pré-iniciados por linguagem em cada worker (0 desliga o pool)
+EXECUTION_WARM_POOL_SIZE = int(os.environ.get('EXECUTION_WARM_POOL_SIZE', 1))
+EXECUTION_WARM_MAX_IDLE = 300
+# Métricas do sistema: um amostrador por host (o processo que obtém a trava)
+# grava as amostras num arquivo circular; os demais processos só o acompanham.
+# Em memória ficam as amostras mais recentes; o arquivo guarda SYSTEM_DISK_SAMPLES
+SYSTEM_METRICS_FOLDER = os.path.join(UPLOAD_FOLDER, '.metrics')
+SYSTEM_SAMPLE_INTERVAL = float(os.environ.get('SYSTEM_SAMPLE_INTERVAL', 5))
+# Inicia a amostragem no import (processos do app e workers); o manage.py desliga
+SYSTEM_SAMPLER_AUTOSTART = os.environ.get('SYSTEM_SAMPLER_AUTOSTART', '1') == '1'
+SYSTEM_MEMORY_SAMPLES = 720                   # 1 hora a cada 5 s
+SYSTEM_DISK_SAMPLES = 7 * 24 * 720            # 7 dias a cada 5 s (~12 MB)
+SYSTEM_HISTORY_DEFAULT_POINTS = 120
+SYSTEM_HISTORY_MAX_POINTS = 1000
+SYSTEM_HISTORY_RANGES = {'5m': 300, '15m': 900, '1h': 3600, '6h': 6 * 3600, '24h': 86400, '7d': 7 * 86400}
+# Métricas da aplicação em /metrics (formato texto do Prometheus). Cada processo
+# grava um snapshot em METRICS_FOLDER e o endpoint soma todos; com METRICS_TOKEN
+# o endpoint exige `Authorization: Bearer <token>`, sem ele só atende conexões
+# diretas do próprio host (loopback, sem cabeçalhos de proxy)
+METRICS_FOLDER = os.path.join(UPLOAD_FOLDER, '.metrics', 'processes')
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+METRICS_STREAM_ENDPOINTS = {'stream_file', 'download_file'}
+METRICS_UPLOAD_ENDPOINTS = {'upload_file', 'put_upload_chunk'}
+
+
+class HashingUploadFile:
+    """Destino de upload que calcula SHA-256, tamanho e guarda o cabeçalho
+    para detecção de MIME enquanto os dados são gravados, em uma única passagem.
+    Depois de finish(), o arquivo em `path` pode ser movido para o destino final;
+    se não for, é descartado no close().
+    """
+
+    def __init__(self, directory):
+        fd, self.path = tempfile.mkstemp(prefix='upload_', suffix='.part', dir=directory)
+        self._file = os.fdopen(fd, 'w+b', buffering=UPLOAD_CHUNK_SIZE)
+        self._sha256 = hashlib.sha256()
+        self.size = 0
+        self.head = b''
+
+    def write(self, data):
+        if len(self.head) < MIME_SNIFF_BYTES:
+            self.head += bytes(data[:MIME_SNIFF_BYTES - len(self.head)])
+        self._sha256.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def hexdigest(self):
+        return self._sha256.hexdigest()
+
+    def finish(self):
+        """Garante os dados em disco e fecha o temporário, pronto para rename."""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+class StreamingUploadRequest(Request):
+    """Request que grava partes de arquivo do multipart direto em HashingUploadFile,
+    em vez do SpooledTemporaryFile padrão do Werkzeug (que exigiria reler o arquivo
+    para calcular hash e MIME).
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        os.makedirs(UPLOAD_TMP_FOLDER, exist_ok=True)
+        return HashingUploadFile(UPLOAD_TMP_FOLDER)
+
+
+app.request_class = StreamingUploadRequest
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool que mede quanto cada checkout levou para obter uma conexão
+    (espera por conexão livre, abertura e pre-ping), exposto em /metrics."""
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            app_metrics.observe('chiapetta_db_pool_checkout_seconds', time.perf_counter() - started)
+
+# SQLite em memória continua com StaticPool (o Flask-SQLAlchemy sobrescreve)
+app.config['SQLALCHEMY_ENGINE_OPTIONS']['poolclass'] = InstrumentedQueuePool
+
 db = SQLAlchemy(app)
 jwt = JWTManager(app)
 CORS(app)
@@ -142,6 +375,9 @@ class User(db.Model):
     password_hash = db.Column(db.String(128), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     storage_quota = db.Column(db.BigInteger, default=1073741824)  # bytes
+    # Contadores mantidos incrementalmente (ver adjust_storage/reserve_storage)
+    storage_used = db.Column(db.BigInteger, nullable=False, default=0)  # soma lógica de File.file_size
+    storage_reserved = db.Column(db.BigInteger, nullable=False, default=0)  # uploads em andamento
     is_admin = db.Column(db.Boolean, default=False)  # Campo para identificar administradores
     
     def set_password(self, password):
@@ -164,9 +400,15 @@ class File(db.Model):
     is_favorite = db.Column(db.Boolean, default=False)
     tags = db.Column(db.Text)  # JSON string para tags
     description = db.Column(db.Text)
+    media_info = db.Column(db.Text)  # JSON: dimensões/EXIF, preenchido pelo job enrich_file
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('ix_file_user_folder', 'user_id', 'folder_id'),
+        db.Index('ix_file_file_hash', 'file_hash'),
+    )
+
 class Folder(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(255), nullable=False)
@@ -174,6 +416,9 @@ class Folder(db.Model):
     parent_id = db.Column(db.Integer, db.ForeignKey('folder.id'), nullable=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     is_public = db.Column(db.Boolean, default=False)
+    # Totais agregados da subárvore, mantidos incrementalmente (adjust_folder_totals)
+    total_size = db.Column(db.BigInteger, nullable=False, default=0, index=True)
+    total_files = db.Column(db.Integer, nullable=False, default=0)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow)
     
@@ -181,13 +426,23 @@ class Folder(db.Model):
     parent = db.relationship('Folder', remote_side=[id], backref='children')
     files = db.relationship('File', backref='folder_ref', lazy=True)
 
+    __table_args__ = (db.Index('ix_folder_user_parent', 'user_id', 'parent_id'),)
+
+class FolderClosure(db.Model):
+    """Tabela de fechamento da hierarquia de pastas: uma linha para cada par
+    (ancestral, descendente), incluindo a própria pasta com depth=0.
+    Permite breadcrumbs e consultas de subárvore com uma única consulta."""
+    ancestor_id = db.Column(db.Integer, db.ForeignKey('folder.id'), primary_key=True, autoincrement=False)
+    descendant_id = db.Column(db.Integer, db.ForeignKey('folder.id'), primary_key=True, autoincrement=False, index=True)
+    depth = db.Column(db.Integer, nullable=False)
+
 class Share(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     token = db.Column(db.String(64), unique=True, nullable=False)
     file_id = db.Column(db.Integer, db.ForeignKey('file.id'), nullable=True)
     folder_id = db.Column(db.Integer, db.ForeignKey('folder.id'), nullable=True)
-    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    shared_with_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)  # Para compartilhamento com usuário específico
+    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    shared_with_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True, index=True)  # Para compartilhamento com usuário específico
     is_public = db.Column(db.Boolean, default=False)
     can_edit = db.Column(db.Boolean, default=False)
     can_download = db.Column(db.Boolean, default=True)
@@ -233,11 +488,28 @@ class Activity(db.Model):
     resource_name = db.Column(db.String(255), nullable=False)
     details = db.Column(db.Text)
     ip_address = db.Column(db.String(45))
+    # Eventos repetidos coalescidos nesta linha (ex.: Ranges de um mesmo stream)
+    event_count = db.Column(db.Integer, nullable=False, default=1)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Relacionamentos
     user = db.relationship('User', backref='activities')
 
+    __table_args__ = (
+        db.Index('ix_activity_user_created', 'user_id', 'created_at'),
+        db.Index('ix_activity_created_at', 'created_at'),
+    )
+
+class ActivityRollup(db.Model):
+    """Resumo diário por usuário/ação de atividades arquivadas pela retenção."""
+    day = db.Column(db.Date, primary_key=True)
+    user_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    action = db.Column(db.String(100), primary_key=True)
+    resource_type = db.Column(db.String(50), primary_key=True)
+    event_count = db.Column(db.BigInteger, nullable=False, default=0)
+
+    __table_args__ = (db.Index('ix_activity_rollup_user_day', 'user_id', 'day'),)
+
 class ExecutionLog(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     file_id = db.Column(db.Integer, db.ForeignKey('file.id'), nullable=False)
@@ -246,40 +518,337 @@ class ExecutionLog(db.Model):
     output = db.Column(db.Text)
     error_output = db.Column(db.Text)
     exit_code = db.Column(db.Integer)
-    executed_at = db.Column(db.DateTime, default=datetime.utcnow)
-
+    executed_at = db.Column(db.DateTime, default=datetime.utcnow)  # envio
+    job_id = db.Column(db.Integer)
+    status = db.Column(db.String(16), default='queued')  # queued, running, done, timeout, failed
+    queue_wait_ms = db.Column(db.Integer)
+    run_ms = db.Column(db.Integer)
+    peak_memory_kb = db.Column(db.Integer)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    # Saída completa no spool em disco (output/error_output guardam só o final)
+    log_path = db.Column(db.String(255))
+    log_bytes = db.Column(db.BigInteger)
+    log_segments = db.Column(db.Integer)
+    output_truncated = db.Column(db.Boolean, default=False)
 
-def run_simple_migrations(engine=None):
-    """Aplica migrações simples compatíveis com MySQL, como ajuste de tipos.
-    Pode receber um engine específico; caso contrário usa o bind da sessão ou engine padrão.
+class ContentBlob(db.Model):
+    """Conteúdo armazenado uma única vez, endereçado pelo SHA-256.
+    Registros File/FileVersion referenciam o blob pelo file_hash; ref_count
+    conta essas referências e o conteúdo é apagado quando chega a zero.
     """
-    try:
-        eng = engine or getattr(db.session, 'bind', None) or db.engine
-        if not eng:
-            return
-        if not getattr(eng.url, 'drivername', '').startswith('mysql'):
-            return
-        from sqlalchemy import text
+    file_hash = db.Column(db.String(64), primary_key=True)
+    file_size = db.Column(db.BigInteger, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class DerivedAsset(db.Model):
+    """Índice do cache de artefatos derivados (thumbnails, imagens redimensionadas...).
+    Guarda tamanho e acessos para a evicção sem depender de atime do disco."""
+    key = db.Column(db.String(255), primary_key=True)  # <tipo>/<aa>/<hash>_<variante>
+    kind = db.Column(db.String(32), nullable=False)
+    source_hash = db.Column(db.String(64), nullable=False, index=True)
+    size_bytes = db.Column(db.BigInteger, nullable=False, default=0)
+    hit_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_access_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+class Job(db.Model):
+    """Job durável em background. Workers pegam jobs prontos (status queued e
+    run_after vencido) com SELECT ... FOR UPDATE SKIP LOCKED."""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(32), nullable=False)
+    payload = db.Column(db.Text)  # JSON
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True, index=True)
+    status = db.Column(db.String(16), nullable=False, default='queued')  # queued, running, done, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=JOB_MAX_ATTEMPTS)
+    run_after = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_by = db.Column(db.String(64))
+    locked_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    result = db.Column(db.Text)  # JSON
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    __table_args__ = (db.Index('ix_job_claim', 'status', 'run_after'),)
+
+class JobKindLock(db.Model):
+    # Uma linha por tipo de job com limite de concorrência; travada durante a
+    # contagem e a reserva para que os limites valham entre workers
+    kind = db.Column(db.String(32), primary_key=True)
+    claimed_at = db.Column(db.DateTime)
+
+class StorageReport(db.Model):
+    """Relatório de uso por usuário materializado por refresh_storage_report()."""
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True, autoincrement=False)
+    username = db.Column(db.String(80), nullable=False)
+    storage_quota = db.Column(db.BigInteger)
+    total_bytes = db.Column(db.BigInteger, nullable=False, default=0, index=True)
+    file_count = db.Column(db.Integer, nullable=False, default=0, index=True)
+    by_category = db.Column(db.Text)  # JSON {categoria: {bytes, files}}
+    largest_files = db.Column(db.Text)  # JSON [{id, name, size, mime_type}]
+    refreshed_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class StorageReportState(db.Model):
+    # Linha única (id=1) com o horário do último refresh e o lock entre workers
+    id = db.Column(db.Integer, primary_key=True)
+    refreshed_at = db.Column(db.DateTime, nullable=True)
+    refreshing_since = db.Column(db.DateTime, nullable=True)
+    duration_ms = db.Column(db.Integer, nullable=True)
+
+class UploadSession(db.Model):
+    """Upload resumable em partes. As partes são gravadas por offset direto no
+    arquivo temporário final (.part), então a finalização é só um rename."""
+    id = db.Column(db.String(32), primary_key=True)  # uuid4 hex
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    folder_id = db.Column(db.Integer, db.ForeignKey('folder.id'), nullable=True)
+    filename = db.Column(db.String(255), nullable=False)
+    total_size = db.Column(db.BigInteger, nullable=False)
+    chunk_size = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(20), default='active')  # active, finalizing, completed, aborted, expired, failed
+    file_id = db.Column(db.Integer, db.ForeignKey('file.id'), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    finalizing_since = db.Column(db.DateTime, nullable=True)
+
+    @property
+    def total_chunks(self):
+        return int(math.ceil(self.total_size / float(self.chunk_size))) if self.total_size else 0
+
+    @property
+    def part_path(self):
+        return os.path.join(UPLOAD_TMP_FOLDER, f"{self.id}.part")
+
+    def chunk_length(self, index):
+        return min(self.chunk_size, self.total_size - index * self.chunk_size)
+
+class UploadChunk(db.Model):
+    # Uma linha por parte recebida; a PK composta torna o registro idempotente
+    # entre workers que recebem a mesma parte em paralelo (retries)
+    upload_id = db.Column(db.String(32), db.ForeignKey('upload_session.id'), primary_key=True)
+    chunk_index = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    received_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class SchemaMigration(db.Model):
+    """Versões de schema já aplicadas (uma linha por migração)."""
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    description = db.Column(db.String(255), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+    duration_ms = db.Column(db.Integer)
+
+
+# === MIGRAÇÕES VERSIONADAS ===
+# Cada passo é idempotente (verifica o schema antes de alterar), então pode ser
+# reexecutado com segurança se um deploy for interrompido no meio. Rodam uma vez
+# via `python manage.py migrate`, não a cada import dos workers.
+
+def _schema_columns(conn, table):
+    from sqlalchemy import inspect as sa_inspect
+    return {col['name'] for col in sa_inspect(conn).get_columns(table)}
+
+def _schema_indexes(conn, table):
+    from sqlalchemy import inspect as sa_inspect
+    return {idx['name'] for idx in sa_inspect(conn).get_indexes(table)}
+
+def _add_columns(conn, table, columns):
+    existing = _schema_columns(conn, table)
+    for name, ddl in columns:
+        if name not in existing:
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}"))
+            print(f"  + {table}.{name}")
+
+def _create_index(conn, name, table, columns):
+    """Cria o índice se não existir. No MySQL usa DDL online (InnoDB), sem
+    bloquear escritas na tabela durante a construção."""
+    if name in _schema_indexes(conn, table):
+        return
+    online = ' ALGORITHM=INPLACE LOCK=NONE' if conn.dialect.name == 'mysql' else ''
+    started = time.perf_counter()
+    conn.execute(text(f"CREATE INDEX {name} ON {table} ({', '.join(columns)}){online}"))
+    print(f"  + índice {name} em {(time.perf_counter() - started) * 1000:.0f} ms")
+
+def _migration_legacy_file_columns(conn):
+    _add_columns(conn, 'file', [
+        ('folder_id', 'INTEGER'),
+        ('is_favorite', 'BOOLEAN DEFAULT FALSE'),
+        ('tags', 'TEXT'),
+        ('description', 'TEXT'),
+    ])
+
+def _migration_bigint_sizes(conn):
+    # Colunas que podem estourar INT (somente MySQL; SQLite não tem esse limite)
+    if conn.dialect.name != 'mysql':
+        return
+    conn.execute(text("ALTER TABLE user MODIFY storage_quota BIGINT"))
+    conn.execute(text("ALTER TABLE file MODIFY file_size BIGINT"))
+    conn.execute(text("ALTER TABLE file_version MODIFY file_size BIGINT"))
+
+def _migration_admin_flag(conn):
+    _add_columns(conn, 'user', [('is_admin', 'BOOLEAN DEFAULT FALSE')])
+
+def _migration_storage_counters(conn):
+    _add_columns(conn, 'user', [
+        ('storage_used', 'BIGINT NOT NULL DEFAULT 0'),
+        ('storage_reserved', 'BIGINT NOT NULL DEFAULT 0'),
+    ])
+    # Popular os contadores a partir dos arquivos existentes. SQL fixo do schema
+    # desta versão (não usa os modelos atuais, que podem mudar depois)
+    user_table = conn.dialect.identifier_preparer.quote('user')
+    conn.execute(text(f"""
+        UPDATE {user_table} SET
+            storage_used = (SELECT COALESCE(SUM(file.file_size), 0) FROM file
+                            WHERE file.user_id = {user_table}.id),
+            storage_reserved = (SELECT COALESCE(SUM(upload_session.total_size), 0) FROM upload_session
+                                WHERE upload_session.user_id = {user_table}.id
+                                  AND upload_session.status IN ('active', 'finalizing'))
+    """))
+
+def _migration_folder_rollups(conn):
+    _add_columns(conn, 'folder', [
+        ('total_size', 'BIGINT NOT NULL DEFAULT 0'),
+        ('total_files', 'INTEGER NOT NULL DEFAULT 0'),
+    ])
+    _create_index(conn, 'ix_folder_total_size', 'folder', ['total_size'])
+    # Backfill da closure table e dos totais com SQL fixo do schema desta versão
+    parents = dict(conn.execute(text("SELECT id, parent_id FROM folder")).all())
+    rows = []
+    for folder_id in parents:
+        depth, current, seen = 0, folder_id, set()
+        while current is not None and current in parents and current not in seen:
+            seen.add(current)
+            rows.append({'ancestor_id': current, 'descendant_id': folder_id, 'depth': depth})
+            current = parents[current]
+            depth += 1
+    conn.execute(text("DELETE FROM folder_closure"))
+    if rows:
+        conn.execute(text(
+            "INSERT INTO folder_closure (ancestor_id, descendant_id, depth) VALUES (:ancestor_id, :descendant_id, :depth)"
+        ), rows)
+    subtree = """FROM file JOIN folder_closure ON folder_closure.descendant_id = file.folder_id
+                 WHERE folder_closure.ancestor_id = folder.id"""
+    conn.execute(text(f"""
+        UPDATE folder SET
+            total_size = (SELECT COALESCE(SUM(file.file_size), 0) {subtree}),
+            total_files = (SELECT COUNT(file.id) {subtree})
+    """))
+
+def _migration_hot_path_indexes(conn):
+    for name, table, columns in HOT_PATH_INDEXES:
+        _create_index(conn, name, table, columns)
+
+def _migration_activity_event_count(conn):
+    _add_columns(conn, 'activity', [('event_count', 'INTEGER NOT NULL DEFAULT 1')])
+
+def _migration_activity_created_index(conn):
+    _create_index(conn, 'ix_activity_created_at', 'activity', ['created_at'])
+
+def _migration_file_media_info(conn):
+    _add_columns(conn, 'file', [('media_info', 'TEXT')])
+
+def _migration_execution_spool(conn):
+    _add_columns(conn, 'execution_log', [
+        ('log_path', 'VARCHAR(255)'),
+        ('log_bytes', 'BIGINT'),
+        ('log_segments', 'INTEGER'),
+        ('output_truncated', 'BOOLEAN DEFAULT FALSE'),
+    ])
+
+def _migration_upload_finalizing_since(conn):
+    _add_columns(conn, 'upload_session', [('finalizing_since', 'DATETIME')])
+
+def _migration_execution_metrics(conn):
+    _add_columns(conn, 'execution_log', [
+        ('job_id', 'INTEGER'),
+        ("status", "VARCHAR(16) DEFAULT 'done'"),
+        ('queue_wait_ms', 'INTEGER'),
+        ('run_ms', 'INTEGER'),
+        ('peak_memory_kb', 'INTEGER'),
+        ('started_at', 'DATETIME'),
+        ('finished_at', 'DATETIME'),
+    ])
+
+# Índices compostos para os filtros mais frequentes (também declarados nos
+# modelos, para bancos novos criados via create_all)
+HOT_PATH_INDEXES = [
+    ('ix_file_user_folder', 'file', ['user_id', 'folder_id']),
+    ('ix_file_file_hash', 'file', ['file_hash']),
+    ('ix_folder_user_parent', 'folder', ['user_id', 'parent_id']),
+    ('ix_activity_user_created', 'activity', ['user_id', 'created_at']),
+    ('ix_share_owner_id', 'share', ['owner_id']),
+    ('ix_share_shared_with_id', 'share', ['shared_with_id']),
+]
+
+MIGRATIONS = [
+    (1, 'Colunas legadas de file (pasta, favorito, tags, descrição)', _migration_legacy_file_columns),
+    (2, 'BIGINT para quotas e tamanhos', _migration_bigint_sizes),
+    (3, 'Flag is_admin em user', _migration_admin_flag),
+    (4, 'Contadores storage_used/storage_reserved', _migration_storage_counters),
+    (5, 'Closure table e totais agregados de pastas', _migration_folder_rollups),
+    (6, 'Índices compostos de hot path', _migration_hot_path_indexes),
+    (7, 'Contador de eventos coalescidos em activity', _migration_activity_event_count),
+    (8, 'Índice activity(created_at) para consultas por período', _migration_activity_created_index),
+    (9, 'Metadados de mídia (EXIF) em file', _migration_file_media_info),
+    (10, 'Fila, tempo de execução e memória em execution_log', _migration_execution_metrics),
+    (11, 'Spool comprimido da saída em execution_log', _migration_execution_spool),
+    (12, 'Início da finalização em upload_session', _migration_upload_finalizing_since),
+]
+
+def schema_version():
+    """Maior versão aplicada (0 se nenhuma)."""
+    return db.session.query(db.func.coalesce(db.func.max(SchemaMigration.version), 0)).scalar()
+
+def pending_migrations():
+    current = schema_version()
+    return [m for m in MIGRATIONS if m[0] > current]
+
+def stamp_schema_head():
+    """Marca todas as migrações como aplicadas (banco recém-criado via create_all)."""
+    applied = {v for (v,) in db.session.query(SchemaMigration.version)}
+    for version, description, _ in MIGRATIONS:
+        if version not in applied:
+            db.session.add(SchemaMigration(version=version, description=description, duration_ms=0))
+    db.session.commit()
+
+def run_migrations(engine=None, target=None):
+    """Aplica as migrações pendentes em ordem, registrando versão e duração
+    de cada uma. Retorna a lista de (versão, descrição, ms) aplicadas."""
+    eng = engine or db.engine
+    db.create_all()
+    applied = []
+    for version, description, step in pending_migrations():
+        if target is not None and version > target:
+            break
+        print(f"→ Migração {version}: {description}")
+        started = time.perf_counter()
         with eng.connect() as conn:
-            # Ajustar colunas que podem estourar INT
-            try:
-                conn.execute(text("ALTER TABLE user MODIFY storage_quota BIGINT"))
-            except Exception as e:
-                print(f"Aviso: ALTER user.storage_quota: {e}")
-            try:
-                conn.execute(text("ALTER TABLE user ADD COLUMN is_admin BOOLEAN DEFAULT FALSE"))
-            except Exception as e:
-                print(f"Aviso: ALTER user.is_admin: {e}")
-            try:
-                conn.execute(text("ALTER TABLE file MODIFY file_size BIGINT"))
-            except Exception as e:
-                print(f"Aviso: ALTER file.file_size: {e}")
-            try:
-                conn.execute(text("ALTER TABLE file_version MODIFY file_size BIGINT"))
-            except Exception as e:
-                print(f"Aviso: ALTER file_version.file_size: {e}")
-    except Exception as e:
-        print(f"Aviso: falha ao executar migrações simples: {e}")
+            step(conn)
+            conn.commit()
+        duration_ms = int((time.perf_counter() - started) * 1000)
+        db.session.add(SchemaMigration(version=version, description=description, duration_ms=duration_ms))
+        db.session.commit()
+        print(f"  ok em {duration_ms} ms")
+        applied.append((version, description, duration_ms))
+    return applied
+
+def initialize_schema(engine=None, migrate=False):
+    """Cria as tabelas que faltam. Banco novo é marcado na versão mais recente;
+    banco existente só é migrado com migrate=True (CLI/setup), senão apenas avisa."""
+    from sqlalchemy import inspect as sa_inspect
+    eng = engine or db.engine
+    fresh = not sa_inspect(eng).has_table('user')
+    db.create_all()
+    if fresh:
+        stamp_schema_head()
+    elif migrate:
+        run_migrations(engine=eng)
+    else:
+        pending = pending_migrations()
+        if pending:
+            print(f"Aviso: {len(pending)} migração(ões) pendente(s); rode `python manage.py migrate`")
 
 def rebind_db_engine(new_uri):
     """Cria um novo engine e reatribui o bind da sessão para a nova conexão.
@@ -421,9 +990,8 @@ def setup_save_db():
             eng = rebind_db_engine(new_uri)
             # Conectar para validar
             _ = eng.connect(); _.close()
-            # Criar tabelas usando a nova conexão configurada
-            db.create_all()
-            run_simple_migrations(engine=eng)
+            # Criar tabelas e aplicar migrações pendentes (ação explícita do setup)
+            initialize_schema(engine=eng, migrate=True)
             # Se o banco estiver vazio e dados do primeiro usuário foram fornecidos, criar este usuário
             created_first = False
             try:
@@ -615,10 +1183,9 @@ def set_db_settings():
                 eng = rebind_db_engine(new_uri)
                 # Valida conexão
                 _ = eng.connect(); _.close()
-                # Criar tabelas usando a nova conexão configurada
-                db.create_all()
                 try:
-                    run_simple_migrations(engine=eng)
+                    # Criar tabelas e aplicar migrações pendentes (ação explícita do setup)
+                    initialize_schema(engine=eng, migrate=True)
                     create_default_user()
                     backfill_admin_flag()
                 except Exception as _e:
@@ -682,8 +1249,7 @@ def list_users():
         users = User.query.all()
         user_list = []
         for user in users:
-            # Calcular uso de armazenamento
-            usage = get_user_storage_usage(user.id)
+            usage = user.storage_used or 0
             user_list.append({
                 'id': user.id,
                 'username': user.username,
@@ -699,6 +1265,148 @@ def list_users():
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/api/admin/storage-report', methods=['GET'])
+@jwt_required()
+def admin_storage_report():
+    """Relatório de uso por usuário a partir da tabela materializada.
+    Query: page, per_page (máx. 200), sort (total_bytes|file_count|username|storage_quota), order (asc|desc).
+    Se o relatório estiver desatualizado, um refresh é disparado em background e
+    os dados atuais são retornados imediatamente.
+    """
+    if 'NO_DB_CONFIG' in globals() and NO_DB_CONFIG:
+        return jsonify({'error': 'Sistema em modo de configuração'}), 503
+    if not _require_admin():
+        return jsonify({'error': 'Acesso negado'}), 403
+    try:
+        page = max(1, request.args.get('page', 1, type=int))
+        per_page = min(200, max(1, request.args.get('per_page', 50, type=int)))
+        sort_columns = {
+            'total_bytes': StorageReport.total_bytes,
+            'file_count': StorageReport.file_count,
+            'username': StorageReport.username,
+            'storage_quota': StorageReport.storage_quota
+        }
+        sort_column = sort_columns.get(request.args.get('sort'), StorageReport.total_bytes)
+        if request.args.get('order', 'desc') == 'asc':
+            order = (sort_column.asc(), StorageReport.user_id.asc())
+        else:
+            order = (sort_column.desc(), StorageReport.user_id.desc())
+
+        state = db.session.get(StorageReportState, 1)
+        stale = not state or not state.refreshed_at or state.refreshed_at < datetime.utcnow() - STORAGE_REPORT_TTL
+        refreshing = bool(state and state.refreshing_since)
+        if stale and not refreshing:
+            refreshing = schedule_storage_report_refresh()
+
+        rows = StorageReport.query.order_by(*order).offset((page - 1) * per_page).limit(per_page).all()
+        totals = db.session.query(
+            db.func.count(StorageReport.user_id),
+            db.func.coalesce(db.func.sum(StorageReport.total_bytes), 0),
+            db.func.coalesce(db.func.sum(StorageReport.file_count), 0)
+        ).one()
+
+        return jsonify({
+            'users': [{
+                'user_id': r.user_id,
+                'username': r.username,
+                'storage_quota': r.storage_quota,
+                'total_bytes': r.total_bytes,
+                'file_count': r.file_count,
+                'storage_percent': (r.total_bytes / r.storage_quota * 100) if r.storage_quota else 0,
+                'by_category': json.loads(r.by_category or '{}'),
+                'largest_files': json.loads(r.largest_files or '[]')
+            } for r in rows],
+            'page': page,
+            'per_page': per_page,
+            'total_users': totals[0],
+            'total_bytes': int(totals[1]),
+            'total_files': int(totals[2]),
+            'refreshed_at': state.refreshed_at.isoformat() if state and state.refreshed_at else None,
+            'refresh_duration_ms': state.duration_ms if state else None,
+            'stale': stale,
+            'refreshing': refreshing
+        }), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/admin/storage-report/refresh', methods=['POST'])
+@jwt_required()
+def admin_refresh_storage_report():
+    if 'NO_DB_CONFIG' in globals() and NO_DB_CONFIG:
+        return jsonify({'error': 'Sistema em modo de configuração'}), 503
+    if not _require_admin():
+        return jsonify({'error': 'Acesso negado'}), 403
+    started = schedule_storage_report_refresh()
+    return jsonify({'message': 'Atualização agendada' if started else 'Atualização já em andamento'}), 202
+
+
+@app.route('/api/admin/jobs', methods=['GET'])
+@jwt_required()
+def admin_job_queue():
+    """Profundidade e latência da fila de jobs (query: window em minutos)."""
+    if 'NO_DB_CONFIG' in globals() and NO_DB_CONFIG:
+        return jsonify({'error': 'Sistema em modo de configuração'}), 503
+    if not _require_admin():
+        return jsonify({'error': 'Acesso negado'}), 403
+    window = min(24 * 60, max(1, request.args.get('window', 60, type=int)))
+    stats = job_queue_stats(window)
+    stats['failed_recent'] = [{
+        'id': job.id,
+        'kind': job.kind,
+        'attempts': job.attempts,
+        'error': job.last_error,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None
+    } for job in Job.query.filter_by(status='failed').order_by(Job.id.desc()).limit(20)]
+    return jsonify(stats), 200
+
+@app.route('/api/admin/activity-writer', methods=['GET'])
+@jwt_required()
+def admin_activity_writer_stats():
+    """Contadores do gravador assíncrono de atividades deste processo."""
+    if 'NO_DB_CONFIG' in globals() and NO_DB_CONFIG:
+        return jsonify({'error': 'Sistema em modo de configuração'}), 503
+    if not _require_admin():
+        return jsonify({'error': 'Acesso negado'}), 403
+    return jsonify({
+        'async': ACTIVITY_ASYNC,
+        'queue_depth': activity_writer.queue_depth(),
+        'queue_capacity': ACTIVITY_QUEUE_SIZE,
+        **activity_writer.stats_snapshot()
+    }), 200
+
+@app.route('/api/admin/derived-cache', methods=['GET'])
+@jwt_required()
+def admin_derived_cache():
+    """Uso do cache de artefatos derivados e taxa de acerto deste processo."""
+    if 'NO_DB_CONFIG' in globals() and NO_DB_CONFIG:
+        return jsonify({'error': 'Sistema em modo de configuração'}), 503
+    if not _require_admin():
+        return jsonify({'error': 'Acesso negado'}), 403
+    return jsonify(derived_cache.report()), 200
+
+@app.route('/api/admin/largest-folders', methods=['GET'])
+@jwt_required()
+def admin_largest_folders():
+    """Pastas com maior volume (subárvore inteira), lidas do índice de total_size."""
+    if 'NO_DB_CONFIG' in globals() and NO_DB_CONFIG:
+        return jsonify({'error': 'Sistema em modo de configuração'}), 503
+    if not _require_admin():
+        return jsonify({'error': 'Acesso negado'}), 403
+    limit = max(1, min(request.args.get('limit', 20, type=int) or 20, 200))
+    rows = db.session.query(
+        Folder.id, Folder.name, Folder.path, Folder.total_size, Folder.total_files, User.username
+    ).join(User, User.id == Folder.user_id).order_by(Folder.total_size.desc()).limit(limit).all()
+    return jsonify({'folders': [{
+        'id': row.id,
+        'name': row.name,
+        'path': row.path,
+        'username': row.username,
+        'total_size': row.total_size,
+        'total_files': row.total_files
+    } for row in rows]}), 200
+
+
 @app.route('/api/admin/users', methods=['POST'])
 @jwt_required()
 def create_user():
@@ -824,22 +1532,35 @@ def delete_user(user_id):
         # Deletar arquivos e relacionamentos do usuário
         user_files = File.query.filter_by(user_id=user_id).all()
         for file in user_files:
-            # Remover arquivo do disco
-            if os.path.exists(file.file_path):
-                try:
-                    os.remove(file.file_path)
-                except Exception:
-                    pass
+            # Liberar conteúdo (blob compartilhado só sai com a última referência)
+            for version in FileVersion.query.filter_by(file_id=file.id).all():
+                remove_stored_content(version.file_path, version.file_hash)
+            try:
+                remove_stored_content(file.file_path, file.file_hash)
+            except OSError:
+                pass
+            FileVersion.query.filter_by(file_id=file.id).delete(synchronize_session=False)
+            Comment.query.filter_by(file_id=file.id).delete(synchronize_session=False)
+            Share.query.filter_by(file_id=file.id).delete(synchronize_session=False)
+            delete_execution_logs(ExecutionLog.file_id == file.id)
         
         # Deletar relacionamentos em cascata (SQLAlchemy deve cuidar)
         # Mas vamos ser explícitos para evitar erro de FK
         Share.query.filter_by(owner_id=user_id).delete()
         Share.query.filter_by(shared_with_id=user_id).delete()
         Comment.query.filter_by(user_id=user_id).delete()
-        ExecutionLog.query.filter_by(user_id=user_id).delete()
+        delete_execution_logs(ExecutionLog.user_id == user_id)
         Activity.query.filter_by(user_id=user_id).delete()
+        ActivityRollup.query.filter_by(user_id=user_id).delete()
+        StorageReport.query.filter_by(user_id=user_id).delete()
+        for upload in UploadSession.query.filter_by(user_id=user_id).all():
+            _discard_upload_session(upload, 'aborted')
+        UploadSession.query.filter_by(user_id=user_id).delete()
         
         # Deletar pastas e arquivos
+        user_folder_ids = db.select(Folder.id).where(Folder.user_id == user_id)
+        FolderClosure.query.filter(FolderClosure.descendant_id.in_(user_folder_ids)).delete(synchronize_session=False)
+        Folder.query.filter_by(user_id=user_id).update({'parent_id': None}, synchronize_session=False)
         Folder.query.filter_by(user_id=user_id).delete()
         File.query.filter_by(user_id=user_id).delete()
         
@@ -870,101 +1591,1919 @@ def delete_user(user_id):
 def calculate_file_hash(file_path):
     hash_sha256 = hashlib.sha256()
     with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
             hash_sha256.update(chunk)
     return hash_sha256.hexdigest()
 
-# Função auxiliar para obter uso de armazenamento do usuário
+# Função auxiliar para detectar o tipo MIME a partir dos bytes iniciais do arquivo
+def detect_mime_type(head, filename):
+    mime_type = None
+    if magic and head:
+        try:
+            mime_type = magic.from_buffer(head, mime=True)
+        except Exception:
+            mime_type = None
+    if not mime_type:
+        mime_type, _ = mimetypes.guess_type(filename)
+    return mime_type or 'application/octet-stream'
+
+# === STORE DE CONTEÚDO (BLOBS) ===
+
+def blob_path(file_hash):
+    return os.path.join(BLOB_FOLDER, file_hash[:2], file_hash[2:4], file_hash)
+
+def is_blob_path(path):
+    try:
+        return os.path.commonpath([os.path.abspath(path), BLOB_FOLDER]) == BLOB_FOLDER
+    except ValueError:
+        return False
+
+def acquire_blob(file_hash, file_size, source_path):
+    """Adiciona uma referência ao blob `file_hash` e retorna seu caminho.
+    Se o blob ainda não existir, `source_path` (arquivo com o mesmo conteúdo)
+    é movido para o store; caso contrário é descartado. Não faz commit.
+    """
+    path = blob_path(file_hash)
+    if not reference_blob(file_hash):
+        try:
+            # Savepoint: se outro worker criar o mesmo blob em paralelo, a PK
+            # conflita sem desfazer o restante da transação corrente
+            with db.session.begin_nested():
+                db.session.add(ContentBlob(file_hash=file_hash, file_size=file_size, ref_count=1))
+        except IntegrityError:
+            ContentBlob.query.filter_by(file_hash=file_hash).update(
+                {'ref_count': ContentBlob.ref_count + 1}, synchronize_session=False
+            )
+    if not os.path.exists(path):
+        # Blob novo (ou registro sem conteúdo em disco): promover o arquivo
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.chmod(source_path, 0o444)
+        os.replace(source_path, path)
+    elif os.path.abspath(source_path) != path:
+        os.remove(source_path)
+    return path
+
+def reference_blob(file_hash):
+    """Adiciona uma referência a um blob existente. Retorna False se não existir. Não faz commit."""
+    return bool(ContentBlob.query.filter_by(file_hash=file_hash).update(
+        {'ref_count': ContentBlob.ref_count + 1}, synchronize_session=False
+    ))
+
+def release_blob(file_hash, count=1):
+    """Remove `count` referências ao blob. Quando a última referência sai, apaga o
+    registro e tira o conteúdo do caminho do blob (rename, enquanto a linha está
+    bloqueada, para não apagar um blob recriado em paralelo). O arquivo só é
+    apagado depois do commit; se a transação for desfeita, volta ao lugar.
+    Não faz commit.
+    """
+    ContentBlob.query.filter_by(file_hash=file_hash).update(
+        {'ref_count': ContentBlob.ref_count - count}, synchronize_session=False
+    )
+    removed = ContentBlob.query.filter(
+        ContentBlob.file_hash == file_hash, ContentBlob.ref_count <= 0
+    ).delete(synchronize_session=False)
+    if removed:
+        path = blob_path(file_hash)
+        released = f"{path}.{uuid.uuid4().hex}.released"
+        try:
+            os.replace(path, released)
+            db.session.info.setdefault('released_blobs', []).append((path, released))
+        except FileNotFoundError:
+            pass
+        # Thumbnails e demais derivados do conteúdo saem junto
+        derived_cache.invalidate(file_hash)
+    return bool(removed)
+
+@event.listens_for(SessionBase, 'after_commit')
+def _delete_released_blobs(session):
+    if session.in_nested_transaction():
+        return  # savepoint: a transação externa ainda pode ser desfeita
+    for _, released in session.info.pop('released_blobs', ()):
+        try:
+            os.remove(released)
+        except FileNotFoundError:
+            pass
+
+@event.listens_for(SessionBase, 'after_rollback')
+def _restore_released_blobs(session):
+    # Conteúdo é endereçado pelo hash: se um upload paralelo já recriou o blob,
+    # o arquivo dele é idêntico e o rename só o substitui pelo mesmo conteúdo
+    if session.in_nested_transaction():
+        return
+    for path, released in session.info.pop('released_blobs', ()):
+        try:
+            os.replace(released, path)
+        except FileNotFoundError:
+            pass
+
+def remove_stored_content(file_path, file_hash):
+    """Libera o conteúdo de um File/FileVersion: blob referenciado ou arquivo legado."""
+    if is_blob_path(file_path):
+        release_blob(file_hash)
+    elif os.path.exists(file_path):
+        os.remove(file_path)
+
+def file_working_dir(file):
+    """Diretório lógico do arquivo (pasta do usuário), usado como cwd em execuções."""
+    if not is_blob_path(file.file_path):
+        return os.path.dirname(file.file_path)
+    user = User.query.get(file.user_id)
+    return resolve_target_dir(user, file.folder_id) or resolve_target_dir(user, None)
+
+# Função auxiliar para resolver (e criar) o diretório de destino de um upload.
+# Retorna None se a pasta não existir ou não pertencer ao usuário.
+def resolve_target_dir(user, folder_id):
+    if folder_id:
+        folder = Folder.query.filter_by(id=folder_id, user_id=user.id).first()
+        if not folder:
+            return None
+        target_dir = os.path.join(app.config['UPLOAD_FOLDER'], folder.path)
+    else:
+        target_dir = os.path.join(app.config['UPLOAD_FOLDER'], user.username)
+    os.makedirs(target_dir, exist_ok=True)
+    return target_dir
+
+# Função auxiliar para obter uso de armazenamento do usuário (contador mantido)
 def get_user_storage_usage(user_id):
-    files = File.query.filter_by(user_id=user_id).all()
-    return sum(file.file_size for file in files)
+    return db.session.query(User.storage_used).filter_by(id=user_id).scalar() or 0
 
-# Função auxiliar para verificar se arquivo é executável com segurança
-def is_safe_executable(file_path):
-    safe_extensions = ['.py', '.sh', '.js', '.php', '.rb', '.pl', '.java']
-    return any(file_path.lower().endswith(ext) for ext in safe_extensions)
+def reserve_storage(user_id, nbytes):
+    """Reserva espaço na quota com um UPDATE condicional e faz commit, para que
+    a reserva fique visível aos outros workers. Retorna False se não couber."""
+    reserved = User.query.filter(
+        User.id == user_id,
+        User.storage_used + User.storage_reserved + nbytes <= User.storage_quota
+    ).update({'storage_reserved': User.storage_reserved + nbytes}, synchronize_session=False)
+    db.session.commit()
+    return bool(reserved)
 
-# Função auxiliar para gerar token de compartilhamento
-def generate_share_token():
-    import secrets
-    return secrets.token_urlsafe(32)
+def consume_storage(user_id, nbytes):
+    """Debita nbytes do uso se couber na quota (UPDATE condicional). Não faz commit;
+    usado quando o registro File é criado na mesma transação."""
+    return bool(User.query.filter(
+        User.id == user_id,
+        User.storage_used + User.storage_reserved + nbytes <= User.storage_quota
+    ).update({'storage_used': User.storage_used + nbytes}, synchronize_session=False))
 
-# Função auxiliar para log de atividades
-def log_activity(user_id, action, resource_type, resource_id, resource_name, details=None):
-    activity = Activity(
-        user_id=user_id,
-        action=action,
-        resource_type=resource_type,
-        resource_id=resource_id,
-        resource_name=resource_name,
-        details=details,
-        ip_address=request.remote_addr
+def adjust_storage(user_id, used=0, reserved=0):
+    """Ajusta os contadores de uso/reserva na transação corrente. Não faz commit."""
+    values = {}
+    if used:
+        values['storage_used'] = User.storage_used + used
+    if reserved:
+        values['storage_reserved'] = User.storage_reserved + reserved
+    if values:
+        User.query.filter_by(id=user_id).update(values, synchronize_session=False)
+
+def reconcile_storage_usage():
+    """Recalcula storage_used (soma de File.file_size) e storage_reserved (sessões
+    de upload abertas) de todos os usuários, com um UPDATE agregado para cada.
+    Reservas de uploads simples em andamento são zeradas: rode em baixa atividade."""
+    used = db.session.query(db.func.coalesce(db.func.sum(File.file_size), 0)).filter(
+        File.user_id == User.id
+    ).scalar_subquery()
+    reserved = db.session.query(db.func.coalesce(db.func.sum(UploadSession.total_size), 0)).filter(
+        UploadSession.user_id == User.id, UploadSession.status.in_(('active', 'finalizing'))
+    ).scalar_subquery()
+    User.query.update({'storage_used': used, 'storage_reserved': reserved}, synchronize_session=False)
+    db.session.commit()
+
+# === RELATÓRIO DE ARMAZENAMENTO (ADMIN) ===
+
+def mime_category_expression():
+    """Expressão SQL que classifica File.mime_type em categorias do relatório."""
+    mime = db.func.coalesce(File.mime_type, '')
+    return case(
+        (mime.like('image/%'), 'image'),
+        (mime.like('video/%'), 'video'),
+        (mime.like('audio/%'), 'audio'),
+        (db.or_(mime.like('text/%'), mime == 'application/pdf', mime.like('application/msword%'),
+                mime.like('application/vnd.openxmlformats%'), mime.like('application/vnd.oasis%')), 'document'),
+        (mime.in_(('application/zip', 'application/x-tar', 'application/gzip', 'application/x-gzip',
+                   'application/x-7z-compressed', 'application/x-rar', 'application/x-rar-compressed',
+                   'application/x-bzip2', 'application/x-xz')), 'archive'),
+        else_='other'
     )
-    db.session.add(activity)
+
+def refresh_storage_report():
+    """Recalcula o relatório materializado: um GROUP BY (usuário, categoria) para
+    totais e breakdown, e uma consulta com ROW_NUMBER() para os maiores arquivos.
+    Substitui todas as linhas de StorageReport em uma transação."""
+    started = datetime.utcnow()
+    category = mime_category_expression().label('category')
+    rows = db.session.query(
+        File.user_id, category, db.func.sum(File.file_size), db.func.count(File.id)
+    ).group_by(File.user_id, category).all()
+
+    ranked = db.session.query(
+        File.id, File.user_id, File.original_name, File.file_size, File.mime_type,
+        db.func.row_number().over(partition_by=File.user_id, order_by=File.file_size.desc()).label('rank')
+    ).subquery()
+    largest = db.session.query(ranked).filter(ranked.c.rank <= STORAGE_REPORT_LARGEST_FILES).all()
+
+    stats = {}
+    for user_id, cat, total, count in rows:
+        entry = stats.setdefault(user_id, {'bytes': 0, 'files': 0, 'categories': {}, 'largest': []})
+        entry['bytes'] += int(total or 0)
+        entry['files'] += int(count or 0)
+        entry['categories'][cat] = {'bytes': int(total or 0), 'files': int(count or 0)}
+    for row in sorted(largest, key=lambda r: (r.user_id, r.rank)):
+        if row.user_id in stats:
+            stats[row.user_id]['largest'].append({
+                'id': row.id, 'name': row.original_name, 'size': row.file_size, 'mime_type': row.mime_type
+            })
+
+    users = db.session.query(User.id, User.username, User.storage_quota).all()
+    StorageReport.query.delete(synchronize_session=False)
+    db.session.bulk_insert_mappings(StorageReport, [{
+        'user_id': uid,
+        'username': username,
+        'storage_quota': quota,
+        'total_bytes': stats.get(uid, {}).get('bytes', 0),
+        'file_count': stats.get(uid, {}).get('files', 0),
+        'by_category': json.dumps(stats.get(uid, {}).get('categories', {})),
+        'largest_files': json.dumps(stats.get(uid, {}).get('largest', [])),
+        'refreshed_at': started
+    } for uid, username, quota in users])
+
+    state = db.session.get(StorageReportState, 1) or StorageReportState(id=1)
+    state.refreshed_at = started
+    state.refreshing_since = None
+    state.duration_ms = int((datetime.utcnow() - started).total_seconds() * 1000)
+    db.session.add(state)
     db.session.commit()
 
-# Função auxiliar para verificar tipos de arquivo streamable
-def is_streamable_file(mime_type):
-    if not mime_type:
+def _claim_storage_report_refresh():
+    """Lock entre workers: só um processo recalcula o relatório por vez."""
+    now = datetime.utcnow()
+    if not db.session.get(StorageReportState, 1):
+        try:
+            db.session.add(StorageReportState(id=1))
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+    claimed = StorageReportState.query.filter(
+        StorageReportState.id == 1,
+        db.or_(StorageReportState.refreshing_since.is_(None),
+               StorageReportState.refreshing_since < now - timedelta(minutes=10))
+    ).update({'refreshing_since': now}, synchronize_session=False)
+    db.session.commit()
+    return bool(claimed)
+
+_storage_report_thread = None
+
+def schedule_storage_report_refresh():
+    """Dispara o refresh em uma thread de background (no máximo uma por processo)."""
+    global _storage_report_thread
+    if _storage_report_thread and _storage_report_thread.is_alive():
         return False
-    
-    streamable_types = [
-        'video/', 'audio/', 'image/',
-        'application/pdf',
-        'text/', 'application/json',
-        'application/javascript',
-        'application/xml'
-    ]
-    
-    return any(mime_type.startswith(stype) for stype in streamable_types)
 
-# Função auxiliar para criar thumbnail
-def create_thumbnail(file_path, mime_type):
-    if not mime_type or not mime_type.startswith('image/') or not Image:
-        return None
-    
-    try:
-        # Criar diretório de thumbnails se não existir
-        thumb_dir = os.path.join(app.config['UPLOAD_FOLDER'], '.thumbnails')
-        os.makedirs(thumb_dir, exist_ok=True)
-        
-        # Gerar nome do thumbnail
-        file_hash = calculate_file_hash(file_path)
-        thumb_path = os.path.join(thumb_dir, f"{file_hash}_thumb.jpg")
-        
-        # Criar thumbnail se não existir
-        if not os.path.exists(thumb_path):
-            with Image.open(file_path) as img:
-                img.thumbnail((200, 200), Image.Resampling.LANCZOS)
-                img.convert('RGB').save(thumb_path, 'JPEG', quality=85)
-        
-        return thumb_path
-    except Exception as e:
-        print(f"Erro ao criar thumbnail: {e}")
-        return None
+    def run():
+        with app.app_context():
+            try:
+                if _claim_storage_report_refresh():
+                    refresh_storage_report()
+            except Exception as e:
+                db.session.rollback()
+                StorageReportState.query.filter_by(id=1).update({'refreshing_since': None}, synchronize_session=False)
+                db.session.commit()
+                print(f"Aviso: falha ao atualizar relatório de armazenamento: {e}")
+            finally:
+                db.session.remove()
 
-# Rotas da API
+    _storage_report_thread = threading.Thread(target=run, name='storage-report-refresh', daemon=True)
+    _storage_report_thread.start()
+    return True
 
-@app.route('/')
-def index():
-    return render_template('index_modern.html')
+# === HIERARQUIA DE PASTAS (CLOSURE TABLE) ===
 
-@app.route('/api/test', methods=['GET'])
-def test_api():
-    return jsonify({'message': 'API funcionando!', 'status': 'ok'}), 200
+def link_folder_closure(folder_id, parent_id):
+    """Registra uma pasta recém-criada na closure table (sem commit)."""
+    db.session.add(FolderClosure(ancestor_id=folder_id, descendant_id=folder_id, depth=0))
+    if parent_id:
+        parent_links = db.select(
+            FolderClosure.ancestor_id, db.literal(folder_id), FolderClosure.depth + 1
+        ).where(FolderClosure.descendant_id == parent_id)
+        db.session.execute(db.insert(FolderClosure).from_select(
+            ['ancestor_id', 'descendant_id', 'depth'], parent_links
+        ))
 
-@app.route('/api/register', methods=['POST'])
-def register():
-    if 'NO_DB_CONFIG' in globals() and NO_DB_CONFIG:
-        return jsonify({'error': 'Sistema em modo de configuração. Configure o MySQL primeiro.'}), 503
-    data = request.get_json()
-    username = data.get('username')
-    email = data.get('email')
-    password = data.get('password')
-    
-    if not username or not email or not password:
-        return jsonify({'error': 'Todos os campos são obrigatórios'}), 400
-    
+def folder_subtree_ids(folder_id):
+    """Subconsulta com os ids da pasta e de todas as suas descendentes."""
+    return db.select(FolderClosure.descendant_id).where(FolderClosure.ancestor_id == folder_id)
+
+def folder_breadcrumb(folder_id, user_id):
+    """Caminho da raiz até a pasta em uma consulta."""
+    rows = db.session.query(Folder.id, Folder.name).join(
+        FolderClosure, FolderClosure.ancestor_id == Folder.id
+    ).filter(
+        FolderClosure.descendant_id == folder_id, Folder.user_id == user_id
+    ).order_by(FolderClosure.depth.desc()).all()
+    return [{'id': row.id, 'name': row.name} for row in rows]
+
+def folder_contains(ancestor_id, folder_id):
+    return db.session.query(FolderClosure.depth).filter_by(
+        ancestor_id=ancestor_id, descendant_id=folder_id
+    ).first() is not None
+
+def rebuild_folder_closure():
+    """Reconstrói a closure table a partir de Folder.parent_id (backfill/reparo)."""
+    parents = dict(db.session.query(Folder.id, Folder.parent_id).all())
+    rows = []
+    for folder_id in parents:
+        depth, current, seen = 0, folder_id, set()
+        while current is not None and current in parents and current not in seen:
+            seen.add(current)
+            rows.append({'ancestor_id': current, 'descendant_id': folder_id, 'depth': depth})
+            current = parents[current]
+            depth += 1
+    FolderClosure.query.delete(synchronize_session=False)
+    if rows:
+        db.session.bulk_insert_mappings(FolderClosure, rows)
+    db.session.commit()
+    return len(rows)
+
+def adjust_folder_totals(folder_id, size=0, files=0):
+    """Aplica uma variação de bytes/arquivos à pasta e a todos os ancestrais
+    (um UPDATE via closure table). Não faz commit."""
+    if not folder_id or (not size and not files):
+        return
+    ancestors = db.select(FolderClosure.ancestor_id).where(FolderClosure.descendant_id == folder_id)
+    Folder.query.filter(Folder.id.in_(ancestors)).update({
+        'total_size': Folder.total_size + size,
+        'total_files': Folder.total_files + files
+    }, synchronize_session=False)
+
+def rebuild_folder_totals():
+    """Recalcula os totais de todas as pastas em uma passada (UPDATE agregado
+    sobre a closure table). Use como reparo após divergências."""
+    def subtree_aggregate(column):
+        return db.select(column).select_from(File).join(
+            FolderClosure, FolderClosure.descendant_id == File.folder_id
+        ).where(FolderClosure.ancestor_id == Folder.id).scalar_subquery()
+    size = subtree_aggregate(db.func.coalesce(db.func.sum(File.file_size), 0))
+    count = subtree_aggregate(db.func.count(File.id))
+    updated = Folder.query.update({'total_size': size, 'total_files': count}, synchronize_session=False)
+    db.session.commit()
+    return updated
+
+# === LISTAGEM PAGINADA (KEYSET) ===
+
+FILE_LISTING_SORTS = {
+    'name': File.original_name,
+    'date': File.created_at,
+    'size': File.file_size
+}
+
+def encode_listing_cursor(sort, value, last_id):
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    raw = json.dumps([sort, value, last_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def decode_listing_cursor(cursor, sort):
+    """Retorna (valor, id) do último item da página anterior; ValueError se inválido."""
+    try:
+        cursor_sort, value, last_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception:
+        raise ValueError('Cursor inválido')
+    if cursor_sort != sort:
+        raise ValueError('Cursor não corresponde à ordenação')
+    if sort == 'date':
+        value = datetime.fromisoformat(value)
+    return value, int(last_id)
+
+def parse_listing_args():
+    """Lê sort/order/limit/cursor da query string. Levanta ValueError se inválidos.
+    limit é None quando nem limit nem cursor foram informados (listagem completa)."""
+    sort = request.args.get('sort', 'name')
+    if sort not in FILE_LISTING_SORTS:
+        raise ValueError('sort deve ser name, date ou size')
+    order = request.args.get('order', 'asc')
+    if order not in ('asc', 'desc'):
+        raise ValueError('order deve ser asc ou desc')
+    cursor = request.args.get('cursor')
+    # Sem limit nem cursor (clientes antigos) a listagem vem completa: limit None
+    limit = None
+    if cursor or 'limit' in request.args:
+        limit = min(LISTING_MAX_LIMIT, max(1, request.args.get('limit', LISTING_DEFAULT_LIMIT, type=int)))
+    after = decode_listing_cursor(cursor, sort) if cursor else None
+    return sort, order, limit, after
+
+def file_listing_query(user_id, folder_id, sort, order, after=None, recursive=False):
+    """Consulta projetada (só as colunas listadas) ordenada por (sort, id), com
+    condição de keyset a partir do último item já entregue. Com recursive=True
+    inclui os arquivos de toda a subárvore (via closure table)."""
+    column = FILE_LISTING_SORTS[sort]
+    query = db.session.query(
+        File.id, File.original_name, File.file_size, File.mime_type,
+        File.is_favorite, File.created_at, File.updated_at, File.folder_id, File.file_hash
+    ).filter(File.user_id == user_id)
+    if not recursive:
+        query = query.filter(File.folder_id == folder_id)
+    elif folder_id:
+        query = query.filter(File.folder_id.in_(folder_subtree_ids(folder_id)))
+    if after:
+        value, last_id = after
+        if order == 'asc':
+            query = query.filter(db.or_(column > value, db.and_(column == value, File.id > last_id)))
+        else:
+            query = query.filter(db.or_(column < value, db.and_(column == value, File.id < last_id)))
+    if order == 'asc':
+        return query.order_by(column.asc(), File.id.asc())
+    return query.order_by(column.desc(), File.id.desc())
+
+def file_count_hint(user_id, folder_id, recursive=False):
+    """Contagem limitada a LISTING_COUNT_HINT_CAP (evita varrer pastas enormes)."""
+    query = db.session.query(File.id).filter(File.user_id == user_id)
+    if not recursive:
+        query = query.filter(File.folder_id == folder_id)
+    elif folder_id:
+        query = query.filter(File.folder_id.in_(folder_subtree_ids(folder_id)))
+    capped = query.limit(LISTING_COUNT_HINT_CAP + 1).subquery()
+    total = db.session.query(db.func.count()).select_from(capped).scalar()
+    return min(total, LISTING_COUNT_HINT_CAP), total <= LISTING_COUNT_HINT_CAP
+
+def stream_file_listing(header, fetch_page, serialize, sort, limit=None, after=None):
+    """Gera o JSON da listagem em partes: cabeçalho, arquivos um a um e, ao final,
+    next_cursor. fetch_page(after, size) devolve até `size` linhas após o keyset
+    `after`; as linhas vêm em blocos de LISTING_DEFAULT_LIMIT, sem cursor aberto
+    durante a resposta. Sem limit entrega todos os arquivos (formato antigo).
+    Uma falha no meio ainda fecha o JSON, com 'error' e o cursor para retomar."""
+    column_by_sort = {'name': 'original_name', 'date': 'created_at', 'size': 'file_size'}
+    yield json.dumps(header)[:-1] + ', "files": ['
+    count = 0
+    last = None
+    has_more = False
+    error = None
+    try:
+        while True:
+            # Uma linha a mais no último bloco indica has_more
+            size = LISTING_DEFAULT_LIMIT if limit is None else min(LISTING_DEFAULT_LIMIT, limit - count + 1)
+            page = fetch_page(after, size)
+            for row in page:
+                if count == limit:
+                    has_more = True
+                    break
+                yield (', ' if count else '') + json.dumps(serialize(row))
+                count += 1
+                last = row
+            if has_more or len(page) < size:
+                break
+            after = (getattr(last, column_by_sort[sort]), last.id)
+    except Exception as e:
+        db.session.rollback()
+        error = f'Listagem interrompida: {e}'
+    finally:
+        next_cursor = None
+        if (has_more or error) and last is not None:
+            next_cursor = encode_listing_cursor(sort, getattr(last, column_by_sort[sort]), last.id)
+        tail = {'next_cursor': next_cursor, 'has_more': has_more or bool(next_cursor), 'returned': count}
+        if error:
+            tail['error'] = error
+    yield '], ' + json.dumps(tail)[1:]
+
+# Função auxiliar para verificar se arquivo é executável com segurança
+def is_safe_executable(file_path):
+    safe_extensions = ['.py', '.sh', '.js', '.php', '.rb', '.pl', '.java']
+    return any(file_path.lower().endswith(ext) for ext in safe_extensions)
+
+# Função auxiliar para gerar token de compartilhamento
+def generate_share_token():
+    import secrets
+    return secrets.token_urlsafe(32)
+
+# === LOG DE ATIVIDADES (ESCRITA ASSÍNCRONA EM LOTE) ===
+
+class ActivityWriter:
+    """Fila limitada em memória + thread que grava as atividades em lote.
+
+    Eventos são agrupados até ACTIVITY_FLUSH_EVENTS ou ACTIVITY_FLUSH_INTERVAL
+    e gravados com um INSERT em lote por flush. Ações em ACTIVITY_COALESCE_ACTIONS
+    (ex.: 'stream', uma por Range) do mesmo usuário, arquivo e sessão dentro de
+    ACTIVITY_COALESCE_WINDOW viram uma única linha com event_count incrementado.
+    A coalescência é por processo: com N workers do gunicorn, um mesmo stream
+    espalhado entre eles gera até N linhas por janela (a soma de event_count
+    continua exata). Com a fila cheia o evento é descartado e contado em
+    `dropped`; a requisição nunca espera pelo banco.
+    """
+
+    def __init__(self, max_queue, flush_events, flush_interval, coalesce_window):
+        self.max_queue = max_queue
+        self.flush_events = flush_events
+        self.flush_interval = flush_interval
+        self.coalesce_window = coalesce_window
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        # Contadores mudam nas threads das requisições e na thread de gravação
+        self._stats_lock = threading.Lock()
+        # chave de coalescência -> (id da linha, created_at do último evento)
+        self._recent = {}
+        self.stats = {'queued': 0, 'written': 0, 'coalesced': 0, 'dropped': 0,
+                      'flushes': 0, 'errors': 0, 'last_flush_ms': 0}
+
+    def _ensure_started(self):
+        # Após fork (workers do gunicorn) a thread do processo pai não existe
+        if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+                return
+            import queue
+            self._queue = queue.Queue(maxsize=self.max_queue)
+            self._recent = {}
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='activity-writer', daemon=True)
+            self._thread.start()
+
+    def _count(self, **deltas):
+        with self._stats_lock:
+            for name, delta in deltas.items():
+                self.stats[name] += delta
+
+    def stats_snapshot(self):
+        with self._stats_lock:
+            return dict(self.stats)
+
+    def submit(self, event):
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(event)
+            self._count(queued=1)
+            return True
+        except Exception:
+            self._count(dropped=1)
+            return False
+
+    def queue_depth(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def _drain(self, block):
+        import queue
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.flush_events:
+            timeout = deadline - time.monotonic()
+            try:
+                if block and timeout > 0:
+                    batch.append(self._queue.get(timeout=timeout))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._drain(block=True)
+            if batch:
+                self._write(batch)
+
+    def flush(self):
+        """Grava imediatamente tudo o que está na fila e espera o lote que a
+        thread estiver gravando (testes, shutdown, CLI)."""
+        if self._queue is None or self._pid != os.getpid():
+            return
+        while True:
+            batch = self._drain(block=False)
+            if not batch:
+                break
+            self._write(batch)
+        self._queue.join()
+
+    def _write(self, batch):
+        started = time.perf_counter()
+        with self._flush_lock, app.app_context():
+            try:
+                self._write_batch(batch)
+                self._count(flushes=1)
+            except Exception as e:
+                db.session.rollback()
+                self._count(errors=1)
+                self._recent = {}
+                print(f"Aviso: falha ao gravar {len(batch)} atividade(s): {e}")
+            finally:
+                db.session.remove()
+        with self._stats_lock:
+            self.stats['last_flush_ms'] = int((time.perf_counter() - started) * 1000)
+        for _ in batch:
+            self._queue.task_done()
+
+    def _write_batch(self, batch):
+        rows = []
+        coalesced_rows = {}
+        increments = {}
+        coalesced = 0
+        for event in batch:
+            key = event.pop('coalesce_key', None)
+            if key is None:
+                rows.append(event)
+                continue
+            recent = self._recent.get(key)
+            if key in coalesced_rows:
+                coalesced_rows[key]['event_count'] += 1
+            elif recent and event['created_at'] - recent[1] <= self.coalesce_window:
+                increments[recent[0]] = increments.get(recent[0], 0) + 1
+                self._recent[key] = (recent[0], event['created_at'])
+            else:
+                coalesced_rows[key] = event
+                continue
+            coalesced += 1
+
+        if rows:
+            db.session.execute(db.insert(Activity), rows)
+        # Linhas coalescíveis novas precisam do id para receber os próximos eventos
+        new_activities = {key: Activity(**event) for key, event in coalesced_rows.items()}
+        db.session.add_all(new_activities.values())
+        for activity_id, count in increments.items():
+            Activity.query.filter_by(id=activity_id).update(
+                {'event_count': Activity.event_count + count}, synchronize_session=False
+            )
+        db.session.commit()
+        for key, activity in new_activities.items():
+            self._recent[key] = (activity.id, activity.created_at)
+        self._count(written=len(rows) + len(new_activities), coalesced=coalesced)
+
+        # Esquecer chaves fora da janela
+        cutoff = datetime.utcnow() - self.coalesce_window
+        self._recent = {k: v for k, v in self._recent.items() if v[1] >= cutoff}
+
+activity_writer = ActivityWriter(
+    max_queue=ACTIVITY_QUEUE_SIZE,
+    flush_events=ACTIVITY_FLUSH_EVENTS,
+    flush_interval=ACTIVITY_FLUSH_INTERVAL,
+    coalesce_window=ACTIVITY_COALESCE_WINDOW
+)
+atexit.register(activity_writer.flush)
+
+def _activity_session_key():
+    """Identifica a sessão do cliente (JWT ou token de compartilhamento usado)."""
+    credential = (request.args.get('token') or request.args.get('jwt')
+                  or request.headers.get('Authorization') or request.remote_addr or '')
+    return hashlib.sha1(credential.encode('utf-8')).hexdigest()[:16]
+
+# Função auxiliar para log de atividades
+def log_activity(user_id, action, resource_type, resource_id, resource_name, details=None):
+    event = {
+        'user_id': user_id,
+        'action': action,
+        'resource_type': resource_type,
+        'resource_id': resource_id,
+        'resource_name': resource_name,
+        'details': details,
+        'ip_address': request.remote_addr,
+        'created_at': datetime.utcnow(),
+        'event_count': 1
+    }
+    if not ACTIVITY_ASYNC:
+        db.session.add(Activity(**event))
+        db.session.commit()
+        return
+    if action in ACTIVITY_COALESCE_ACTIONS:
+        event['coalesce_key'] = (user_id, action, resource_type, resource_id, _activity_session_key())
+    activity_writer.submit(event)
+
+def archive_activities(days=None, batch=5000):
+    """Move eventos mais antigos que `days` para resumos diários por
+    usuário/ação (activity_rollup) e apaga as linhas brutas, em lotes por id
+    (cada lote em sua transação). Retorna (eventos arquivados, linhas de resumo tocadas)."""
+    days = ACTIVITY_RETENTION_DAYS if days is None else days
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    archived = touched = 0
+    day = db.func.date(Activity.created_at)
+    while True:
+        ids = [row[0] for row in db.session.query(Activity.id).filter(
+            Activity.created_at < cutoff
+        ).order_by(Activity.id).limit(batch)]
+        if not ids:
+            break
+        groups = db.session.query(
+            day, Activity.user_id, Activity.action, Activity.resource_type,
+            db.func.sum(Activity.event_count)
+        ).filter(Activity.id.in_(ids)).group_by(
+            day, Activity.user_id, Activity.action, Activity.resource_type
+        ).all()
+        for group_day, user_id, action, resource_type, count in groups:
+            if isinstance(group_day, str):
+                group_day = datetime.strptime(group_day, '%Y-%m-%d').date()
+            updated = ActivityRollup.query.filter_by(
+                day=group_day, user_id=user_id, action=action, resource_type=resource_type
+            ).update({'event_count': ActivityRollup.event_count + count}, synchronize_session=False)
+            if not updated:
+                db.session.add(ActivityRollup(day=group_day, user_id=user_id, action=action,
+                                              resource_type=resource_type, event_count=count))
+            touched += 1
+        Activity.query.filter(Activity.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        archived += len(ids)
+    return archived, touched
+
+def activity_feed_query(after=None):
+    """Atividades em ordem (created_at, id) decrescente, a partir do cursor."""
+    query = db.session.query(
+        Activity.id, Activity.user_id, Activity.action, Activity.resource_type, Activity.resource_id,
+        Activity.resource_name, Activity.details, Activity.ip_address, Activity.event_count, Activity.created_at
+    )
+    if after:
+        value, last_id = after
+        query = query.filter(db.or_(
+            Activity.created_at < value,
+            db.and_(Activity.created_at == value, Activity.id < last_id)
+        ))
+    return query.order_by(Activity.created_at.desc(), Activity.id.desc())
+
+def parse_activity_page_args():
+    """limit/cursor/since/until da query string. Levanta ValueError se inválidos."""
+    limit = request.args.get('limit', ACTIVITY_FEED_DEFAULT_LIMIT, type=int)
+    limit = max(1, min(limit or ACTIVITY_FEED_DEFAULT_LIMIT, ACTIVITY_FEED_MAX_LIMIT))
+    cursor = request.args.get('cursor')
+    after = decode_listing_cursor(cursor, 'date') if cursor else None
+    bounds = []
+    for name in ('since', 'until'):
+        value = request.args.get(name)
+        try:
+            bounds.append(datetime.fromisoformat(value) if value else None)
+        except ValueError:
+            raise ValueError(f'{name} deve estar em ISO 8601')
+    return limit, after, bounds[0], bounds[1]
+
+def activity_page(query, limit, serialize):
+    rows = query.limit(limit + 1).all()
+    page = rows[:limit]
+    next_cursor = None
+    if len(rows) > limit:
+        next_cursor = encode_listing_cursor('date', page[-1].created_at, page[-1].id)
+    return {'activities': [serialize(row) for row in page], 'next_cursor': next_cursor}
+
+# Função auxiliar para verificar tipos de arquivo streamable
+def is_streamable_file(mime_type):
+    if not mime_type:
+        return False
+    
+    streamable_types = [
+        'video/', 'audio/', 'image/',
+        'application/pdf',
+        'text/', 'application/json',
+        'application/javascript',
+        'application/xml'
+    ]
+    
+    return any(mime_type.startswith(stype) for stype in streamable_types)
+
+# Função auxiliar para criar thumbnail
+# === THUMBNAILS ===
+
+def thumbnail_path(file_hash, size, fmt):
+    """Thumbnail derivado do blob: um arquivo por (hash, tamanho, formato)."""
+    return derived_cache.path_for('thumb', file_hash, f"{size}.{fmt}")
+
+def thumbnail_size_for(requested):
+    """Menor tamanho pré-definido que cobre o pedido (ou o maior disponível)."""
+    for size in THUMBNAIL_SIZES:
+        if requested <= size:
+            return size
+    return THUMBNAIL_SIZES[-1]
+
+def negotiate_image_format():
+    """WebP quando o cliente aceita (Accept: image/webp), senão JPEG."""
+    return 'webp' if 'image/webp' in request.headers.get('Accept', '') else 'jpg'
+
+def render_thumbnail(source_path, dest_path, size, fmt):
+    """Gera o thumbnail com decodificação reduzida do JPEG (draft) e grava de
+    forma atômica (arquivo temporário + rename)."""
+    from PIL import ImageOps
+    with Image.open(source_path) as img:
+        # JPEG: o decoder já entrega em escala 1/2, 1/4 ou 1/8 (bem mais barato)
+        img.draft('RGB', (size, size))
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((size, size), Image.Resampling.LANCZOS)
+        save_image_atomic(img, dest_path, fmt, THUMBNAIL_QUALITY)
+
+def save_image_atomic(img, dest_path, fmt, quality):
+    """Grava a imagem em JPEG ou WebP (mantendo transparência no WebP) via
+    arquivo temporário + rename, para leitores nunca verem um arquivo parcial."""
+    has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+    img = img.convert('RGBA' if has_alpha and fmt == 'webp' else 'RGB')
+    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest_path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            if fmt == 'webp':
+                img.save(out, 'WEBP', quality=quality, method=4)
+            else:
+                img.save(out, 'JPEG', quality=quality, optimize=True, progressive=max(img.size) >= 400)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, dest_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def content_version(file_hash):
+    """Prefixo do hash usado como ?v= nas URLs de imagem (muda com o conteúdo)."""
+    return file_hash[:16] if file_hash else None
+
+def parse_image_variant(args):
+    """Lê w/h/fit/q de /api/image. Dimensões arredondadas para cima em passos de
+    IMAGE_DIMENSION_STEP (limita as variantes no cache). ValueError se inválidos."""
+    def dimension(name):
+        value = args.get(name, type=int)
+        if value is None:
+            return 0
+        if value < 1:
+            raise ValueError(f'{name} deve ser positivo')
+        value = -(-value // IMAGE_DIMENSION_STEP) * IMAGE_DIMENSION_STEP
+        return min(value, IMAGE_MAX_DIMENSION)
+    width, height = dimension('w'), dimension('h')
+    if not width and not height:
+        raise ValueError('Informe w e/ou h')
+    fit = args.get('fit', 'contain')
+    if fit not in ('contain', 'cover'):
+        raise ValueError('fit deve ser contain ou cover')
+    if fit == 'cover' and not (width and height):
+        raise ValueError('fit=cover exige w e h')
+    quality = args.get('q', IMAGE_DEFAULT_QUALITY, type=int)
+    quality = min(95, max(30, quality or IMAGE_DEFAULT_QUALITY))
+    return width, height, fit, quality
+
+def render_resized_image(source_path, dest_path, width, height, fit, quality, fmt):
+    """Redimensiona sem ampliar: contain cabe em w x h (0 = livre), cover
+    preenche w x h recortando o centro."""
+    from PIL import ImageOps
+    with Image.open(source_path) as img:
+        src_width, src_height = img.size
+        bound_w = width or src_width * (height / src_height)
+        bound_h = height or src_height * (width / src_width)
+        img.draft('RGB', (int(bound_w), int(bound_h)))
+        img = ImageOps.exif_transpose(img)
+        if fit == 'cover':
+            # Original menor que a caixa: reduz a caixa (mesma proporção) em vez de ampliar
+            scale = max(1, max(width / img.width, height / img.height))
+            box = (max(1, round(width / scale)), max(1, round(height / scale)))
+            img = ImageOps.fit(img, box, Image.Resampling.LANCZOS)
+        else:
+            img.thumbnail((int(width or img.width), int(height or img.height)), Image.Resampling.LANCZOS)
+        save_image_atomic(img, dest_path, fmt, quality)
+
+def single_flight(lock_path):
+    """Trava exclusiva entre threads e processos (flock) para que só um gere
+    um mesmo artefato; os demais esperam e reaproveitam o resultado."""
+    import contextlib
+
+    @contextlib.contextmanager
+    def held():
+        os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+        with open(lock_path, 'a') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+    return held()
+
+class DerivedCache:
+    """Cache em disco de artefatos derivados de blobs, limitado a `max_bytes`.
+
+    O índice (DerivedAsset) guarda tamanho, contagem e último acesso de cada
+    artefato. Acessos são acumulados em memória e gravados em lote; ao passar
+    do orçamento, os menos usados (LRU, ou LFU) são apagados até 90% dele.
+    Artefatos de um conteúdo são invalidados quando o blob deixa de existir.
+    Operações do índice usam conexão própria, fora da transação da requisição.
+    """
+
+    def __init__(self, root, max_bytes, policy='lru'):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self._lock = threading.Lock()
+        self._touches = {}
+        self._last_touch_flush = time.monotonic()
+        self._total = None  # bytes no índice (estimativa local entre reconferências)
+        self._total_synced_at = 0.0
+        self.stats = {'hits': 0, 'misses': 0, 'errors': 0, 'evicted': 0, 'evicted_bytes': 0}
+
+    def key_for(self, kind, source_hash, variant):
+        return f"{kind}/{source_hash[:2]}/{source_hash}_{variant}"
+
+    def path_for(self, kind, source_hash, variant):
+        return os.path.join(self.root, *self.key_for(kind, source_hash, variant).split('/'))
+
+    def lock_path_for(self, key):
+        # Arquivo de lock estável: apagá-lo depois do flock deixaria um processo
+        # esperando no inode antigo enquanto outro trava um arquivo novo
+        stripe = int(hashlib.sha1(key.encode('utf-8')).hexdigest(), 16) % DERIVED_CACHE_LOCK_STRIPES
+        return os.path.join(self.root, '.locks', f"{stripe:03d}.lock")
+
+    def get_or_create(self, kind, source_hash, variant, producer):
+        """Caminho do artefato; se ausente, `producer(caminho)` o gera uma única
+        vez (single-flight entre workers). Exceções do producer propagam."""
+        key = self.key_for(kind, source_hash, variant)
+        path = self.path_for(kind, source_hash, variant)
+        if os.path.exists(path):
+            self._touch(key)
+            app_metrics.inc('chiapetta_derived_cache_lookups_total', kind=kind, result='hit')
+            return path
+        try:
+            with single_flight(self.lock_path_for(key)):
+                if os.path.exists(path):
+                    self._touch(key)
+                    app_metrics.inc('chiapetta_derived_cache_lookups_total', kind=kind, result='hit')
+                    return path
+                with self._lock:
+                    self.stats['misses'] += 1
+                app_metrics.inc('chiapetta_derived_cache_lookups_total', kind=kind, result='miss')
+                producer(path)
+                self._register(key, kind, source_hash, os.path.getsize(path))
+        except Exception:
+            with self._lock:
+                self.stats['errors'] += 1
+            raise
+        self.evict_if_needed()
+        return path
+
+    def _touch(self, key):
+        with self._lock:
+            self.stats['hits'] += 1
+            last_access, hits = self._touches.get(key, (None, 0))
+            self._touches[key] = (datetime.utcnow(), hits + 1)
+            due = (len(self._touches) >= DERIVED_CACHE_TOUCH_BATCH
+                   or time.monotonic() - self._last_touch_flush >= DERIVED_CACHE_TOUCH_INTERVAL)
+        if due:
+            self.flush_touches()
+
+    def flush_touches(self):
+        """Grava no índice os acessos acumulados (um UPDATE em lote)."""
+        with self._lock:
+            touches, self._touches = self._touches, {}
+            self._last_touch_flush = time.monotonic()
+        if not touches:
+            return
+        table = DerivedAsset.__table__
+        statement = table.update().where(table.c.key == db.bindparam('k')).values(
+            last_access_at=db.bindparam('accessed'), hit_count=table.c.hit_count + db.bindparam('hits')
+        )
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(statement, [
+                    {'k': key, 'accessed': accessed, 'hits': hits} for key, (accessed, hits) in touches.items()
+                ])
+        except Exception as e:
+            print(f"Aviso: falha ao registrar acessos do cache derivado: {e}")
+
+    def _register(self, key, kind, source_hash, size):
+        table = DerivedAsset.__table__
+        now = datetime.utcnow()
+        with db.engine.begin() as conn:
+            updated = conn.execute(table.update().where(table.c.key == key).values(
+                size_bytes=size, last_access_at=now
+            )).rowcount
+            if not updated:
+                conn.execute(table.insert().values(
+                    key=key, kind=kind, source_hash=source_hash, size_bytes=size,
+                    hit_count=0, created_at=now, last_access_at=now
+                ))
+        if updated:
+            self._set_total(None)  # tamanho anterior desconhecido: reconfere no próximo uso
+        else:
+            self._adjust_total(size)
+
+    def total_bytes(self):
+        with db.engine.connect() as conn:
+            return int(conn.execute(db.select(db.func.coalesce(db.func.sum(DerivedAsset.size_bytes), 0))).scalar())
+
+    def _set_total(self, total):
+        with self._lock:
+            self._total = total
+            self._total_synced_at = time.monotonic()
+
+    def _adjust_total(self, delta):
+        with self._lock:
+            if self._total is not None:
+                self._total += delta
+
+    def estimated_total(self):
+        """Total em bytes sem consultar o banco a cada miss: soma local das
+        variações, reconferida com SUM no máximo a cada DERIVED_CACHE_TOTAL_RESYNC."""
+        with self._lock:
+            total = self._total
+            stale = total is None or time.monotonic() - self._total_synced_at >= DERIVED_CACHE_TOTAL_RESYNC
+        if stale:
+            total = self.total_bytes()
+            self._set_total(total)
+        return total
+
+    def evict_if_needed(self):
+        """Apaga os artefatos menos usados até ficar abaixo de 90% do orçamento."""
+        if self.estimated_total() <= self.max_bytes:
+            return 0
+        # Confere o valor exato (outros workers podem já ter evictado)
+        total = self.total_bytes()
+        self._set_total(total)
+        if total <= self.max_bytes:
+            return 0
+        self.flush_touches()
+        target = int(self.max_bytes * 0.9)
+        if self.policy == 'lfu':
+            order = (DerivedAsset.hit_count.asc(), DerivedAsset.last_access_at.asc())
+        else:
+            order = (DerivedAsset.last_access_at.asc(),)
+        table = DerivedAsset.__table__
+        evicted = evicted_bytes = 0
+        with db.engine.begin() as conn:
+            candidates = conn.execute(
+                db.select(DerivedAsset.key, DerivedAsset.size_bytes).order_by(*order).limit(1000)
+            ).all()
+            victims = []
+            for key, size in candidates:
+                if total <= target:
+                    break
+                victims.append(key)
+                total -= size
+                evicted_bytes += size
+            if victims:
+                conn.execute(table.delete().where(table.c.key.in_(victims)))
+        self._set_total(total)
+        for key in victims:
+            try:
+                os.remove(os.path.join(self.root, *key.split('/')))
+            except FileNotFoundError:
+                pass
+            evicted += 1
+        with self._lock:
+            self.stats['evicted'] += evicted
+            self.stats['evicted_bytes'] += evicted_bytes
+        return evicted
+
+    def invalidate(self, source_hash):
+        """Remove do índice (na transação atual, sem commit) e do disco todos os
+        artefatos derivados do conteúdo."""
+        rows = db.session.query(DerivedAsset.key, DerivedAsset.size_bytes).filter_by(source_hash=source_hash).all()
+        keys = [key for key, _ in rows]
+        if keys:
+            DerivedAsset.query.filter(DerivedAsset.key.in_(keys)).delete(synchronize_session=False)
+            self._adjust_total(-sum(size for _, size in rows))
+        for key in keys:
+            try:
+                os.remove(os.path.join(self.root, *key.split('/')))
+            except FileNotFoundError:
+                pass
+        return len(keys)
+
+    def prune_untracked(self):
+        """Apaga arquivos no diretório do cache que não estão no índice (sobras
+        de falhas) e o diretório legado .thumbnails. Retorna bytes liberados."""
+        tracked = {row[0] for row in db.session.query(DerivedAsset.key)}
+        freed = 0
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            if dirpath == self.root and '.locks' in dirnames:
+                dirnames.remove('.locks')  # locks de geração ficam sempre
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                key = os.path.relpath(path, self.root).replace(os.sep, '/')
+                if key not in tracked:
+                    freed += os.path.getsize(path)
+                    os.remove(path)
+        legacy = os.path.join(UPLOAD_FOLDER, '.thumbnails')
+        if os.path.isdir(legacy):
+            for dirpath, _, filenames in os.walk(legacy):
+                freed += sum(os.path.getsize(os.path.join(dirpath, name)) for name in filenames)
+            shutil.rmtree(legacy, ignore_errors=True)
+        return freed
+
+    def report(self):
+        with self._lock:
+            stats = dict(self.stats)
+        lookups = stats['hits'] + stats['misses']
+        with db.engine.connect() as conn:
+            by_kind = conn.execute(db.select(
+                DerivedAsset.kind, db.func.count(DerivedAsset.key), db.func.coalesce(db.func.sum(DerivedAsset.size_bytes), 0)
+            ).group_by(DerivedAsset.kind)).all()
+        return {
+            'max_bytes': self.max_bytes,
+            'policy': self.policy,
+            'total_bytes': sum(int(row[2]) for row in by_kind),
+            'by_kind': {row[0]: {'count': row[1], 'bytes': int(row[2])} for row in by_kind},
+            'hit_ratio': round(stats['hits'] / lookups, 4) if lookups else None,
+            **stats
+        }
+
+derived_cache = DerivedCache(DERIVED_FOLDER, DERIVED_CACHE_MAX_BYTES, DERIVED_CACHE_POLICY)
+
+@atexit.register
+def _flush_derived_cache_touches():
+    if 'NO_DB_CONFIG' in globals() and NO_DB_CONFIG:
+        return
+    with app.app_context():
+        derived_cache.flush_touches()
+
+def ensure_thumbnail(file_hash, source_path, mime_type, size, fmt='jpg'):
+    """Caminho do thumbnail (gerado uma única vez por blob/tamanho/formato no
+    cache derivado), ou None se o arquivo não for imagem ou não puder ser decodificado."""
+    if not mime_type or not mime_type.startswith('image/') or not Image or not file_hash:
+        return None
+    try:
+        return derived_cache.get_or_create(
+            'thumb', file_hash, f"{size}.{fmt}",
+            lambda dest: render_thumbnail(source_path, dest, size, fmt)
+        )
+    except Exception as e:
+        print(f"Erro ao criar thumbnail: {e}")
+        return None
+
+# === FILA DE JOBS EM BACKGROUND ===
+
+class PermanentJobError(Exception):
+    """Falha que não adianta repetir (o job vai direto para failed)."""
+
+JOB_HANDLERS = {}
+
+def job_handler(kind):
+    """Registra a função que processa jobs do tipo `kind`: handler(payload, job)
+    retorna um dict (gravado em job.result) ou None."""
+    def register(func):
+        JOB_HANDLERS[kind] = func
+        return func
+    return register
+
+def enqueue_job(kind, payload=None, user_id=None, delay=0, max_attempts=None):
+    """Adiciona um job na transação atual (não faz commit): o job só fica visível
+    aos workers junto com a mudança que o originou."""
+    job = Job(
+        kind=kind,
+        payload=json.dumps(payload or {}),
+        user_id=user_id,
+        max_attempts=max_attempts or JOB_MAX_ATTEMPTS,
+        run_after=datetime.utcnow() + timedelta(seconds=delay)
+    )
+    db.session.add(job)
+    return job
+
+def job_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def job_backoff(attempts):
+    """Espera antes da próxima tentativa: exponencial com jitter, limitada."""
+    delay = min(JOB_BACKOFF_MAX, JOB_BACKOFF_BASE * 2 ** max(0, attempts - 1))
+    return delay * random.uniform(1.0, 1.25)
+
+# Tipos com limite de jobs simultâneos: kind -> (máximo global, máximo por usuário)
+JOB_CONCURRENCY_LIMITS = {}
+
+def _job_ready_filter(now):
+    return db.or_(
+        db.and_(Job.status == 'queued', Job.run_after <= now),
+        db.and_(Job.status == 'running', Job.locked_at < now - timedelta(seconds=JOB_LEASE_SECONDS))
+    )
+
+def _lock_job_kind(kind, now):
+    """Serializa a reserva de jobs de um tipo limitado entre todos os workers:
+    o UPDATE na linha de job_kind_lock é o primeiro comando da transação e
+    segura a linha (MySQL/PostgreSQL) ou o banco (SQLite) até o commit."""
+    db.session.commit()
+    if JobKindLock.query.filter_by(kind=kind).update({'claimed_at': now}, synchronize_session=False):
+        return
+    try:
+        db.session.add(JobKindLock(kind=kind, claimed_at=now))
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+    JobKindLock.query.filter_by(kind=kind).update({'claimed_at': now}, synchronize_session=False)
+
+def _claim_limited_job(kind, worker_id, now):
+    """Reserva no máximo um job de um tipo com limite de concorrência: o
+    primeiro job pronto do usuário com menos jobs em execução, respeitando os
+    limites global e por usuário. Contagem e reserva acontecem na mesma
+    transação, sob o lock do tipo, então os limites valem entre workers."""
+    max_total, max_per_user = JOB_CONCURRENCY_LIMITS[kind]
+    _lock_job_kind(kind, now)
+    try:
+        running = dict(db.session.query(Job.user_id, db.func.count(Job.id)).filter(
+            Job.kind == kind, Job.status == 'running',
+            Job.locked_at >= now - timedelta(seconds=JOB_LEASE_SECONDS)
+        ).group_by(Job.user_id).all())
+        if sum(running.values()) >= max_total:
+            return None
+        heads = db.session.query(Job.user_id, db.func.min(Job.id)).filter(
+            Job.kind == kind, _job_ready_filter(now)
+        ).group_by(Job.user_id).all()
+        heads.sort(key=lambda head: (running.get(head[0], 0), head[1]))
+        for user_id, job_id in heads:
+            if running.get(user_id, 0) >= max_per_user:
+                continue
+            if _mark_job_running(db.session.get(Job, job_id), worker_id, now):
+                return job_id
+        return None
+    finally:
+        db.session.commit()
+
+def _mark_job_running(job, worker_id, now):
+    # UPDATE condicional (attempts como versão): só um worker vence a disputa
+    return Job.query.filter(
+        Job.id == job.id, Job.status == job.status, Job.attempts == job.attempts
+    ).update({
+        'status': 'running',
+        'attempts': Job.attempts + 1,
+        'locked_by': worker_id,
+        'locked_at': now,
+        'started_at': now
+    }, synchronize_session=False)
+
+def claim_jobs(worker_id, kinds=None, limit=1):
+    """Reserva até `limit` jobs prontos (ou com lease vencido) para este worker.
+
+    No MySQL/PostgreSQL o SELECT ... FOR UPDATE SKIP LOCKED faz workers
+    concorrentes pegarem linhas diferentes sem esperar uns pelos outros; o
+    UPDATE condicional (attempts como versão) garante o mesmo no SQLite.
+    Tipos em JOB_CONCURRENCY_LIMITS são reservados um por vez, com fila justa
+    por usuário: um job desses volta sozinho, porque conta como em execução
+    desde a reserva e não deve esperar atrás de um lote."""
+    now = datetime.utcnow()
+    limited = [kind for kind in JOB_CONCURRENCY_LIMITS if not kinds or kind in kinds]
+    for kind in limited:
+        job_id = _claim_limited_job(kind, worker_id, now)
+        if job_id:
+            return [db.session.get(Job, job_id)]
+    query = Job.query.filter(_job_ready_filter(now))
+    if kinds:
+        query = query.filter(Job.kind.in_(kinds))
+    if limited:
+        query = query.filter(Job.kind.notin_(limited))
+    candidates = query.order_by(Job.run_after, Job.id).limit(limit).with_for_update(skip_locked=True).all()
+    claimed = [job.id for job in candidates if _mark_job_running(job, worker_id, now)]
+    db.session.commit()
+    if not claimed:
+        return []
+    return Job.query.filter(Job.id.in_(claimed)).order_by(Job.run_after, Job.id).all()
+
+def run_job(job, worker_id):
+    """Executa um job já reservado e grava o resultado: done, nova tentativa com
+    backoff ou failed. Retorna o status final."""
+    job_id, kind, attempts, max_attempts = job.id, job.kind, job.attempts, job.max_attempts
+    handler = JOB_HANDLERS.get(kind)
+    changes = {'locked_by': None, 'locked_at': None, 'finished_at': datetime.utcnow()}
+    try:
+        if not handler:
+            raise PermanentJobError(f'Tipo de job desconhecido: {kind}')
+        if attempts > max_attempts:
+            # Retomado após lease vencido, sem tentativas restantes
+            raise PermanentJobError('Worker interrompido durante a execução')
+        result = handler(json.loads(job.payload or '{}'), job)
+        db.session.commit()
+        changes.update(status='done', result=json.dumps(result) if result is not None else None, last_error=None)
+    except Exception as e:
+        db.session.rollback()
+        error = f'{type(e).__name__}: {e}'[:2000]
+        if isinstance(e, PermanentJobError) or attempts >= max_attempts:
+            changes.update(status='failed', last_error=error)
+        else:
+            changes.update(status='queued', last_error=error,
+                           run_after=datetime.utcnow() + timedelta(seconds=job_backoff(attempts)))
+    changes['finished_at'] = datetime.utcnow()
+    # Só grava se o lease ainda é deste worker (pode ter sido retomado por outro)
+    Job.query.filter_by(id=job_id, locked_by=worker_id, status='running').update(changes, synchronize_session=False)
+    db.session.commit()
+    return changes['status']
+
+def work_once(worker_id, kinds=None, batch=5):
+    """Reserva e executa um lote de jobs. Retorna quantos foram processados."""
+    jobs = claim_jobs(worker_id, kinds, batch)
+    for job in jobs:
+        run_job(job, worker_id)
+    return len(jobs)
+
+def purge_finished_jobs(days=None):
+    """Apaga jobs concluídos (done) mais antigos que a retenção; failed ficam para análise."""
+    cutoff = datetime.utcnow() - timedelta(days=days or JOB_RETENTION_DAYS)
+    removed = Job.query.filter(Job.status == 'done', Job.finished_at < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+    return removed
+
+def job_queue_stats(window_minutes=60):
+    """Profundidade da fila por tipo/status, idade do job pronto mais antigo e
+    latências (espera na fila e execução) dos jobs concluídos na janela."""
+    now = datetime.utcnow()
+    depth = {}
+    for kind, status, count in db.session.query(Job.kind, Job.status, db.func.count(Job.id)).group_by(Job.kind, Job.status):
+        depth.setdefault(kind, {})[status] = count
+    oldest_ready = db.session.query(db.func.min(Job.run_after)).filter(
+        Job.status == 'queued', Job.run_after <= now
+    ).scalar()
+    recent = db.session.query(Job.created_at, Job.started_at, Job.finished_at).filter(
+        Job.status == 'done', Job.finished_at >= now - timedelta(minutes=window_minutes)
+    ).order_by(Job.finished_at.desc()).limit(1000).all()
+
+    def percentiles(values):
+        if not values:
+            return None
+        values = sorted(values)
+        pick = lambda q: round(values[min(len(values) - 1, int(q * len(values)))], 3)  # noqa: E731
+        return {'p50': pick(0.5), 'p95': pick(0.95), 'max': round(values[-1], 3)}
+    return {
+        'depth': depth,
+        'ready': sum(kinds.get('queued', 0) for kinds in depth.values()),
+        'oldest_ready_age_seconds': round((now - oldest_ready).total_seconds(), 1) if oldest_ready else 0,
+        'window_minutes': window_minutes,
+        'completed': len(recent),
+        'wait_seconds': percentiles([(row.started_at - row.created_at).total_seconds() for row in recent if row.started_at]),
+        'run_seconds': percentiles([(row.finished_at - row.started_at).total_seconds() for row in recent if row.started_at])
+    }
+
+def extract_media_info(path, mime_type):
+    """Dimensões e EXIF básico (data, câmera, orientação) de imagens."""
+    if not mime_type or not mime_type.startswith('image/') or not Image:
+        return None
+    exif_tags = {0x0110: 'camera_model', 0x010F: 'camera_make', 0x0112: 'orientation', 0x0132: 'modified_at'}
+    with Image.open(path) as img:
+        info = {'width': img.width, 'height': img.height, 'format': img.format}
+        exif = img.getexif()
+        for tag, name in exif_tags.items():
+            if tag in exif:
+                info[name] = str(exif[tag]).strip('\x00 ')
+        taken_at = exif.get_ifd(0x8769).get(0x9003)  # DateTimeOriginal
+        if taken_at:
+            info['taken_at'] = str(taken_at).strip('\x00 ')
+    return info
+
+@job_handler('enrich_file')
+def enrich_file_job(payload, job):
+    """Pós-upload: confere o hash do conteúdo, gera os thumbnails e extrai EXIF."""
+    file = db.session.get(File, payload.get('file_id'))
+    if not file or not os.path.exists(file.file_path):
+        return {'skipped': 'arquivo removido'}
+    if file.file_hash and calculate_file_hash(file.file_path) != file.file_hash:
+        raise PermanentJobError(f'Hash divergente no conteúdo do arquivo {file.id}')
+    thumbnails = [size for size in THUMBNAIL_SIZES
+                  if ensure_thumbnail(file.file_hash, file.file_path, file.mime_type, size, 'jpg')]
+    media_info = extract_media_info(file.file_path, file.mime_type)
+    if media_info:
+        file.media_info = json.dumps(media_info)
+    return {'thumbnails': thumbnails, 'media_info': bool(media_info)}
+
+# === EXECUÇÃO DE SCRIPTS (JOBS) ===
+
+EXECUTION_INTERPRETERS = {
+    '.py': 'python3',
+    '.sh': 'bash',
+    '.js': 'node',
+    '.php': 'php',
+    '.rb': 'ruby',
+    '.pl': 'perl',
+}
+JOB_CONCURRENCY_LIMITS['execute'] = (EXECUTION_MAX_CONCURRENT, EXECUTION_MAX_PER_USER)
+
+def execution_command(file):
+    """Comando para executar o arquivo (pela extensão do nome), ou None."""
+    _, ext = os.path.splitext(file.filename.lower())
+    interpreter = EXECUTION_INTERPRETERS.get(ext)
+    return [interpreter, file.file_path] if interpreter else None
+
+def execution_log_dir(execution_id):
+    return os.path.join(EXECUTION_LOG_FOLDER, str(execution_id))
+
+def execution_segment_path(log_dir, index):
+    return os.path.join(log_dir, f'{index:05d}.ndjson.gz')
+
+class OutputSpool:
+    """Grava a saída de uma execução como registros NDJSON ({"s": "out"|"err",
+    "d": texto}) em segmentos gzip de até EXECUTION_SEGMENT_BYTES (descomprimidos).
+
+    Cada escrita termina com Z_SYNC_FLUSH, então leitores conseguem descomprimir
+    o segmento em andamento enquanto o processo roda. Ao fechar, grava
+    `done.json` com os totais. Guarda em memória só o final de cada stream."""
+
+    def __init__(self, log_dir):
+        self.log_dir = log_dir
+        shutil.rmtree(log_dir, ignore_errors=True)
+        os.makedirs(log_dir)
+        self.segments = 0
+        self.total_bytes = 0
+        self.truncated = False
+        self._segment = None
+        self._segment_bytes = 0
+        self._decoders = {name: codecs.getincrementaldecoder('utf-8')(errors='replace') for name in ('out', 'err')}
+        self._tails = {name: bytearray() for name in ('out', 'err')}
+
+    def _open_segment(self):
+        self._segment = open(execution_segment_path(self.log_dir, self.segments), 'wb')
+        self._compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # formato gzip
+        self._segment_bytes = 0
+        self.segments += 1
+
+    def _close_segment(self):
+        if self._segment:
+            self._segment.write(self._compressor.flush(zlib.Z_FINISH))
+            self._segment.close()
+            self._segment = None
+
+    def write(self, stream, data, final=False):
+        """Registra bytes de um stream. Retorna False quando o limite de saída
+        foi atingido (o excedente é descartado)."""
+        if self.truncated:
+            return False
+        room = EXECUTION_OUTPUT_LIMIT - self.total_bytes
+        if len(data) > room:
+            data = data[:room]
+            self.truncated = True
+        self.total_bytes += len(data)
+        tail = self._tails[stream]
+        tail += data
+        del tail[:-EXECUTION_TAIL_BYTES]
+        text = self._decoders[stream].decode(data, final=final)
+        if text:
+            if self._segment is None or self._segment_bytes >= EXECUTION_SEGMENT_BYTES:
+                self._close_segment()
+                self._open_segment()
+            record = (json.dumps({'s': stream, 'd': text}) + '\n').encode('utf-8')
+            self._segment.write(self._compressor.compress(record))
+            self._segment.write(self._compressor.flush(zlib.Z_SYNC_FLUSH))
+            self._segment.flush()
+            self._segment_bytes += len(record)
+        return not self.truncated
+
+    def tail(self, stream):
+        text = bytes(self._tails[stream]).decode('utf-8', errors='replace')
+        if self.total_bytes > EXECUTION_TAIL_BYTES and text:
+            text = '[...]\n' + text
+        return text
+
+    def close(self, summary):
+        if not self.truncated:
+            for stream in ('out', 'err'):
+                self.write(stream, b'', final=True)
+        self._close_segment()
+        summary = dict(summary, segments=self.segments, bytes=self.total_bytes, truncated=self.truncated)
+        with open(os.path.join(self.log_dir, 'done.json'), 'w') as f:
+            json.dump(summary, f)
+
+def read_execution_records(log_dir, start_segment=0, skip=0, follow=True, poll=0.2, max_wait=None, idle_ticks=False):
+    """Lê os registros do spool como (segmento, índice, registro). Com follow=True
+    acompanha o segmento em andamento (um segmento está completo quando o stream
+    gzip termina) até existir done.json, ou até max_wait segundos sem novidade.
+    Com idle_ticks=True produz None a cada espera (para keep-alive de quem consome)."""
+    index = start_segment
+    done_path = os.path.join(log_dir, 'done.json')
+    idle_since = time.monotonic()
+    while True:
+        path = execution_segment_path(log_dir, index)
+        if not os.path.exists(path):
+            # done.json só é gravado depois de fechar o último segmento
+            if not follow or os.path.exists(done_path):
+                return
+            if max_wait is not None and time.monotonic() - idle_since > max_wait:
+                return
+            if idle_ticks:
+                yield None
+            time.sleep(poll)
+            continue
+        decompressor = zlib.decompressobj(31)
+        pending = b''
+        line_no = 0
+        with open(path, 'rb') as f:
+            while not decompressor.eof:
+                chunk = f.read(EXECUTION_READ_SIZE)
+                if chunk:
+                    pending += decompressor.decompress(chunk)
+                    *lines, pending = pending.split(b'\n')
+                    for line in lines:
+                        if line_no >= skip:
+                            yield index, line_no, json.loads(line)
+                        line_no += 1
+                    idle_since = time.monotonic()
+                    continue
+                if not follow or (max_wait is not None and time.monotonic() - idle_since > max_wait):
+                    return
+                if idle_ticks:
+                    yield None
+                time.sleep(poll)
+        index += 1
+        skip = 0  # só o segmento inicial é retomado do meio
+
+def apply_execution_rlimits():
+    """Limites de recursos do processo atual (chamado no filho, antes do exec)."""
+    resource.setrlimit(resource.RLIMIT_CPU, (EXECUTION_CPU_LIMIT, EXECUTION_CPU_LIMIT + 1))
+    resource.setrlimit(resource.RLIMIT_DATA, (EXECUTION_MEMORY_LIMIT, EXECUTION_MEMORY_LIMIT))
+    resource.setrlimit(resource.RLIMIT_FSIZE, (EXECUTION_FILE_SIZE_LIMIT, EXECUTION_FILE_SIZE_LIMIT))
+    resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+
+class ExecutionCgroup:
+    """cgroup v2 de uma execução, criado sob EXECUTION_CGROUP_ROOT. Limita memória
+    (sem swap), número de processos e CPU (um núcleo); ao destruir, mata o que
+    restou dentro dele (inclusive processos que saíram do grupo de sessão)."""
+
+    def __init__(self, name):
+        self.path = os.path.join(EXECUTION_CGROUP_ROOT, name)
+        os.makedirs(self.path, exist_ok=True)
+        self._write('memory.max', EXECUTION_MEMORY_LIMIT)
+        self._write('pids.max', EXECUTION_MAX_PROCESSES)
+        self._write('cpu.max', '100000 100000')
+        if os.path.exists(os.path.join(self.path, 'memory.swap.max')):
+            self._write('memory.swap.max', 0)
+
+    def _write(self, name, value):
+        with open(os.path.join(self.path, name), 'w') as f:
+            f.write(str(value))
+
+    def add(self, pid):
+        """Move o processo para o cgroup (pid 0 = o próprio processo que escreve)."""
+        self._write('cgroup.procs', pid)
+
+    def oom_killed(self):
+        try:
+            with open(os.path.join(self.path, 'memory.events')) as f:
+                events = dict(line.split() for line in f if line.strip())
+        except OSError:
+            return False
+        return int(events.get('oom_kill', 0)) > 0
+
+    def destroy(self):
+        if os.path.exists(os.path.join(self.path, 'cgroup.kill')):
+            self._write('cgroup.kill', 1)
+        for _ in range(50):
+            try:
+                os.rmdir(self.path)
+                return
+            except FileNotFoundError:
+                return
+            except OSError:
+                time.sleep(0.02)  # processos mortos ainda saindo do cgroup
+
+# Cada bootstrap fica bloqueado lendo {"script", "source", "cwd"} do stdin; quando
+# recebe, entra no diretório e roda como programa principal o conteúdo lido de
+# `source` (o blob), com o caminho lógico `script` (na pasta do usuário) como
+# __file__/argv[0] e sua pasta no caminho de imports. stdin vazio (o processo pai
+# morreu ou o pool foi fechado) encerra sem fazer nada
+EXECUTION_WARM_BOOTSTRAPS = {
+    'python3': ['python3', '-c', """import json, os, sys, types
+data = sys.stdin.buffer.read()
+if not data:
+    sys.exit(0)
+request = json.loads(data)
+os.chdir(request["cwd"])
+sys.argv = [request["script"]]
+sys.path[0] = os.path.dirname(request["script"])
+with open(request["source"], "rb") as source:
+    code = compile(source.read(), request["script"], "exec")
+main = types.ModuleType("__main__")
+main.__file__ = request["script"]
+main.__builtins__ = __builtins__
+sys.modules["__main__"] = main
+del data, request, source
+exec(code, main.__dict__)"""],
+    'node': ['node', '-e', """const fs = require("fs"), path = require("path"), Module = require("module");
+const data = fs.readFileSync(0, "utf8");
+if (!data) process.exit(0);
+const request = JSON.parse(data);
+process.chdir(request.cwd);
+process.argv[1] = request.script;
+const main = new Module(".", null);
+main.filename = request.script;
+main.paths = Module._nodeModulePaths(path.dirname(request.script));
+process.mainModule = main;
+main._compile(fs.readFileSync(request.source, "utf8"), request.script);
+main.loaded = true;"""],
+    'ruby': ['ruby', '-e', """data = STDIN.read
+exit 0 if data.empty?
+require "json"
+request = JSON.parse(data)
+Dir.chdir(request["cwd"])
+$0 = request["script"]
+eval(File.read(request["source"]), TOPLEVEL_BINDING, request["script"], 1)"""],
+}
+
+class InterpreterPool:
+    """Interpretadores já iniciados (com os rlimits aplicados), por linguagem.
+
+    acquire() entrega um processo pronto; replenish(), chamado depois que a
+    execução termina, inicia o substituto, que sobe enquanto o worker busca o
+    próximo job. Assim nem a partida do interpretador nem o fork ficam na
+    latência da execução. Cada processo roda um único script. Sem processo
+    pronto (ou para linguagens sem bootstrap) quem chama cai no caminho normal."""
+
+    def __init__(self, bootstraps, size, max_idle=EXECUTION_WARM_MAX_IDLE):
+        self.bootstraps = dict(bootstraps)
+        self.size = size
+        self.max_idle = max_idle
+        self.pid = os.getpid()
+        self._idle = {name: deque() for name in self.bootstraps}
+        self._lock = threading.Lock()
+        self.stats = {'warm': 0, 'cold': 0}
+
+    def start(self):
+        """Preenche o pool de todas as linguagens (ex.: ao iniciar um worker)."""
+        for name in list(self.bootstraps):
+            self.replenish(name)
+
+    def replenish(self, name):
+        if self.size <= 0 or name not in self.bootstraps:
+            return
+        with self._lock:
+            missing = self.size - len(self._idle.get(name, ()))
+        for _ in range(max(missing, 0)):
+            try:
+                proc = subprocess.Popen(self.bootstraps[name], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE, start_new_session=True,
+                                        preexec_fn=apply_execution_rlimits)
+            except OSError:
+                # Interpretador não instalado: a linguagem segue só pelo caminho normal
+                with self._lock:
+                    self.bootstraps.pop(name, None)
+                    self._idle.pop(name, None)
+                return
+            with self._lock:
+                self._idle[name].append((time.monotonic(), proc))
+
+    @staticmethod
+    def _discard(proc):
+        for pipe in (proc.stdin, proc.stdout, proc.stderr):
+            try:
+                pipe.close()
+            except OSError:
+                pass  # stdin com dados pendentes e o processo já morto
+        if proc.poll() is None:
+            os.killpg(proc.pid, signal.SIGKILL)
+            proc.wait()
+
+    def acquire(self, interpreter):
+        """Processo pronto para o interpretador, ou None."""
+        if self.size <= 0 or interpreter not in self.bootstraps:
+            return None
+        proc = None
+        with self._lock:
+            idle = self._idle[interpreter]
+            while idle and proc is None:
+                born, candidate = idle.popleft()
+                if candidate.poll() is None and time.monotonic() - born < self.max_idle:
+                    proc = candidate
+                else:
+                    self._discard(candidate)
+        self.stats['warm' if proc else 'cold'] += 1
+        return proc
+
+    @staticmethod
+    def dispatch(proc, command, cwd, script=None):
+        """Entrega o script ao processo pronto; o stdin fechado funciona como /dev/null."""
+        request = {'script': script or command[1], 'source': command[1], 'cwd': cwd}
+        proc.stdin.write(json.dumps(request).encode('utf-8'))
+        proc.stdin.close()
+
+    def close(self):
+        with self._lock:
+            idle = [proc for queue in self._idle.values() for _, proc in queue]
+            for queue in self._idle.values():
+                queue.clear()
+        for proc in idle:
+            self._discard(proc)
+
+_execution_pool = None
+
+def execution_pool():
+    """Pool de interpretadores do processo atual (processos filhos criam o seu)."""
+    global _execution_pool
+    if _execution_pool is None or _execution_pool.pid != os.getpid():
+        _execution_pool = InterpreterPool(EXECUTION_WARM_BOOTSTRAPS, EXECUTION_WARM_POOL_SIZE)
+        atexit.register(_execution_pool.close)
+    return _execution_pool
+
+def run_script(command, cwd, timeout, spool, pool=None, cgroup_name=None, script=None):
+    """Executa o comando lendo stdout/stderr aos poucos (selectors) direto para
+    o spool, sem acumular a saída em memória. Usa um interpretador pronto do
+    pool quando houver. Mede tempo, CPU e pico de memória (rusage via wait4).
+    O grupo de processos inteiro é morto ao estourar o timeout ou o limite de
+    saída; CPU, memória e arquivos são limitados por rlimit (e cgroup).
+
+    `command` é [interpretador, arquivo com o conteúdo]; `script` é o caminho
+    lógico (na pasta do usuário) que o programa enxerga como seu. Linguagens
+    com bootstrap sempre rodam por ele, pronto no pool ou iniciado na hora."""
+    started = time.perf_counter()
+    cgroup = ExecutionCgroup(cgroup_name) if EXECUTION_CGROUP_ROOT and cgroup_name else None
+    try:
+        proc = pool.acquire(command[0]) if pool else None
+        if proc:
+            if cgroup:
+                cgroup.add(proc.pid)
+            try:
+                InterpreterPool.dispatch(proc, command, cwd, script)
+            except BrokenPipeError:
+                InterpreterPool._discard(proc)
+                proc = None
+        warm = proc is not None
+        if not proc:
+            bootstrap = EXECUTION_WARM_BOOTSTRAPS.get(command[0])
+
+            def setup():
+                apply_execution_rlimits()
+                if cgroup:
+                    cgroup.add(0)
+            proc = subprocess.Popen(bootstrap or command, cwd=cwd,
+                                    stdin=subprocess.PIPE if bootstrap else subprocess.DEVNULL,
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                    start_new_session=True, preexec_fn=setup)
+            if bootstrap:
+                try:
+                    InterpreterPool.dispatch(proc, command, cwd, script)
+                except BrokenPipeError:
+                    pass  # o processo já saiu: o código de saída vai no resultado
+        result = _collect_script_output(proc, timeout, spool)
+        result['memory_limit'] = bool(cgroup and cgroup.oom_killed())
+    finally:
+        if cgroup:
+            cgroup.destroy()
+    result['warm'] = warm
+    result['run_ms'] = int((time.perf_counter() - started) * 1000)
+    if pool:
+        pool.replenish(command[0])
+    return result
+
+def _collect_script_output(proc, timeout, spool):
+    deadline = time.monotonic() + timeout
+    selector = selectors.DefaultSelector()
+    selector.register(proc.stdout, selectors.EVENT_READ, 'out')
+    selector.register(proc.stderr, selectors.EVENT_READ, 'err')
+    reason = None
+    exited = None
+
+    def kill():
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    while selector.get_map():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            reason = 'timeout'
+            kill()
+            break
+        for key, _ in selector.select(timeout=min(remaining, 0.5)):
+            data = os.read(key.fileobj.fileno(), EXECUTION_READ_SIZE)
+            if not data:
+                selector.unregister(key.fileobj)
+            elif not spool.write(key.data, data):
+                reason = 'output_limit'
+                kill()
+                break
+        if reason:
+            break
+        if exited is None:
+            pid, status, usage = os.wait4(proc.pid, os.WNOHANG)
+            if pid:
+                exited = (status, usage)
+                # Processo saiu: só esperar o que falta nos pipes (filhos em background
+                # que herdaram os pipes não seguram a execução)
+                deadline = min(deadline, time.monotonic() + 1)
+    selector.close()
+    proc.stdout.close()
+    proc.stderr.close()
+    if exited is None:
+        if reason is None:
+            kill()
+        _, status, usage = os.wait4(proc.pid, 0)
+    else:
+        status, usage = exited
+        if reason == 'timeout':
+            reason = None  # só os pipes de processos filhos ficaram abertos
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    cpu_seconds = usage.ru_utime + usage.ru_stime
+    # RLIMIT_CPU: SIGXCPU no limite flexível, SIGKILL no rígido (se o script ignorar o primeiro)
+    killed_by = os.WTERMSIG(status) if os.WIFSIGNALED(status) else None
+    cpu_limit = reason is None and (killed_by == signal.SIGXCPU or
+                                    (killed_by == signal.SIGKILL and cpu_seconds >= EXECUTION_CPU_LIMIT))
+    return {
+        'exit_code': proc.returncode,
+        'timed_out': reason == 'timeout',
+        'output_limit': reason == 'output_limit',
+        'cpu_limit': cpu_limit,
+        'cpu_ms': int(cpu_seconds * 1000),
+        'peak_memory_kb': usage.ru_maxrss  # KB no Linux
+    }
+
+def delete_execution_logs(condition):
+    """Apaga os registros de execução (na transação atual) e o spool em disco."""
+    ids = [row[0] for row in db.session.query(ExecutionLog.id).filter(condition)]
+    if ids:
+        ExecutionLog.query.filter(ExecutionLog.id.in_(ids)).delete(synchronize_session=False)
+    for execution_id in ids:
+        shutil.rmtree(execution_log_dir(execution_id), ignore_errors=True)
+    return len(ids)
+
+@job_handler('execute')
+def execute_job(payload, job):
+    """Roda o script de um ExecutionLog enfileirado por /api/execute."""
+    log = db.session.get(ExecutionLog, payload.get('execution_id'))
+    if not log:
+        return {'skipped': 'execução removida'}
+    file = db.session.get(File, log.file_id)
+    started = datetime.utcnow()
+    log.started_at = started
+    log.queue_wait_ms = int((started - log.executed_at).total_seconds() * 1000)
+    command = execution_command(file) if file and os.path.exists(file.file_path) else None
+    if not command:
+        log.status = 'failed'
+        log.error_output = 'Arquivo não existe no sistema'
+        log.finished_at = datetime.utcnow()
+        return {'status': log.status}
+    log.status = 'running'
+    log.log_path = os.path.relpath(execution_log_dir(log.id), UPLOAD_FOLDER)
+    db.session.commit()
+
+    spool = OutputSpool(execution_log_dir(log.id))
+    try:
+        cwd = file_working_dir(file)
+        result = run_script(command, cwd, EXECUTION_TIMEOUT, spool, pool=execution_pool(),
+                            cgroup_name=f'execution-{log.id}', script=os.path.join(cwd, file.filename))
+    except Exception as e:
+        result = None
+        log.status = 'failed'
+        log.error_output = f'Erro durante execução: {e}'
+    if result:
+        log.exit_code = result['exit_code']
+        log.run_ms = result['run_ms']
+        log.peak_memory_kb = result['peak_memory_kb']
+        log.output = spool.tail('out')
+        log.error_output = spool.tail('err')
+        notice = None
+        if result['timed_out']:
+            log.status = 'timeout'
+            notice = f'Execução excedeu tempo limite de {EXECUTION_TIMEOUT} segundos'
+        elif result['output_limit']:
+            log.status = 'output_limit'
+            notice = f'Saída excedeu o limite de {EXECUTION_OUTPUT_LIMIT} bytes; processo encerrado'
+        elif result['cpu_limit']:
+            log.status = 'cpu_limit'
+            notice = f'Execução excedeu o limite de {EXECUTION_CPU_LIMIT} segundos de CPU'
+        elif result['memory_limit']:
+            log.status = 'memory_limit'
+            notice = f'Execução excedeu o limite de {EXECUTION_MEMORY_LIMIT // (1024 * 1024)} MB de memória'
+        else:
+            log.status = 'done'
+        if notice:
+            log.error_output = (log.error_output + '\n' if log.error_output else '') + notice
+    log.log_bytes = spool.total_bytes
+    log.log_segments = spool.segments
+    log.output_truncated = spool.truncated
+    log.finished_at = datetime.utcnow()
+    # Estado final no banco antes do done.json: quem acompanha o spool já encontra o resultado
+    db.session.commit()
+    spool.close({'status': log.status, 'exit_code': log.exit_code})
+    summary = {'status': log.status, 'exit_code': log.exit_code}
+    if result:
+        summary.update(warm=result['warm'], cpu_ms=result['cpu_ms'])
+    return summary
+
+def serialize_execution(log):
+    data = {
+        'execution_id': log.id,
+        'job_id': log.job_id,
+        'status': log.status,
+        'command': log.command,
+        'output': log.output,
+        'error': log.error_output,
+        'exit_code': log.exit_code,
+        'queue_wait_ms': log.queue_wait_ms,
+        'run_ms': log.run_ms,
+        'peak_memory_kb': log.peak_memory_kb,
+        'submitted_at': log.executed_at.isoformat() if log.executed_at else None,
+        'started_at': log.started_at.isoformat() if log.started_at else None,
+        'finished_at': log.finished_at.isoformat() if log.finished_at else None,
+        'log_bytes': log.log_bytes,
+        'log_segments': log.log_segments,
+        'output_truncated': bool(log.output_truncated),
+        'stream_url': f'/api/executions/{log.id}/stream',
+        'log_url': f'/api/executions/{log.id}/log'
+    }
+    if log.status == 'queued' and log.job_id:
+        data['queue_position'] = Job.query.filter(
+            Job.kind == 'execute', Job.status == 'queued', Job.id < log.job_id
+        ).count() + 1
+    return data
+
+# Rotas da API
+
+@app.route('/')
+def index():
+    return render_template('index_modern.html')
+
+@app.route('/api/test', methods=['GET'])
+def test_api():
+    return jsonify({'message': 'API funcionando!', 'status': 'ok'}), 200
+
+@app.route('/api/register', methods=['POST'])
+def register():
+    if 'NO_DB_CONFIG' in globals() and NO_DB_CONFIG:
+        return jsonify({'error': 'Sistema em modo de configuração. Configure o MySQL primeiro.'}), 503
+    data = request.get_json()
+    username = data.get('username')
+    email = data.get('email')
+    password = data.get('password')
+    
+    if not username or not email or not password:
+        return jsonify({'error': 'Todos os campos são obrigatórios'}), 400
+    
     if User.query.filter_by(username=username).first():
         return jsonify({'error': 'Nome de usuário já existe'}), 400
     
@@ -1034,6 +3573,7 @@ def refresh_token():
 def upload_file():
     if 'NO_DB_CONFIG' in globals() and NO_DB_CONFIG:
         return jsonify({'error': 'Sistema em modo de configuração'}), 503
+    reserved = 0
     try:
         user_id = int(get_jwt_identity())
         user = User.query.get(user_id)
@@ -1041,6 +3581,15 @@ def upload_file():
         if not user:
             return jsonify({'error': 'Usuário não encontrado'}), 404
         
+        # Reservar cedo pelo Content-Length, antes de consumir o corpo da requisição.
+        # A reserva é atômica no banco: uploads concorrentes em outros workers não
+        # passam juntos pela verificação de quota.
+        if request.content_length:
+            early_reservation = max(0, request.content_length - UPLOAD_FORM_OVERHEAD)
+            if not reserve_storage(user_id, early_reservation):
+                return jsonify({'error': 'Quota de armazenamento excedida'}), 413
+            reserved = early_reservation
+        
         if 'file' not in request.files:
             return jsonify({'error': 'Nenhum arquivo enviado'}), 400
         
@@ -1052,55 +3601,28 @@ def upload_file():
         if file.filename == '':
             return jsonify({'error': 'Nome de arquivo inválido'}), 400
         
-        # Ler arquivo uma vez e armazenar em variável
-        file_content = file.read()
-        file_size = len(file_content)
-        
-        # Verificar quota de armazenamento
-        current_usage = get_user_storage_usage(user_id)
-        if current_usage + file_size > user.storage_quota:
-            return jsonify({'error': 'Quota de armazenamento excedida'}), 413
-    
         filename = secure_filename(file.filename)
         
-        # Determinar diretório baseado na pasta
-        if folder_id:
-            folder = Folder.query.filter_by(id=folder_id, user_id=user_id).first()
-            if not folder:
-                return jsonify({'error': 'Pasta não encontrada'}), 404
-            target_dir = os.path.join(app.config['UPLOAD_FOLDER'], folder.path)
-        else:
-            target_dir = os.path.join(app.config['UPLOAD_FOLDER'], user.username)
+        # Validar pasta de destino
+        if folder_id and not resolve_target_dir(user, folder_id):
+            return jsonify({'error': 'Pasta não encontrada'}), 404
         
-        os.makedirs(target_dir, exist_ok=True)
+        # O corpo já foi gravado em disco durante o parse do multipart, com hash,
+        # tamanho e cabeçalho calculados na mesma passagem (HashingUploadFile)
+        upload = file.stream
+        file_size = upload.size
         
-        # Gerar nome único se arquivo já existir
-        file_path = os.path.join(target_dir, filename)
-        counter = 1
-        base_name, extension = os.path.splitext(filename)
-        while os.path.exists(file_path):
-            filename = f"{base_name}_{counter}{extension}"
-            file_path = os.path.join(target_dir, filename)
-            counter += 1
+        # Completar a reserva com o tamanho real
+        if file_size > reserved:
+            if not reserve_storage(user_id, file_size - reserved):
+                return jsonify({'error': 'Quota de armazenamento excedida'}), 413
+            reserved = file_size
         
-        # Salvar arquivo usando o conteúdo lido
-        with open(file_path, 'wb') as f:
-            f.write(file_content)
-    
-        # Obter informações do arquivo
-        file_hash = calculate_file_hash(file_path)
-        # Detectar tipo MIME
-        if magic:
-            try:
-                mime_type = magic.from_file(file_path, mime=True)
-            except:
-                mime_type, _ = mimetypes.guess_type(file_path)
-                if not mime_type:
-                    mime_type = 'application/octet-stream'
-        else:
-            mime_type, _ = mimetypes.guess_type(file_path)
-            if not mime_type:
-                mime_type = 'application/octet-stream'
+        upload.finish()
+        file_hash = upload.hexdigest()
+        mime_type = detect_mime_type(upload.head, filename)
+        # Conteúdo idêntico já armazenado é reaproveitado (só ganha uma referência)
+        file_path = acquire_blob(file_hash, file_size, upload.path)
         
         # Salvar informações no banco de dados
         db_file = File(
@@ -1115,7 +3637,13 @@ def upload_file():
         )
         
         db.session.add(db_file)
+        # Converter a reserva em uso na mesma transação do registro
+        adjust_storage(user_id, used=file_size, reserved=-reserved)
+        adjust_folder_totals(folder_id, size=file_size, files=1)
+        db.session.flush()
+        enqueue_job('enrich_file', {'file_id': db_file.id}, user_id=user_id)
         db.session.commit()
+        reserved = 0
         
         # Log da atividade
         log_activity(user_id, 'upload', 'file', db_file.id, file.filename)
@@ -1128,10 +3656,539 @@ def upload_file():
     
     except Exception as e:
         return jsonify({'error': f'Erro no upload: {str(e)}'}), 500
+    finally:
+        if reserved:
+            db.session.rollback()
+            adjust_storage(user_id, reserved=-reserved)
+            db.session.commit()
+
+def possession_challenge(user_id, file_hash, size, window=None):
+    """Desafio de posse determinístico (sem estado no servidor) para um hash:
+    o trecho [offset, offset + length) do conteúdo e um nonce derivados de
+    HMAC(SECRET_KEY) sobre usuário, hash, tamanho e a janela de tempo atual."""
+    if window is None:
+        window = int(time.time() // INSTANT_UPLOAD_PROOF_TTL)
+    key = app.config['SECRET_KEY'].encode()
+    nonce = hmac.new(key, f'{user_id}:{file_hash}:{size}:{window}'.encode(), hashlib.sha256).hexdigest()
+    length = min(INSTANT_UPLOAD_PROOF_BYTES, size)
+    offset = int(nonce[:16], 16) % (size - length + 1)
+    return {'nonce': nonce, 'offset': offset, 'length': length}
+
+def possession_proof(nonce, data):
+    """Resposta esperada para um desafio: SHA-256(nonce || trecho do conteúdo)."""
+    return hashlib.sha256(bytes.fromhex(nonce) + data).hexdigest()
+
+def verify_possession(user_id, file_hash, size, proof):
+    """Confere a prova contra o blob para a janela atual ou a anterior."""
+    if not proof or not isinstance(proof, str):
+        return False
+    window = int(time.time() // INSTANT_UPLOAD_PROOF_TTL)
+    for candidate in (window, window - 1):
+        challenge = possession_challenge(user_id, file_hash, size, candidate)
+        try:
+            with open(blob_path(file_hash), 'rb') as f:
+                f.seek(challenge['offset'])
+                data = f.read(challenge['length'])
+        except OSError:
+            return False
+        if hmac.compare_digest(possession_proof(challenge['nonce'], data), proof.lower()):
+            return True
+    return False
+
+@app.route('/api/upload/precheck', methods=['POST'])
+@jwt_required()
+def precheck_upload():
+    """Upload instantâneo: o cliente envia SHA-256 e tamanho antes dos bytes.
+    Se o conteúdo já estiver no store, o arquivo é criado sem transferência.
+    Espera JSON { folder_id?, files: [{ sha256, size, filename, folder_id?, proof? }, ...] }
+    e responde com o status de cada item: created, missing, challenge,
+    quota_exceeded ou invalid. Itens 'missing' devem ser enviados normalmente
+    (/api/upload ou /api/uploads).
+
+    Só conteúdo que o usuário já possui é reaproveitado direto. Com
+    INSTANT_UPLOAD_SCOPE='global', os demais hashes voltam como 'challenge'
+    ({nonce, offset, length}) — existindo ou não no servidor, para não revelar
+    o que outros usuários guardam — e o cliente reenvia o item com
+    proof = sha256(nonce || bytes[offset:offset+length]).
+    """
+    if 'NO_DB_CONFIG' in globals() and NO_DB_CONFIG:
+        return jsonify({'error': 'Sistema em modo de configuração'}), 503
+    try:
+        user_id = int(get_jwt_identity())
+        user = User.query.get(user_id)
+        if not user:
+            return jsonify({'error': 'Usuário não encontrado'}), 404
+
+        data = request.get_json() or {}
+        items = data.get('files') or []
+        if not isinstance(items, list) or not items:
+            return jsonify({'error': 'Lista de arquivos é obrigatória'}), 400
+        if len(items) > INSTANT_UPLOAD_MAX_BATCH:
+            return jsonify({'error': f'Máximo de {INSTANT_UPLOAD_MAX_BATCH} arquivos por chamada'}), 400
+        try:
+            default_folder_id = int(data.get('folder_id') or 0) or None
+        except (TypeError, ValueError):
+            return jsonify({'error': 'folder_id inválido'}), 400
+
+        hashes = {str(item.get('sha256') or '').lower() for item in items if isinstance(item, dict)}
+        hashes.discard('')
+
+        # Uma consulta para os blobs conhecidos e uma para as pastas citadas
+        blobs = {b.file_hash: b for b in ContentBlob.query.filter(ContentBlob.file_hash.in_(hashes)).all()} if hashes else {}
+        owned = {h for (h,) in db.session.query(File.file_hash).filter(
+            File.user_id == user_id, File.file_hash.in_(list(blobs))
+        ).distinct()} if blobs else set()
+        mime_by_hash = dict(db.session.query(File.file_hash, File.mime_type).filter(
+            File.file_hash.in_(list(blobs))
+        ).distinct().all()) if blobs else {}
+        def item_folder(item):
+            try:
+                return int(item.get('folder_id') or 0) or default_folder_id
+            except (TypeError, ValueError):
+                return -1  # nunca é uma pasta válida
+        folder_ids = {item_folder(item) for item in items if isinstance(item, dict)}
+        folder_ids.discard(None)
+        valid_folders = {f.id for f in Folder.query.filter(Folder.id.in_(folder_ids), Folder.user_id == user_id)} if folder_ids else set()
+
+        results = []
+        created = []
+        for index, item in enumerate(items):
+            if not isinstance(item, dict):
+                results.append({'index': index, 'status': 'invalid', 'error': 'Item inválido'})
+                continue
+            file_hash = str(item.get('sha256') or '').lower()
+            filename = (item.get('filename') or '').strip()
+            folder_id = item_folder(item)
+            result = {'index': index, 'sha256': file_hash, 'filename': filename}
+            try:
+                size = int(item.get('size'))
+            except (TypeError, ValueError):
+                size = None
+
+            blob = blobs.get(file_hash)
+            if not filename or not secure_filename(filename) or size is None or size < 0 or not re.fullmatch(r'[0-9a-f]{64}', file_hash):
+                result.update(status='invalid', error='sha256, size e filename são obrigatórios')
+            elif folder_id and folder_id not in valid_folders:
+                result.update(status='invalid', error='Pasta não encontrada')
+            elif file_hash not in owned and INSTANT_UPLOAD_SCOPE == 'global' and not item.get('proof'):
+                result.update(status='challenge', challenge=possession_challenge(user_id, file_hash, size))
+            elif not blob or blob.file_size != size or not os.path.exists(blob_path(file_hash)):
+                result['status'] = 'missing'
+            elif file_hash not in owned and (INSTANT_UPLOAD_SCOPE != 'global'
+                                             or not verify_possession(user_id, file_hash, size, item.get('proof'))):
+                result['status'] = 'missing'
+            elif not consume_storage(user_id, size):
+                result['status'] = 'quota_exceeded'
+            else:
+                reference_blob(file_hash)
+                safe_name = secure_filename(filename)
+                db_file = File(
+                    filename=safe_name,
+                    original_name=filename,
+                    file_path=blob_path(file_hash),
+                    file_size=size,
+                    mime_type=mime_by_hash.get(file_hash) or mimetypes.guess_type(safe_name)[0] or 'application/octet-stream',
+                    file_hash=file_hash,
+                    user_id=user_id,
+                    folder_id=folder_id
+                )
+                db.session.add(db_file)
+                adjust_folder_totals(folder_id, size=size, files=1)
+                created.append((db_file, result))
+                result['status'] = 'created'
+            results.append(result)
+
+        if created:
+            db.session.flush()
+            for db_file, result in created:
+                result['file_id'] = db_file.id
+                enqueue_job('enrich_file', {'file_id': db_file.id}, user_id=user_id)
+            db.session.commit()
+            for db_file, _ in created:
+                log_activity(user_id, 'upload', 'file', db_file.id, db_file.original_name, details='instant')
+
+        return jsonify({
+            'results': results,
+            'created': len(created),
+            'missing': sum(1 for r in results if r['status'] == 'missing')
+        }), 200
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'Erro na verificação de upload: {str(e)}'}), 500
+
+# === ROTAS DE UPLOAD EM PARTES (RESUMABLE) ===
+
+def _upload_session_stale():
+    """Condição SQL das sessões a descartar: ativas expiradas ou presas em
+    'finalizing' (finalização interrompida) há mais de UPLOAD_SESSION_FINALIZE_TIMEOUT."""
+    now = datetime.utcnow()
+    return db.or_(
+        db.and_(UploadSession.status == 'active', UploadSession.expires_at < now),
+        db.and_(UploadSession.status == 'finalizing', db.or_(
+            UploadSession.finalizing_since < now - UPLOAD_SESSION_FINALIZE_TIMEOUT,
+            db.and_(UploadSession.finalizing_since.is_(None), UploadSession.expires_at < now)
+        ))
+    )
+
+def _get_upload_session(upload_id, user_id):
+    upload = UploadSession.query.filter_by(id=upload_id, user_id=user_id).first()
+    if upload and upload.status in ('active', 'finalizing') and \
+            UploadSession.query.filter(UploadSession.id == upload.id, _upload_session_stale()).count():
+        _discard_upload_session(upload, 'expired')
+        db.session.commit()
+    return upload
+
+def _discard_upload_session(upload, status):
+    """Remove partes e o arquivo .part de uma sessão e devolve a reserva de quota
+    (sem commit). A troca de status é um UPDATE condicional: só quem a faz
+    devolve a reserva. Retorna False se outra requisição mudou a sessão antes."""
+    previous = upload.status
+    claimed = UploadSession.query.filter_by(id=upload.id, status=previous).update(
+        {'status': status}, synchronize_session=False
+    )
+    if not claimed:
+        db.session.refresh(upload)
+        return False
+    if previous in ('active', 'finalizing'):
+        adjust_storage(upload.user_id, reserved=-upload.total_size)
+    try:
+        os.remove(upload.part_path)
+    except FileNotFoundError:
+        pass
+    UploadChunk.query.filter_by(upload_id=upload.id).delete(synchronize_session=False)
+    upload.status = status
+    return True
+
+def cleanup_expired_upload_sessions(limit=50):
+    """Descarta sessões ativas expiradas e finalizações interrompidas, devolvendo
+    a reserva de quota. Chamado oportunisticamente na criação de sessões."""
+    expired = UploadSession.query.filter(_upload_session_stale()).limit(limit).all()
+    for upload in expired:
+        _discard_upload_session(upload, 'expired')
+    if expired:
+        db.session.commit()
+
+def _lock_upload_part(fd, exclusive):
+    """flock no .part: partes gravam com trava compartilhada e a finalização
+    espera a exclusiva, então nenhuma parte é escrita durante o hash."""
+    if fcntl:
+        fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+def _received_ranges(indexes):
+    """Compacta índices de partes recebidas em intervalos [início, fim]."""
+    ranges = []
+    for index in sorted(indexes):
+        if ranges and index == ranges[-1][1] + 1:
+            ranges[-1][1] = index
+        else:
+            ranges.append([index, index])
+    return ranges
+
+def _upload_session_status(upload):
+    indexes = [row.chunk_index for row in db.session.query(UploadChunk.chunk_index).filter_by(upload_id=upload.id)]
+    received_bytes = sum(upload.chunk_length(i) for i in indexes)
+    return {
+        'upload_id': upload.id,
+        'filename': upload.filename,
+        'status': upload.status,
+        'total_size': upload.total_size,
+        'chunk_size': upload.chunk_size,
+        'total_chunks': upload.total_chunks,
+        'received_chunks': len(indexes),
+        'received_bytes': received_bytes,
+        'received_ranges': _received_ranges(indexes),
+        'file_id': upload.file_id,
+        'expires_at': upload.expires_at.isoformat()
+    }
+
+@app.route('/api/uploads', methods=['POST'])
+@jwt_required()
+def create_upload_session():
+    """Cria uma sessão de upload em partes.
+    Espera JSON { filename, size, folder_id?, chunk_size? }.
+    A quota é verificada aqui, considerando outras sessões ativas do usuário.
+    """
+    if 'NO_DB_CONFIG' in globals() and NO_DB_CONFIG:
+        return jsonify({'error': 'Sistema em modo de configuração'}), 503
+    try:
+        user_id = int(get_jwt_identity())
+        user = User.query.get(user_id)
+        if not user:
+            return jsonify({'error': 'Usuário não encontrado'}), 404
+
+        data = request.get_json() or {}
+        filename = (data.get('filename') or '').strip()
+        try:
+            total_size = int(data.get('size'))
+            chunk_size = int(data.get('chunk_size') or UPLOAD_SESSION_DEFAULT_CHUNK)
+        except (TypeError, ValueError):
+            return jsonify({'error': 'size e chunk_size devem ser inteiros'}), 400
+        folder_id = data.get('folder_id') or None
+
+        if not filename or not secure_filename(filename):
+            return jsonify({'error': 'Nome de arquivo inválido'}), 400
+        if total_size < 0:
+            return jsonify({'error': 'Tamanho inválido'}), 400
+        if chunk_size <= 0 or chunk_size > UPLOAD_SESSION_MAX_CHUNK:
+            return jsonify({'error': f'chunk_size deve estar entre 1 e {UPLOAD_SESSION_MAX_CHUNK}'}), 400
+        if folder_id and not Folder.query.filter_by(id=folder_id, user_id=user_id).first():
+            return jsonify({'error': 'Pasta não encontrada'}), 404
+
+        cleanup_expired_upload_sessions()
+
+        # Quota: o tamanho total fica reservado enquanto a sessão estiver aberta
+        if not reserve_storage(user_id, total_size):
+            return jsonify({'error': 'Quota de armazenamento excedida'}), 413
+
+        upload = UploadSession(
+            id=uuid.uuid4().hex,
+            user_id=user_id,
+            folder_id=folder_id,
+            filename=filename,
+            total_size=total_size,
+            chunk_size=chunk_size,
+            status='active',
+            expires_at=datetime.utcnow() + UPLOAD_SESSION_TTL
+        )
+        try:
+            # Pré-alocar (esparso) o arquivo final; as partes são gravadas por offset
+            os.makedirs(UPLOAD_TMP_FOLDER, exist_ok=True)
+            with open(upload.part_path, 'wb') as f:
+                f.truncate(total_size)
+            db.session.add(upload)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            adjust_storage(user_id, reserved=-total_size)
+            db.session.commit()
+            raise
+        return jsonify(_upload_session_status(upload)), 201
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'Erro ao criar sessão de upload: {str(e)}'}), 500
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+@jwt_required()
+def get_upload_session(upload_id):
+    """Estado da sessão, incluindo os intervalos de partes já recebidas (para retomar)."""
+    if 'NO_DB_CONFIG' in globals() and NO_DB_CONFIG:
+        return jsonify({'error': 'Sistema em modo de configuração'}), 503
+    upload = _get_upload_session(upload_id, int(get_jwt_identity()))
+    if not upload:
+        return jsonify({'error': 'Sessão de upload não encontrada'}), 404
+    return jsonify(_upload_session_status(upload)), 200
+
+@app.route('/api/uploads/<upload_id>/chunks/<int:index>', methods=['PUT'])
+@jwt_required()
+def put_upload_chunk(upload_id, index):
+    """Recebe uma parte (corpo bruto). Partes podem chegar em paralelo e em
+    qualquer ordem; reenviar uma parte já recebida é idempotente.
+    Header opcional X-Chunk-SHA256 para verificar a integridade da parte.
+    """
+    if 'NO_DB_CONFIG' in globals() and NO_DB_CONFIG:
+        return jsonify({'error': 'Sistema em modo de configuração'}), 503
+    user_id = int(get_jwt_identity())
+    upload = _get_upload_session(upload_id, user_id)
+    if not upload:
+        return jsonify({'error': 'Sessão de upload não encontrada'}), 404
+    if upload.status != 'active':
+        return jsonify({'error': f'Sessão não está ativa ({upload.status})'}), 409
+    if index < 0 or index >= upload.total_chunks:
+        return jsonify({'error': 'Índice de parte inválido'}), 400
+
+    expected = upload.chunk_length(index)
+    if request.content_length is not None and request.content_length != expected:
+        return jsonify({'error': f'Parte {index} deve ter {expected} bytes'}), 400
+
+    expected_hash = (request.headers.get('X-Chunk-SHA256') or '').lower()
+    chunk_hash = hashlib.sha256()
+    offset = index * upload.chunk_size
+    written = 0
+    try:
+        fd = os.open(upload.part_path, os.O_WRONLY)
+    except FileNotFoundError:
+        return jsonify({'error': 'Sessão de upload sem arquivo temporário'}), 410
+    try:
+        # Reconfere o status já com a trava: uma finalização iniciada depois da
+        # primeira verificação não pode receber bytes durante o hash
+        _lock_upload_part(fd, exclusive=False)
+        db.session.commit()  # nova leitura, fora do snapshot da transação anterior
+        status = db.session.query(UploadSession.status).filter_by(id=upload_id).scalar()
+        if status != 'active':
+            return jsonify({'error': f'Sessão não está ativa ({status})'}), 409
+        while written < expected:
+            data = request.stream.read(min(UPLOAD_CHUNK_SIZE, expected - written))
+            if not data:
+                break
+            chunk_hash.update(data)
+            os.pwrite(fd, data, offset + written)
+            written += len(data)
+    finally:
+        os.close(fd)
+
+    if written != expected:
+        return jsonify({'error': f'Parte incompleta: {written} de {expected} bytes'}), 400
+    if expected_hash and expected_hash != chunk_hash.hexdigest():
+        return jsonify({'error': 'SHA-256 da parte não confere'}), 422
+
+    try:
+        db.session.add(UploadChunk(upload_id=upload.id, chunk_index=index, size=written))
+        upload.expires_at = datetime.utcnow() + UPLOAD_SESSION_TTL
+        db.session.commit()
+    except Exception:
+        # Parte já registrada por outra requisição (retry concorrente)
+        db.session.rollback()
+    return jsonify({'upload_id': upload.id, 'chunk_index': index, 'size': written}), 200
+
+@app.route('/api/uploads/<upload_id>/complete', methods=['POST'])
+@jwt_required()
+def complete_upload_session(upload_id):
+    """Finaliza a sessão: confere as partes, calcula o hash, move o .part para
+    o destino (rename, sem recópia) e cria o registro File.
+    JSON opcional { sha256 } para validar o conteúdo completo.
+    """
+    if 'NO_DB_CONFIG' in globals() and NO_DB_CONFIG:
+        return jsonify({'error': 'Sistema em modo de configuração'}), 503
+    user_id = int(get_jwt_identity())
+    user = User.query.get(user_id)
+    upload = _get_upload_session(upload_id, user_id)
+    if not user or not upload:
+        return jsonify({'error': 'Sessão de upload não encontrada'}), 404
+    if upload.status == 'completed':
+        return jsonify(_upload_session_status(upload)), 200
+    if upload.status != 'active':
+        return jsonify({'error': f'Sessão não está ativa ({upload.status})'}), 409
+
+    received = db.session.query(UploadChunk).filter_by(upload_id=upload.id).count()
+    if received != upload.total_chunks:
+        status = _upload_session_status(upload)
+        status['error'] = 'Upload incompleto'
+        return jsonify(status), 409
+
+    # Apenas uma requisição finaliza a sessão
+    claimed = UploadSession.query.filter_by(id=upload.id, status='active').update(
+        {'status': 'finalizing', 'finalizing_since': datetime.utcnow()}, synchronize_session=False
+    )
+    db.session.commit()
+    if not claimed:
+        return jsonify({'error': 'Sessão já está sendo finalizada'}), 409
+
+    part_fd = None
+    moved_blob = None  # hash do blob criado a partir do .part, se o rename já ocorreu
+    try:
+        data = request.get_json(silent=True) or {}
+        file_size = upload.total_size
+
+        # Espera as partes que ainda estão sendo gravadas; novas já veem 'finalizing'
+        part_fd = os.open(upload.part_path, os.O_RDONLY)
+        _lock_upload_part(part_fd, exclusive=True)
+        # Hash em leitura sequencial única (as partes chegam fora de ordem)
+        file_hash = calculate_file_hash(upload.part_path)
+        if data.get('sha256') and data['sha256'].lower() != file_hash:
+            UploadSession.query.filter_by(id=upload.id, status='finalizing').update(
+                {'status': 'active', 'finalizing_since': None}, synchronize_session=False
+            )
+            db.session.commit()
+            return jsonify({'error': 'SHA-256 do arquivo não confere', 'sha256': file_hash}), 422
+        with open(upload.part_path, 'rb') as f:
+            head = f.read(MIME_SNIFF_BYTES)
+
+        if upload.folder_id and not resolve_target_dir(user, upload.folder_id):
+            upload.folder_id = None
+        filename = secure_filename(upload.filename)
+
+        # Reivindica a conclusão antes de mover o .part: se a sessão foi descartada
+        # como presa enquanto o hash rodava, a reserva já voltou e nada é movido.
+        # A linha fica travada até o commit, então a limpeza não a pega no meio.
+        if not UploadSession.query.filter_by(id=upload.id, status='finalizing').update(
+            {'status': 'completed'}, synchronize_session=False
+        ):
+            db.session.rollback()
+            return jsonify({'error': 'Sessão expirou durante a finalização'}), 409
+        blob_existed = os.path.exists(blob_path(file_hash))
+        file_path = acquire_blob(file_hash, file_size, upload.part_path)
+        if not blob_existed:
+            moved_blob = file_hash
+
+        db_file = File(
+            filename=filename,
+            original_name=upload.filename,
+            file_path=file_path,
+            file_size=file_size,
+            mime_type=detect_mime_type(head, filename),
+            file_hash=file_hash,
+            user_id=user_id,
+            folder_id=upload.folder_id
+        )
+        db.session.add(db_file)
+        db.session.flush()
+        UploadSession.query.filter_by(id=upload.id).update({'file_id': db_file.id}, synchronize_session=False)
+        # A reserva feita na criação da sessão vira uso
+        adjust_storage(user_id, used=file_size, reserved=-file_size)
+        adjust_folder_totals(upload.folder_id, size=file_size, files=1)
+        UploadChunk.query.filter_by(upload_id=upload.id).delete(synchronize_session=False)
+        enqueue_job('enrich_file', {'file_id': db_file.id}, user_id=user_id)
+        db.session.commit()
+
+        log_activity(user_id, 'upload', 'file', db_file.id, upload.filename)
+
+        return jsonify({
+            'message': 'Arquivo enviado com sucesso',
+            'file_id': db_file.id,
+            'filename': filename,
+            'sha256': file_hash
+        }), 201
+    except Exception as e:
+        db.session.rollback()
+        db.session.refresh(upload)
+        if upload.status != 'finalizing':
+            # Descartada pela limpeza no meio da finalização (reserva já devolvida)
+            return jsonify({'error': 'Sessão expirou durante a finalização'}), 409
+        if os.path.exists(upload.part_path):
+            # .part intacto: a sessão volta a aceitar partes e nova finalização
+            UploadSession.query.filter_by(id=upload_id, status='finalizing').update(
+                {'status': 'active', 'finalizing_since': None}, synchronize_session=False
+            )
+        else:
+            # O .part já foi para o blob store: a sessão não tem mais como
+            # concluir; devolve a reserva e tira o blob órfão (a referência
+            # foi desfeita no rollback)
+            _discard_upload_session(upload, 'failed')
+            if moved_blob and not db.session.get(ContentBlob, moved_blob):
+                try:
+                    os.remove(blob_path(moved_blob))
+                except FileNotFoundError:
+                    pass
+        db.session.commit()
+        return jsonify({'error': f'Erro ao finalizar upload: {str(e)}'}), 500
+    finally:
+        if part_fd is not None:
+            os.close(part_fd)
+
+@app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+@jwt_required()
+def abort_upload_session(upload_id):
+    if 'NO_DB_CONFIG' in globals() and NO_DB_CONFIG:
+        return jsonify({'error': 'Sistema em modo de configuração'}), 503
+    upload = _get_upload_session(upload_id, int(get_jwt_identity()))
+    if not upload:
+        return jsonify({'error': 'Sessão de upload não encontrada'}), 404
+    if upload.status != 'active':
+        return jsonify({'error': f'Sessão não está ativa ({upload.status})'}), 409
+    if not _discard_upload_session(upload, 'aborted'):
+        return jsonify({'error': f'Sessão não está ativa ({upload.status})'}), 409
+    db.session.commit()
+    return jsonify({'message': 'Upload cancelado'}), 200
 
 @app.route('/api/files', methods=['GET'])
 @jwt_required()
 def list_files():
+    """Lista a pasta: subpastas (só na primeira página) e arquivos paginados por cursor.
+    Query: folder_id, sort (name|date|size), order (asc|desc), limit, cursor e
+    recursive=1 (arquivos de toda a subárvore). Sem limit nem cursor vêm todos
+    os arquivos, como antes da paginação.
+    A resposta é gerada em streaming; next_cursor vem no final do JSON.
+    """
     if 'NO_DB_CONFIG' in globals() and NO_DB_CONFIG:
         return jsonify({'error': 'Sistema em modo de configuração'}), 503
     try:
@@ -1139,55 +4196,52 @@ def list_files():
         folder_id = request.args.get('folder_id', type=int, default=None)
         if folder_id == 0:
             folder_id = None
+        recursive = request.args.get('recursive') in ('1', 'true')
+        try:
+            sort, order, limit, after = parse_listing_args()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        # Buscar pastas na pasta atual
-        folders = Folder.query.filter_by(user_id=user_id, parent_id=folder_id).all()
-        
-        # Buscar arquivos na pasta atual
-        files = File.query.filter_by(user_id=user_id, folder_id=folder_id).all()
-        
-        folder_list = []
-        for folder in folders:
-            folder_list.append({
+        header = {'current_folder_id': folder_id, 'sort': sort, 'order': order, 'recursive': recursive}
+        if not after:
+            # Buscar pastas na pasta atual (apenas colunas exibidas)
+            folders = db.session.query(
+                Folder.id, Folder.name, Folder.total_size, Folder.total_files, Folder.created_at, Folder.updated_at
+            ).filter_by(user_id=user_id, parent_id=folder_id).order_by(Folder.name).all()
+            header['folders'] = [{
                 'id': folder.id,
                 'name': folder.name,
+                'size': folder.total_size,
+                'file_count': folder.total_files,
                 'created_at': folder.created_at.isoformat(),
                 'updated_at': folder.updated_at.isoformat()
-            })
+            } for folder in folders]
+            header['total_hint'], header['total_is_exact'] = file_count_hint(user_id, folder_id, recursive)
+            header['total_items'] = len(folders) + header['total_hint']
+        
+            # Construir o caminho (breadcrumb) com uma consulta na closure table
+            header['path'] = folder_breadcrumb(folder_id, user_id) if folder_id else []
         
-        file_list = []
-        for file in files:
-            file_list.append({
+        def fetch_page(after, size):
+            return file_listing_query(user_id, folder_id, sort, order, after, recursive).limit(size).all()
+        
+        def serialize(file):
+            return {
                 'id': file.id,
+                'folder_id': file.folder_id,
                 'filename': file.original_name,
                 'size': file.file_size,
                 'upload_date': file.created_at.isoformat(),
                 'mime_type': file.mime_type,
-                'is_favorite': getattr(file, 'is_favorite', False),
-                'is_streamable': is_streamable_file(file.mime_type)
-            })
-        
-        # Construir o caminho (breadcrumb)
-        path = []
-        if folder_id:
-            current_folder = Folder.query.get(folder_id)
-            if current_folder and current_folder.user_id == user_id:
-                # Construir caminho até a raiz
-                temp_folder = current_folder
-                while temp_folder:
-                    path.insert(0, {
-                        'id': temp_folder.id,
-                        'name': temp_folder.name
-                    })
-                    temp_folder = Folder.query.get(temp_folder.parent_id) if temp_folder.parent_id else None
+                'is_favorite': bool(file.is_favorite),
+                'is_streamable': is_streamable_file(file.mime_type),
+                'version': content_version(file.file_hash)
+            }
         
-        return jsonify({
-            'folders': folder_list,
-            'files': file_list,
-            'path': path,
-            'current_folder_id': folder_id,
-            'total_items': len(folder_list) + len(file_list)
-        }), 200
+        return app.response_class(
+            stream_with_context(stream_file_listing(header, fetch_page, serialize, sort, limit, after)),
+            mimetype='application/json'
+        )
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -1205,7 +4259,13 @@ def download_file(file_id):
     if not os.path.exists(file.file_path):
         return jsonify({'error': 'Arquivo não existe no sistema'}), 404
     
-    return send_file(file.file_path, as_attachment=True, download_name=file.original_name)
+    return send_stored_file(
+        file.file_path,
+        file.mime_type or 'application/octet-stream',
+        content_disposition('attachment', file.original_name),
+        etag=file.file_hash,
+        last_modified=file.updated_at
+    )
 
 @app.route('/api/files/<int:file_id>/rename', methods=['POST'])
 @jwt_required()
@@ -1226,7 +4286,6 @@ def rename_file(file_id):
         return jsonify({'error': 'Arquivo não encontrado'}), 404
 
     # Sanitizar nome e preservar extensão se ausente
-    base_dir = os.path.dirname(file.file_path)
     # Se não vier extensão, manter a extensão atual
     import os as _os
     _old_base, _old_ext = _os.path.splitext(file.original_name)
@@ -1237,18 +4296,23 @@ def rename_file(file_id):
     if not safe_name:
         return jsonify({'error': 'Nome inválido'}), 400
 
-    # Evitar colisão
-    target_path = os.path.join(base_dir, safe_name)
-    counter = 1
-    name_root, name_ext = os.path.splitext(safe_name)
-    while os.path.exists(target_path) and os.path.abspath(target_path) != os.path.abspath(file.file_path):
-        safe_name = f"{name_root}_{counter}{name_ext}"
+    # Arquivos no store de blobs só mudam de nome no banco
+    target_path = file.file_path
+    if not is_blob_path(file.file_path):
+        # Evitar colisão
+        base_dir = os.path.dirname(file.file_path)
         target_path = os.path.join(base_dir, safe_name)
-        counter += 1
+        counter = 1
+        name_root, name_ext = os.path.splitext(safe_name)
+        while os.path.exists(target_path) and os.path.abspath(target_path) != os.path.abspath(file.file_path):
+            safe_name = f"{name_root}_{counter}{name_ext}"
+            target_path = os.path.join(base_dir, safe_name)
+            counter += 1
 
     try:
         # Renomear no disco
-        os.rename(file.file_path, target_path)
+        if target_path != file.file_path:
+            os.rename(file.file_path, target_path)
         # Atualizar no banco
         file.file_path = target_path
         file.filename = safe_name
@@ -1273,10 +4337,6 @@ def delete_file(file_id):
     if not file:
         return jsonify({'error': 'Arquivo não encontrado'}), 404
     
-    # Remover arquivo do sistema
-    if os.path.exists(file.file_path):
-        os.remove(file.file_path)
-    
     # Remover dependências relacionadas antes de deletar (evita erro de FK no MySQL)
     try:
         Share.query.filter_by(file_id=file.id).delete(synchronize_session=False)
@@ -1287,15 +4347,26 @@ def delete_file(file_id):
     except Exception:
         pass
     try:
+        for version in FileVersion.query.filter_by(file_id=file.id).all():
+            remove_stored_content(version.file_path, version.file_hash)
         FileVersion.query.filter_by(file_id=file.id).delete(synchronize_session=False)
     except Exception:
         pass
     try:
-        ExecutionLog.query.filter_by(file_id=file.id).delete(synchronize_session=False)
+        delete_execution_logs(ExecutionLog.file_id == file.id)
     except Exception:
         pass
+    try:
+        UploadSession.query.filter_by(file_id=file.id).update({'file_id': None}, synchronize_session=False)
+    except Exception:
+        pass
+
+    # Remover conteúdo (blob compartilhado só sai com a última referência)
+    remove_stored_content(file.file_path, file.file_hash)
 
     # Remover do banco de dados
+    adjust_storage(user_id, used=-file.file_size)
+    adjust_folder_totals(file.folder_id, size=-file.file_size, files=-1)
     db.session.delete(file)
     db.session.commit()
 
@@ -1310,6 +4381,8 @@ def delete_file(file_id):
 @app.route('/api/execute/<int:file_id>', methods=['POST'])
 @jwt_required()
 def execute_file(file_id):
+    """Enfileira a execução do script e responde na hora (202) com o id para
+    acompanhar em /api/executions/<id>. Os scripts rodam nos workers (worker.py)."""
     if 'NO_DB_CONFIG' in globals() and NO_DB_CONFIG:
         return jsonify({'error': 'Sistema em modo de configuração'}), 503
     user_id = int(get_jwt_identity())
@@ -1321,60 +4394,541 @@ def execute_file(file_id):
     if not os.path.exists(file.file_path):
         return jsonify({'error': 'Arquivo não existe no sistema'}), 404
     
-    if not is_safe_executable(file.file_path):
+    # A extensão vem do nome do arquivo (no store de blobs o caminho não tem extensão)
+    if not is_safe_executable(file.filename):
         return jsonify({'error': 'Tipo de arquivo não é executável com segurança'}), 400
+    command = execution_command(file)
+    if not command:
+        return jsonify({'error': 'Tipo de arquivo não suportado para execução'}), 400
     
-    try:
-        # Determinar comando de execução baseado na extensão
-        _, ext = os.path.splitext(file.file_path.lower())
-        
-        if ext == '.py':
-            command = ['python3', file.file_path]
-        elif ext == '.sh':
-            command = ['bash', file.file_path]
-        elif ext == '.js':
-            command = ['node', file.file_path]
-        elif ext == '.php':
-            command = ['php', file.file_path]
-        elif ext == '.rb':
-            command = ['ruby', file.file_path]
-        elif ext == '.pl':
-            command = ['perl', file.file_path]
+    pending = Job.query.filter(
+        Job.kind == 'execute', Job.user_id == user_id, Job.status.in_(('queued', 'running'))
+    ).count()
+    if pending >= EXECUTION_MAX_QUEUED_PER_USER:
+        return jsonify({'error': 'Muitas execuções pendentes; aguarde as anteriores terminarem'}), 429
+    
+    log = ExecutionLog(
+        file_id=file_id,
+        user_id=user_id,
+        command=' '.join(command),
+        status='queued'
+    )
+    db.session.add(log)
+    db.session.flush()
+    # Scripts não são repetidos automaticamente se falharem
+    job = enqueue_job('execute', {'execution_id': log.id}, user_id=user_id, max_attempts=1)
+    db.session.flush()
+    log.job_id = job.id
+    db.session.commit()
+    
+    return jsonify({
+        'execution_id': log.id,
+        'job_id': job.id,
+        'status': log.status,
+        'status_url': f'/api/executions/{log.id}'
+    }), 202
+
+@app.route('/api/executions/<int:execution_id>', methods=['GET'])
+@jwt_required()
+def get_execution(execution_id):
+    """Estado de uma execução: posição na fila, ou saída, código de saída,
+    espera na fila, tempo de execução e pico de memória."""
+    if 'NO_DB_CONFIG' in globals() and NO_DB_CONFIG:
+        return jsonify({'error': 'Sistema em modo de configuração'}), 503
+    user_id = int(get_jwt_identity())
+    log = ExecutionLog.query.filter_by(id=execution_id, user_id=user_id).first()
+    if not log:
+        return jsonify({'error': 'Execução não encontrada'}), 404
+    return jsonify(serialize_execution(log)), 200
+
+def _sse(event, data, event_id=None):
+    head = f'id: {event_id}\n' if event_id else ''
+    return f'{head}event: {event}\ndata: {json.dumps(data)}\n\n'
+
+@app.route('/api/executions/<int:execution_id>/stream', methods=['GET'])
+def stream_execution(execution_id):
+    """Saída da execução ao vivo em Server-Sent Events: `status` enquanto está na
+    fila, `stdout`/`stderr` conforme o processo escreve e `end` com o resultado.
+    Aceita ?jwt= (EventSource não envia headers) e retoma de Last-Event-ID."""
+    if 'NO_DB_CONFIG' in globals() and NO_DB_CONFIG:
+        return jsonify({'error': 'Sistema em modo de configuração'}), 503
+    scope, error = resolve_access_scope()
+    if error:
+        return error
+    if scope[0] != 'user':
+        return jsonify({'error': 'Acesso negado'}), 403
+    user_id = scope[1]
+    if not ExecutionLog.query.filter_by(id=execution_id, user_id=user_id).count():
+        return jsonify({'error': 'Execução não encontrada'}), 404
+    start_segment, skip = 0, 0
+    last_event = request.headers.get('Last-Event-ID', '')
+    if re.fullmatch(r'\d+:\d+', last_event):
+        start_segment, skip = (int(part) for part in last_event.split(':'))
+        skip += 1
+
+    def current():
+        # Encerra a transação para enxergar o que o worker gravou desde a última leitura
+        db.session.rollback()
+        return db.session.get(ExecutionLog, execution_id)
+
+    def generate():
+        yield 'retry: 2000\n\n'
+        log = current()
+        delay, position = 0.2, None
+        while log and log.status == 'queued':
+            queue_position = serialize_execution(log).get('queue_position')
+            if queue_position != position:
+                position = queue_position
+                yield _sse('status', {'status': 'queued', 'queue_position': queue_position})
+            else:
+                yield ': ping\n\n'
+            # Backoff: cada espectador na fila faz no máximo uma consulta a cada 2 s
+            time.sleep(delay)
+            delay = min(delay * 2, 2.0)
+            log = current()
+        if not log:
+            return
+        if log.log_path:
+            log_dir = os.path.join(UPLOAD_FOLDER, log.log_path)
+            yield _sse('status', {'status': log.status})
+            idle = 0
+            for item in read_execution_records(log_dir, start_segment, skip, follow=True,
+                                               max_wait=EXECUTION_TIMEOUT + 30, idle_ticks=True):
+                if item is None:
+                    idle += 1
+                    if idle % 75 == 0:  # ~15 s sem saída
+                        yield ': ping\n\n'
+                    continue
+                segment, line, record = item
+                yield _sse('stdout' if record['s'] == 'out' else 'stderr', record['d'], f'{segment}:{line}')
+        elif log.status not in ('queued', 'running') and not last_event:
+            # Execuções anteriores ao spool: só o que ficou no banco
+            if log.output:
+                yield _sse('stdout', log.output, '0:0')
+            if log.error_output:
+                yield _sse('stderr', log.error_output, '0:1')
+        log = current()
+        for _ in range(25):
+            if log.status not in ('queued', 'running'):
+                break
+            time.sleep(0.2)
+            log = current()
+        final = serialize_execution(log)
+        yield _sse('end', {key: final[key] for key in (
+            'status', 'exit_code', 'run_ms', 'queue_wait_ms', 'peak_memory_kb', 'log_bytes', 'output_truncated'
+        )})
+
+    response = app.response_class(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # nginx: não bufferizar o stream
+    return response
+
+@app.route('/api/executions/<int:execution_id>/log', methods=['GET'])
+@jwt_required()
+def execution_log_index(execution_id):
+    """Segmentos do spool de saída (para ler trechos antigos sob demanda)."""
+    if 'NO_DB_CONFIG' in globals() and NO_DB_CONFIG:
+        return jsonify({'error': 'Sistema em modo de configuração'}), 503
+    user_id = int(get_jwt_identity())
+    log = ExecutionLog.query.filter_by(id=execution_id, user_id=user_id).first()
+    if not log:
+        return jsonify({'error': 'Execução não encontrada'}), 404
+    log_dir = os.path.join(UPLOAD_FOLDER, log.log_path) if log.log_path else None
+    segments = []
+    index = 0
+    while log_dir and os.path.exists(execution_segment_path(log_dir, index)):
+        segments.append({
+            'index': index,
+            'compressed_bytes': os.path.getsize(execution_segment_path(log_dir, index)),
+            'url': f'/api/executions/{execution_id}/log/{index}'
+        })
+        index += 1
+    return jsonify({
+        'execution_id': execution_id,
+        'status': log.status,
+        'complete': bool(log_dir) and os.path.exists(os.path.join(log_dir, 'done.json')),
+        'log_bytes': log.log_bytes,
+        'output_truncated': bool(log.output_truncated),
+        'segments': segments
+    }), 200
+
+@app.route('/api/executions/<int:execution_id>/log/<int:segment>', methods=['GET'])
+@jwt_required()
+def execution_log_segment(execution_id, segment):
+    """Um segmento da saída em NDJSON ({"s": "out"|"err", "d": texto} por linha).
+    Segmentos fechados saem como estão no disco, com Content-Encoding: gzip,
+    quando o cliente aceita; senão são descomprimidos no envio. ?after=N pula
+    as N primeiras linhas (acompanhamento por polling do segmento em andamento)."""
+    if 'NO_DB_CONFIG' in globals() and NO_DB_CONFIG:
+        return jsonify({'error': 'Sistema em modo de configuração'}), 503
+    user_id = int(get_jwt_identity())
+    log = ExecutionLog.query.filter_by(id=execution_id, user_id=user_id).first()
+    if not log or not log.log_path:
+        return jsonify({'error': 'Execução não encontrada'}), 404
+    log_dir = os.path.join(UPLOAD_FOLDER, log.log_path)
+    path = execution_segment_path(log_dir, segment)
+    if not os.path.exists(path):
+        return jsonify({'error': 'Segmento não encontrado'}), 404
+    after = request.args.get('after', 0, type=int) or 0
+    closed = (os.path.exists(execution_segment_path(log_dir, segment + 1))
+              or os.path.exists(os.path.join(log_dir, 'done.json')))
+    if closed and not after and 'gzip' in request.headers.get('Accept-Encoding', ''):
+        response = send_stored_file(path, 'application/x-ndjson', etag=f'exec-{execution_id}-{segment}')
+        response.headers['Content-Encoding'] = 'gzip'
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
+
+    def single_segment():
+        for index, _, record in read_execution_records(log_dir, segment, max(after, 0), follow=False):
+            if index != segment:
+                break
+            yield json.dumps(record) + '\n'
+    response = app.response_class(single_segment(), mimetype='application/x-ndjson')
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+# === MÉTRICAS DO SISTEMA (AMOSTRAGEM EM BACKGROUND) ===
+
+SYSTEM_METRIC_FIELDS = ('t', 'cpu', 'mem_percent', 'mem_total', 'mem_available',
+                        'disk_percent', 'disk_total', 'disk_used', 'disk_free',
+                        'read_bps', 'write_bps', 'net_sent_bps', 'net_recv_bps')
+# Campos das séries do histórico (médias por intervalo; CPU também com o máximo)
+SYSTEM_HISTORY_FIELDS = ('cpu', 'mem_percent', 'disk_percent', 'read_bps', 'write_bps',
+                         'net_sent_bps', 'net_recv_bps')
+
+def _bisect_time(time_at, lo, hi, target):
+    """Primeira posição em [lo, hi) com tempo >= target (tempos em ordem crescente)."""
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if time_at(mid) < target:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+class MetricRing:
+    """Buffer circular de capacidade fixa: um array('d') por campo, mais a
+    sequência de cada amostra (a mesma do arquivo em disco)."""
+
+    def __init__(self, fields, capacity):
+        self.capacity = capacity
+        self.columns = [array('d', bytes(8 * capacity)) for _ in fields]
+        self.seqs = array('q', bytes(8 * capacity))
+        self.count = 0
+        self.last_seq = -1
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def clear(self):
+        self.count = 0
+        self.last_seq = -1
+
+    def append(self, seq, values):
+        index = self.count % self.capacity
+        for column, value in zip(self.columns, values):
+            column[index] = value
+        self.seqs[index] = seq
+        self.count += 1
+        self.last_seq = seq
+
+    def _index(self, position):
+        return (self.count - len(self) + position) % self.capacity
+
+    def row(self, position):
+        """Amostra na posição dada (0 = a mais antiga ainda no buffer)."""
+        index = self._index(position)
+        return tuple(column[index] for column in self.columns)
+
+    def rows(self, since, until):
+        times = self.columns[0]
+        start = _bisect_time(lambda position: times[self._index(position)], 0, len(self), since)
+        result = []
+        for position in range(start, len(self)):
+            row = self.row(position)
+            if row[0] > until:
+                break
+            result.append(row)
+        return result
+
+class MetricFile:
+    """Arquivo circular de amostras: cabeçalho + `slots` registros de tamanho
+    fixo (sequência + campos em float64). A amostra N fica no slot N % slots e
+    o cabeçalho guarda a última sequência gravada, então o arquivo não cresce
+    e quem lê acha as novidades com um pread."""
+
+    MAGIC = b'CCSM'
+    HEADER = struct.Struct('<4sIQq')  # magic, nº de campos, slots, última sequência
+
+    def __init__(self, path, fields, slots):
+        self.path = path
+        self.fields = len(fields)
+        self.slots = slots
+        self.record = struct.Struct('<q' + 'd' * len(fields))
+        self.fd = None
+
+    def open(self, create=False):
+        """Abre para leitura; com create=True (só o amostrador) cria o arquivo,
+        ou o recria se o formato mudou. Retorna False se não há arquivo válido."""
+        self.close()
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT if create else os.O_RDONLY, 0o644)
+        except FileNotFoundError:
+            return False
+        header = os.pread(fd, self.HEADER.size, 0)
+        valid = len(header) == self.HEADER.size and self.HEADER.unpack(header)[:3] == (self.MAGIC, self.fields, self.slots)
+        if not valid:
+            if not create:
+                os.close(fd)
+                return False
+            os.ftruncate(fd, 0)
+            os.ftruncate(fd, self.HEADER.size + self.slots * self.record.size)  # esparso
+            os.pwrite(fd, self.HEADER.pack(self.MAGIC, self.fields, self.slots, -1), 0)
+        self.fd = fd
+        return True
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _offset(self, seq):
+        return self.HEADER.size + (seq % self.slots) * self.record.size
+
+    def last_seq(self):
+        return self.HEADER.unpack(os.pread(self.fd, self.HEADER.size, 0))[3]
+
+    def first_seq(self, last):
+        return max(0, last - self.slots + 1)
+
+    def write(self, seq, values):
+        os.pwrite(self.fd, self.record.pack(seq, *values), self._offset(seq))
+        os.pwrite(self.fd, self.HEADER.pack(self.MAGIC, self.fields, self.slots, seq), 0)
+
+    def time_at(self, seq):
+        return self.record.unpack(os.pread(self.fd, self.record.size, self._offset(seq)))[1]
+
+    def read(self, first, last):
+        """(sequência, campos) de first até last, pulando slots já sobrescritos."""
+        seq = first
+        while seq <= last:
+            count = min(last - seq + 1, self.slots - seq % self.slots, 4096)
+            data = os.pread(self.fd, count * self.record.size, self._offset(seq))
+            for index, values in enumerate(self.record.iter_unpack(data)):
+                if values[0] == seq + index:
+                    yield values[0], values[1:]
+            seq += count
+
+def downsample_metrics(rows, since, until, points):
+    """Agrupa as amostras em no máximo `points` intervalos iguais entre since e
+    until. Intervalos sem amostras (servidor parado) ficam de fora."""
+    step = max((until - since) / points, SYSTEM_SAMPLE_INTERVAL)
+    last_bucket = max(0, math.ceil((until - since) / step) - 1)  # until entra no último
+    indexes = [SYSTEM_METRIC_FIELDS.index(name) for name in SYSTEM_HISTORY_FIELDS]
+    series = {'t': [], 'cpu_max': [], **{name: [] for name in SYSTEM_HISTORY_FIELDS}}
+    bucket = None
+    sums, count, peak = [], 0, 0.0
+
+    def emit():
+        series['t'].append(round(since + bucket * step, 3))
+        for name, total in zip(SYSTEM_HISTORY_FIELDS, sums):
+            series[name].append(round(total / count, 2))
+        series['cpu_max'].append(round(peak, 2))
+
+    for row in rows:
+        current = min(int((row[0] - since) // step), last_bucket)
+        if current != bucket:
+            if count:
+                emit()
+            bucket, sums, count, peak = current, [0.0] * len(indexes), 0, 0.0
+        for position, index in enumerate(indexes):
+            sums[position] += row[index]
+        peak = max(peak, row[1])
+        count += 1
+    if count:
+        emit()
+    return {'since': since, 'until': until, 'step': step, 'series': series}
+
+class SystemSampler:
+    """Amostras de CPU, memória, disco e I/O coletadas em background.
+
+    Um único processo por host amostra: quem obtém o flock de `sampler.lock`
+    grava cada amostra no MetricFile. Os demais processos (workers do gunicorn)
+    leem as amostras novas do arquivo a cada intervalo e assumem a trava se o
+    amostrador sair. Todos mantêm as amostras recentes num MetricRing, então
+    /api/system-info responde da memória, sem medir nada na requisição.
+    Sem fcntl (Windows) cada processo amostra por conta própria."""
+
+    def __init__(self, folder, interval, memory_samples, disk_samples):
+        self.folder = folder
+        self.interval = interval
+        self.ring = MetricRing(SYSTEM_METRIC_FIELDS, memory_samples)
+        self.file = MetricFile(os.path.join(folder, 'system.metrics'), SYSTEM_METRIC_FIELDS, disk_samples)
+        self.leader = False
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._sample_lock = threading.Lock()  # protege _previous
+        self._lock_file = None
+        self._previous = None
+        self._thread = None
+        self._pid = None
+
+    def start(self):
+        """Inicia a thread do processo atual (após fork, os workers iniciam a sua)."""
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # Descritores herdados do pai: manter a trava aberta no filho impediria
+            # outro processo de assumir a amostragem quando o pai sair
+            if self._lock_file:
+                self._lock_file.close()
+                self._lock_file = None
+            self.file.close()
+            self.leader = False
+            self._previous = None
+            self.tick()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='system-sampler', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval - time.time() % self.interval)  # alinhado ao relógio
+            try:
+                self.tick()
+            except Exception as e:
+                print(f"Aviso: falha na amostragem do sistema: {e}")
+
+    def tick(self):
+        """Um ciclo: o amostrador mede e grava; os demais acompanham o arquivo."""
+        if not self.leader:
+            self._try_lead()
+        if not self.leader:
+            self._follow()
+            return
+        values = self.sample()
+        with self._lock:
+            seq = self.file.last_seq() + 1
+            self.file.write(seq, values)
+            self.ring.append(seq, values)
+
+    def _try_lead(self):
+        if self._lock_file is None:
+            os.makedirs(self.folder, exist_ok=True)
+            self._lock_file = open(os.path.join(self.folder, 'sampler.lock'), 'a')
+        if fcntl:
+            try:
+                fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return
+        self.file.open(create=True)
+        self.leader = True
+        self._follow()  # continua a sequência (e o buffer) de onde o arquivo parou
+
+    def _follow(self):
+        if self.file.fd is None and not self.file.open():
+            return
+        last = self.file.last_seq()
+        with self._lock:
+            if last < self.ring.last_seq:
+                self.ring.clear()  # arquivo recriado
+            first = max(self.ring.last_seq + 1, last - self.ring.capacity + 1, self.file.first_seq(last))
+            for seq, values in self.file.read(first, last):
+                self.ring.append(seq, values)
+
+    def sample(self, advance=True):
+        """Mede o estado atual. CPU e taxas de I/O vêm da diferença para a amostra
+        anterior (na primeira, a CPU é a média desde o boot), sem bloquear.
+        Com advance=False a medição não vira a referência da próxima amostra."""
+        now = time.time()
+        cpu = psutil.cpu_times()
+        memory = psutil.virtual_memory()
+        disk = psutil.disk_usage(app.config['UPLOAD_FOLDER'])
+        io = psutil.disk_io_counters()
+        net = psutil.net_io_counters()
+        counters = (now, sum(cpu), cpu.idle + getattr(cpu, 'iowait', 0.0),
+                    io.read_bytes if io else 0, io.write_bytes if io else 0,
+                    net.bytes_sent if net else 0, net.bytes_recv if net else 0)
+        with self._sample_lock:
+            previous = self._previous
+            if advance:
+                self._previous = counters
+        if previous:
+            total, idle = counters[1] - previous[1], counters[2] - previous[2]
+            elapsed = max(now - previous[0], 1e-6)
+            rates = [max(0, current - before) / elapsed for current, before in zip(counters[3:], previous[3:])]
         else:
-            return jsonify({'error': 'Tipo de arquivo não suportado para execução'}), 400
-        
-        # Executar com timeout de 30 segundos
-        result = subprocess.run(
-            command,
-            capture_output=True,
-            text=True,
-            timeout=30,
-            cwd=os.path.dirname(file.file_path)
-        )
-        
-        # Salvar log de execução
-        log = ExecutionLog(
-            file_id=file_id,
-            user_id=user_id,
-            command=' '.join(command),
-            output=result.stdout,
-            error_output=result.stderr,
-            exit_code=result.returncode
-        )
-        db.session.add(log)
-        db.session.commit()
-        
-        return jsonify({
-            'output': result.stdout,
-            'error': result.stderr,
-            'exit_code': result.returncode,
-            'execution_id': log.id
-        }), 200
-    
-    except subprocess.TimeoutExpired:
-        return jsonify({'error': 'Execução excedeu tempo limite de 30 segundos'}), 408
-    except Exception as e:
-        return jsonify({'error': f'Erro durante execução: {str(e)}'}), 500
+            total, idle = counters[1], counters[2]
+            rates = [0.0] * 4
+        cpu_percent = 100.0 * (total - idle) / total if total > 0 else 0.0
+        return (now, round(cpu_percent, 2), memory.percent, memory.total, memory.available,
+                disk.percent, disk.total, disk.used, disk.free, *rates)
+
+    def latest(self):
+        with self._lock:
+            if len(self.ring):
+                return dict(zip(SYSTEM_METRIC_FIELDS, self.ring.row(len(self.ring) - 1)))
+        # Nem o arquivo tem amostras ainda (primeiro segundo do amostrador): mede
+        # sem alterar a referência da amostragem em background
+        return dict(zip(SYSTEM_METRIC_FIELDS, self.sample(advance=False)))
+
+    def history(self, since, until, points):
+        """Série reduzida entre since e until (epoch). Usa o buffer em memória
+        quando ele cobre o início do intervalo; senão lê o arquivo."""
+        with self._lock:
+            if len(self.ring) and self.ring.row(0)[0] <= since:
+                return downsample_metrics(self.ring.rows(since, until), since, until, points)
+            if self.file.fd is None and not self.file.open():
+                return downsample_metrics(self.ring.rows(since, until), since, until, points)
+            last = self.file.last_seq()
+        first = self.file.first_seq(last)
+        start = _bisect_time(self.file.time_at, first, last + 1, since)
+
+        def rows():
+            for _, values in self.file.read(start, last):
+                if values[0] > until:
+                    break
+                yield values
+        return downsample_metrics(rows(), since, until, points)
+
+system_sampler = SystemSampler(SYSTEM_METRICS_FOLDER, SYSTEM_SAMPLE_INTERVAL,
+                               SYSTEM_MEMORY_SAMPLES, SYSTEM_DISK_SAMPLES)
+
+@app.before_request
+def _start_system_sampler():
+    # Iniciado no import do módulo; processos criados por fork depois disso
+    # (gunicorn --preload) iniciam a sua thread na primeira requisição
+    if SYSTEM_SAMPLER_AUTOSTART:
+        system_sampler.start()
+
+def parse_history_range():
+    """since/until (ISO 8601, ou ?range=5m|15m|1h|6h|24h|7d) e points da query
+    string, como epoch. Levanta ValueError se inválidos."""
+    now = time.time()
+    bounds = []
+    for name in ('since', 'until'):
+        value = request.args.get(name)
+        try:
+            moment = datetime.fromisoformat(value) if value else None
+        except ValueError:
+            raise ValueError(f'{name} deve estar em ISO 8601')
+        if moment and moment.tzinfo is None:
+            moment = moment.replace(tzinfo=timezone.utc)
+        bounds.append(moment.timestamp() if moment else None)
+    since, until = bounds
+    until = until or now
+    if since is None:
+        span = SYSTEM_HISTORY_RANGES.get(request.args.get('range', '1h'))
+        if span is None:
+            raise ValueError(f"range deve ser um de: {', '.join(SYSTEM_HISTORY_RANGES)}")
+        since = until - span
+    if since >= until:
+        raise ValueError('since deve ser anterior a until')
+    points = request.args.get('points', SYSTEM_HISTORY_DEFAULT_POINTS, type=int)
+    points = max(1, min(points or SYSTEM_HISTORY_DEFAULT_POINTS, SYSTEM_HISTORY_MAX_POINTS))
+    return since, until, points
 
 @app.route('/api/system-info', methods=['GET'])
 @jwt_required()
@@ -1382,29 +4936,338 @@ def system_info():
     if 'NO_DB_CONFIG' in globals() and NO_DB_CONFIG:
         return jsonify({'error': 'Sistema em modo de configuração'}), 503
     try:
-        user_id = int(get_jwt_identity())  # Verificar se JWT é válido
-        
-        cpu_percent = psutil.cpu_percent(interval=0.1)  # Reduzir intervalo
-        memory = psutil.virtual_memory()
-        disk = psutil.disk_usage(app.config['UPLOAD_FOLDER'])
-        
+        sample = system_sampler.latest()
         return jsonify({
-            'cpu_usage': cpu_percent,
+            'cpu_usage': sample['cpu'],
             'memory': {
-                'total': memory.total,
-                'available': memory.available,
-                'percent': memory.percent
+                'total': int(sample['mem_total']),
+                'available': int(sample['mem_available']),
+                'percent': sample['mem_percent']
             },
             'disk': {
-                'total': disk.total,
-                'used': disk.used,
-                'free': disk.free,
-                'percent': disk.percent
-            }
+                'total': int(sample['disk_total']),
+                'used': int(sample['disk_used']),
+                'free': int(sample['disk_free']),
+                'percent': sample['disk_percent']
+            },
+            'io': {name: round(sample[name]) for name in ('read_bps', 'write_bps', 'net_sent_bps', 'net_recv_bps')},
+            'sampled_at': datetime.fromtimestamp(sample['t'], timezone.utc).isoformat(),
+            'sample_interval': SYSTEM_SAMPLE_INTERVAL
         }), 200
     except Exception as e:
         return jsonify({'error': f'Erro ao obter informações do sistema: {str(e)}'}), 500
 
+@app.route('/api/system-info/history', methods=['GET'])
+@jwt_required()
+def system_info_history():
+    """Histórico das métricas reduzido a no máximo `points` pontos, para os gráficos."""
+    if 'NO_DB_CONFIG' in globals() and NO_DB_CONFIG:
+        return jsonify({'error': 'Sistema em modo de configuração'}), 503
+    try:
+        since, until, points = parse_history_range()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(system_sampler.history(since, until, points)), 200
+
+# === MÉTRICAS DA APLICAÇÃO (/metrics) ===
+
+class MetricsRegistry:
+    """Contadores e histogramas no formato texto do Prometheus, somados entre
+    os processos (workers do gunicorn, worker de jobs).
+
+    Cada processo acumula em memória; uma thread grava o snapshot em
+    `<folder>/<pid>.json` a cada `flush_interval` segundos (se mudou). /metrics
+    soma os snapshots dos outros processos com os valores ao vivo do processo
+    que atende. Snapshots de processos que já saíram são somados a
+    `archive.json` e apagados: os contadores seguem crescendo mesmo com workers
+    reciclados e o diretório não acumula arquivos."""
+
+    def __init__(self, folder, flush_interval):
+        self.folder = folder
+        self.flush_interval = flush_interval
+        self._types = {}   # nome -> (tipo, ajuda, buckets)
+        self._values = {}  # (nome, labels) -> valor, ou [contagem por bucket..., soma, total]
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._pid = None
+        self._started_at = None
+        self._thread = None
+
+    def counter(self, name, help_text):
+        self._types[name] = ('counter', help_text, None)
+
+    def histogram(self, name, help_text, buckets):
+        self._types[name] = ('histogram', help_text, tuple(buckets))
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # Após fork os valores herdados pertencem ao processo pai (que grava os seus)
+            self._values = {}
+            self._pid = os.getpid()
+            self._started_at = psutil.Process().create_time()
+            self._thread = threading.Thread(target=self._run, name='metrics-flush', daemon=True)
+            self._thread.start()
+
+    def inc(self, name, value=1, **labels):
+        self._ensure_started()
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+            self._dirty = True
+
+    def observe(self, name, value, **labels):
+        self._ensure_started()
+        buckets = self._types[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [0] * (len(buckets) + 2)
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    series[index] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+            self._dirty = True
+
+    def _run(self):
+        try:
+            self.prune()
+        except Exception as e:
+            print(f"Aviso: falha ao arquivar métricas de processos encerrados: {e}")
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Aviso: falha ao gravar métricas: {e}")
+
+    def _snapshot_path(self, pid):
+        return os.path.join(self.folder, f'{pid}.json')
+
+    def flush(self):
+        """Grava o snapshot deste processo (escrita atômica)."""
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            values = [[name, list(labels), value] for (name, labels), value in self._values.items()]
+            self._dirty = False
+        os.makedirs(self.folder, exist_ok=True)
+        path = self._snapshot_path(self._pid)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'pid': self._pid, 'started_at': self._started_at, 'values': values}, f)
+        os.replace(path + '.tmp', path)
+
+    @staticmethod
+    def _merge(totals, values):
+        for name, labels, value in values:
+            key = (name, tuple(tuple(pair) for pair in labels))
+            current = totals.get(key)
+            if current is None:
+                totals[key] = list(value) if isinstance(value, list) else value
+            elif isinstance(value, list):
+                if len(current) == len(value):  # buckets mudaram entre versões: ignora o antigo
+                    totals[key] = [a + b for a, b in zip(current, value)]
+            else:
+                totals[key] = current + value
+
+    @staticmethod
+    def _alive(snapshot):
+        try:
+            return abs(psutil.Process(snapshot['pid']).create_time() - snapshot['started_at']) < 1
+        except (psutil.NoSuchProcess, psutil.AccessDenied, KeyError):
+            return False
+
+    @staticmethod
+    def _load(path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _archive_dead(self):
+        """Soma os snapshots de processos encerrados em archive.json e os apaga,
+        junto com snapshots ilegíveis e .tmp de pids que não estão mais rodando.
+        Retorna os valores do arquivo atualizado."""
+        archive_path = os.path.join(self.folder, 'archive.json')
+        archive = {}
+        self._merge(archive, (self._load(archive_path) or {'values': []})['values'])
+        dead = []
+        for entry in os.listdir(self.folder):
+            pid = entry.split('.', 1)[0]
+            if not pid.isdigit() or entry not in (f'{pid}.json', f'{pid}.json.tmp'):
+                continue
+            path = os.path.join(self.folder, entry)
+            snapshot = self._load(path) if entry.endswith('.json') else None
+            if snapshot and 'values' in snapshot:
+                if not self._alive(snapshot):
+                    self._merge(archive, snapshot['values'])
+                    dead.append(path)
+            elif not psutil.pid_exists(int(pid)):
+                os.remove(path)
+        if dead:
+            with open(archive_path + '.tmp', 'w') as f:
+                json.dump({'values': [[name, list(labels), value] for (name, labels), value in archive.items()]}, f)
+            os.replace(archive_path + '.tmp', archive_path)
+            for path in dead:
+                os.remove(path)
+        return archive
+
+    def prune(self):
+        """Arquiva os snapshots de processos encerrados (também chamado na partida
+        de cada processo, para o diretório não crescer sem scrapes)."""
+        os.makedirs(self.folder, exist_ok=True)
+        with single_flight(os.path.join(self.folder, 'archive.lock')):
+            self._archive_dead()
+
+    def collect(self):
+        """Valores somados de todos os processos: {(nome, labels): valor}."""
+        self._ensure_started()
+        os.makedirs(self.folder, exist_ok=True)
+        own = self._snapshot_path(self._pid)
+        # Sob a trava: um processo arquivando snapshots não some nem conta em dobro
+        with single_flight(os.path.join(self.folder, 'archive.lock')):
+            totals = self._archive_dead()
+            for entry in os.listdir(self.folder):
+                path = os.path.join(self.folder, entry)
+                if path == own or not entry.endswith('.json') or not entry[:-5].isdigit():
+                    continue
+                snapshot = self._load(path)
+                if snapshot:
+                    self._merge(totals, snapshot['values'])
+        with self._lock:
+            self._merge(totals, [[name, list(labels), value] for (name, labels), value in self._values.items()])
+        return totals
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+        return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+    @staticmethod
+    def _format_number(value):
+        if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+            value = int(value)
+        return repr(value) if isinstance(value, float) else str(value)
+
+    def render(self, gauges=()):
+        """Texto de exposição (versão 0.0.4). `gauges`: (nome, ajuda, [(labels, valor)])
+        medidos na hora por quem chama."""
+        totals = self.collect()
+        by_name = {}
+        for (name, labels), value in totals.items():
+            by_name.setdefault(name, []).append((labels, value))
+        lines = []
+        for name, (kind, help_text, buckets) in sorted(self._types.items()):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in sorted(by_name.get(name, ())):
+                if kind == 'counter':
+                    lines.append(f'{name}{self._format_labels(labels)} {self._format_number(value)}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets, value):
+                    cumulative += count
+                    le = labels + (('le', self._format_number(float(bound))),)
+                    lines.append(f'{name}_bucket{self._format_labels(le)} {cumulative}')
+                lines.append(f'{name}_bucket{self._format_labels(labels + (("le", "+Inf"),))} {value[-1]}')
+                lines.append(f'{name}_sum{self._format_labels(labels)} {self._format_number(value[-2])}')
+                lines.append(f'{name}_count{self._format_labels(labels)} {value[-1]}')
+        for name, help_text, samples in gauges:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} gauge')
+            for labels, value in samples:
+                lines.append(f'{name}{self._format_labels(tuple(sorted(labels.items())))} {self._format_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+app_metrics = MetricsRegistry(METRICS_FOLDER, METRICS_FLUSH_INTERVAL)
+app_metrics.counter('chiapetta_http_requests_total', 'Requisições HTTP por método, rota e status.')
+app_metrics.histogram('chiapetta_http_request_duration_seconds',
+                      'Tempo até a resposta (cabeçalhos, em streaming) por método e rota.', METRICS_LATENCY_BUCKETS)
+app_metrics.histogram('chiapetta_http_request_sql_queries', 'Consultas SQL por requisição, por rota.',
+                      (0, 1, 2, 5, 10, 20, 50, 100))
+app_metrics.counter('chiapetta_db_queries_total', 'Consultas SQL executadas (em requisições ou em background).')
+app_metrics.histogram('chiapetta_db_pool_checkout_seconds', 'Tempo para obter uma conexão do pool.',
+                      (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+app_metrics.counter('chiapetta_streamed_bytes_total', 'Bytes entregues por download/stream (Content-Length).')
+app_metrics.counter('chiapetta_upload_bytes_total', 'Bytes recebidos em uploads concluídos com sucesso.')
+app_metrics.histogram('chiapetta_upload_throughput_bytes_per_second', 'Vazão de cada upload (corpo / duração).',
+                      (64 * 1024, 256 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2, 64 * 1024 ** 2, 256 * 1024 ** 2))
+app_metrics.counter('chiapetta_derived_cache_lookups_total', 'Consultas ao cache de derivados (thumbnails, imagens) por resultado.')
+atexit.register(app_metrics.flush)
+
+@app.before_request
+def _metrics_start_request():
+    g.metrics_started = time.perf_counter()
+    g.metrics_queries = 0
+
+@app.after_request
+def _metrics_record_request(response):
+    started = g.pop('metrics_started', None)
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    # Padrão da rota (ex.: /api/stream/<int:file_id>), não o caminho: cardinalidade limitada
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    app_metrics.inc('chiapetta_http_requests_total', method=request.method, route=route,
+                    status=str(response.status_code))
+    app_metrics.observe('chiapetta_http_request_duration_seconds', elapsed, method=request.method, route=route)
+    app_metrics.observe('chiapetta_http_request_sql_queries', g.pop('metrics_queries', 0), route=route)
+    if request.endpoint in METRICS_STREAM_ENDPOINTS and response.content_length:
+        app_metrics.inc('chiapetta_streamed_bytes_total', response.content_length,
+                        endpoint=request.endpoint, status=str(response.status_code))
+    if request.endpoint in METRICS_UPLOAD_ENDPOINTS and response.status_code < 300 and request.content_length:
+        app_metrics.inc('chiapetta_upload_bytes_total', request.content_length, endpoint=request.endpoint)
+        app_metrics.observe('chiapetta_upload_throughput_bytes_per_second',
+                            request.content_length / max(elapsed, 1e-6), endpoint=request.endpoint)
+    return response
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _metrics_count_query(conn, cursor, statement, parameters, context, executemany):
+    in_request = has_request_context() and 'metrics_queries' in g
+    if in_request:
+        g.metrics_queries += 1
+    app_metrics.inc('chiapetta_db_queries_total', source='request' if in_request else 'background')
+
+def job_queue_gauges():
+    """Profundidade da fila de jobs (por tipo e estado), lida do banco na hora."""
+    rows = db.session.query(Job.kind, Job.status, db.func.count(Job.id)).filter(
+        Job.status.in_(('queued', 'running'))
+    ).group_by(Job.kind, Job.status).all()
+    return [('chiapetta_job_queue_depth', 'Jobs na fila ou em execução, por tipo e estado.',
+             [({'kind': kind, 'status': status}, count) for kind, status, count in rows])]
+
+def metrics_access_allowed():
+    """Com METRICS_TOKEN exige o Bearer; sem ele só a conexão direta do próprio
+    host (um proxy local repassaria requisições externas como loopback)."""
+    if METRICS_TOKEN:
+        return hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {METRICS_TOKEN}')
+    proxied = any(h in request.headers for h in ('X-Forwarded-For', 'X-Real-IP', 'Forwarded'))
+    return request.remote_addr in ('127.0.0.1', '::1') and not proxied
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    if not metrics_access_allowed():
+        return jsonify({'error': 'Acesso negado'}), 403
+    gauges = []
+    if not NO_DB_CONFIG:
+        try:
+            gauges = job_queue_gauges()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Aviso: falha ao ler a fila de jobs para /metrics: {e}")
+    return app.response_class(app_metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
 @app.route('/api/user-info', methods=['GET'])
 @jwt_required()
 def user_info():
@@ -1417,7 +5280,7 @@ def user_info():
         if not user:
             return jsonify({'error': 'Usuário não encontrado'}), 404
         
-        usage = get_user_storage_usage(user_id)
+        usage = user.storage_used or 0
         
         return jsonify({
             'username': user.username,
@@ -1574,18 +5437,25 @@ def view_share(token):
             'mime_type': share.file.mime_type,
             'created_at': share.file.created_at,
             'can_download': share.can_download,
-            'is_streamable': is_streamable_file(share.file.mime_type)
+            'is_streamable': is_streamable_file(share.file.mime_type),
+            'version': content_version(share.file.file_hash)
         }
     else:
-        # Para pastas, listar conteúdo
-        folder_files = File.query.filter_by(folder_id=share.folder_id).all()
+        # Para pastas, listar o conteúdo de toda a subárvore (uma consulta)
+        folder_files = db.session.query(
+            File.id, File.original_name, File.file_size, File.mime_type, File.created_at, File.file_hash
+        ).filter(
+            File.folder_id.in_(folder_subtree_ids(share.folder_id))
+        ).order_by(File.folder_id, File.original_name).all()
         files_list = []
         for file in folder_files:
             files_list.append({
+                'id': file.id,
                 'name': file.original_name,
                 'size': file.file_size,
                 'mime_type': file.mime_type,
-                'created_at': file.created_at
+                'created_at': file.created_at,
+                'version': content_version(file.file_hash)
             })
         
         resource = {
@@ -1621,50 +5491,278 @@ def verify_share_password(token):
 
 # === ROTAS DE STREAMING ===
 
-@app.route('/api/stream/<int:file_id>')
-def stream_file(file_id):
-    """Stream de arquivo com suporte a link compartilhado (token) ou JWT.
-    Se query param 'token' existir, trata como token de compartilhamento.
-    Caso contrário, exige Authorization: Bearer <JWT>.
-    Suporta Range requests para mídia.
+def content_disposition(kind, filename):
+    """Content-Disposition com fallback ASCII e nome UTF-8 (RFC 6266)."""
+    from urllib.parse import quote
+    ascii_name = filename.encode('ascii', 'ignore').decode('ascii').replace('"', '') or 'arquivo'
+    if ascii_name == filename:
+        return f'{kind}; filename="{filename}"'
+    return f"{kind}; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(filename)}"
+
+def _limited_file_iter(f, length, block_size):
+    try:
+        remaining = length
+        while remaining > 0:
+            chunk = f.read(min(block_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+def file_response(path, mimetype, headers, start=0, length=None, status=200):
+    """Entrega `length` bytes do arquivo a partir de `start`.
+
+    Com `wsgi.file_wrapper` disponível (gunicorn), o arquivo posicionado em
+    `start` é entregue ao servidor, que usa os.sendfile a partir do offset atual
+    limitado pelo Content-Length (zero-copy, também para Range). Sem ele, lê
+    em blocos de FILE_SEND_BLOCK_SIZE.
     """
-    if 'NO_DB_CONFIG' in globals() and NO_DB_CONFIG:
-        return jsonify({'error': 'Sistema em modo de configuração'}), 503
+    f = open(path, 'rb')
+    if length is None:
+        length = os.fstat(f.fileno()).st_size - start
+    f.seek(start)
+    wrapper = request.environ.get('wsgi.file_wrapper')
+    body = wrapper(f, FILE_SEND_BLOCK_SIZE) if wrapper else _limited_file_iter(f, length, FILE_SEND_BLOCK_SIZE)
+    response = app.response_class(body, status=status, mimetype=mimetype, direct_passthrough=True)
+    response.headers.update(headers)
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.content_length = length
+    return response
+
+def offload_response(path, mimetype, headers):
+    """Resposta vazia com redirect interno para o proxy (nginx/Apache) enviar
+    o arquivo. Range e demais cabeçalhos da requisição original são tratados
+    pelo proxy. Retorna None se o arquivo estiver fora do storage."""
+    from urllib.parse import quote
+    relative = os.path.relpath(os.path.abspath(path), UPLOAD_FOLDER)
+    if relative.startswith('..'):
+        return None
+    response = app.response_class(status=200, mimetype=mimetype)
+    response.headers.update(headers)
+    if FILE_DELIVERY_MODE == 'x-accel':
+        response.headers['X-Accel-Redirect'] = X_ACCEL_PREFIX.rstrip('/') + '/' + quote(relative.replace(os.sep, '/'))
+    else:
+        response.headers['X-Sendfile'] = os.path.abspath(path)
+    return response
+
+def parse_byte_ranges(header, size):
+    """Interpreta um cabeçalho Range (RFC 7233) para um arquivo de `size` bytes.
+    Retorna a lista de intervalos (início, fim) inclusivos, ordenados e unidos;
+    lista vazia se nenhum intervalo for satisfazível; None se o cabeçalho for
+    inválido (e deve ser ignorado).
+    """
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not spec.strip():
+        return None
+    ranges = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, sep, last = part.partition('-')
+        first, last = first.strip(), last.strip()
+        if not sep or (first and not first.isdigit()) or (last and not last.isdigit()) or not (first or last):
+            return None
+        if not first:
+            # Sufixo: últimos N bytes
+            length = int(last)
+            if length > 0 and size > 0:
+                ranges.append((max(0, size - length), size - 1))
+            continue
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        end = int(last) if last else size - 1
+        if start < size:
+            ranges.append((start, min(end, size - 1)))
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def _evaluate_preconditions(etag, last_modified):
+    """Pré-condições da RFC 7232, na ordem da seção 6. Retorna 304/412 ou None."""
+    if_match = request.headers.get('If-Match')
+    if if_match:
+        if not parse_etags(if_match).contains(etag):
+            return 412
+    else:
+        since = parse_date(request.headers.get('If-Unmodified-Since'))
+        if since and last_modified > since:
+            return 412
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        if parse_etags(if_none_match).contains_weak(etag):
+            return 304 if request.method in ('GET', 'HEAD') else 412
+    elif request.method in ('GET', 'HEAD'):
+        since = parse_date(request.headers.get('If-Modified-Since'))
+        if since and last_modified <= since:
+            return 304
+    return None
+
+def _if_range_matches(etag, last_modified):
+    """If-Range: o Range só vale se o validador ainda for o atual (comparação forte)."""
+    value = request.headers.get('If-Range')
+    if not value:
+        return True
+    value = value.strip()
+    if value.startswith('"') or value.startswith('W/'):
+        tag, weak = unquote_etag(value)
+        return not weak and tag == etag
+    since = parse_date(value)
+    return since is not None and since == last_modified
+
+def _multipart_body(path, ranges, size, mimetype, boundary):
+    """Partes de multipart/byteranges e o tamanho total do corpo."""
+    parts = []
+    length = 0
+    for start, end in ranges:
+        head = (f"\r\n--{boundary}\r\nContent-Type: {mimetype}\r\n"
+                f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n").encode('latin-1')
+        parts.append((head, start, end - start + 1))
+        length += len(head) + end - start + 1
+    tail = f"\r\n--{boundary}--\r\n".encode('latin-1')
+    length += len(tail)
+
+    def generate():
+        with open(path, 'rb') as f:
+            for head, start, count in parts:
+                yield head
+                f.seek(start)
+                remaining = count
+                while remaining > 0:
+                    chunk = f.read(min(FILE_SEND_BLOCK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+            yield tail
+    return generate(), length
+
+def send_stored_file(path, mimetype, disposition=None, etag=None, last_modified=None):
+    """Entrega um arquivo do storage com requisições condicionais (RFC 7232:
+    ETag forte, Last-Modified, 304/412) e Range (RFC 7233: sufixos, múltiplos
+    intervalos em multipart/byteranges, If-Range e 416).
+    Em FILE_DELIVERY_MODE 'x-accel'/'x-sendfile' as pré-condições são avaliadas
+    aqui e o proxy envia os bytes (tratando o Range).
+    """
+    stat = os.stat(path)
+    size = stat.st_size
+    etag = etag or f"{int(stat.st_mtime):x}-{size:x}"
+    last_modified = (last_modified or datetime.utcfromtimestamp(stat.st_mtime)).replace(microsecond=0, tzinfo=timezone.utc)
+    headers = {
+        'ETag': quote_etag(etag),
+        'Last-Modified': http_date(last_modified),
+        'Cache-Control': 'private, no-cache'
+    }
+    if disposition:
+        headers['Content-Disposition'] = disposition
+
+    status = _evaluate_preconditions(etag, last_modified)
+    if status:
+        response = app.response_class(status=status)
+        if status == 304:
+            response.headers.update({k: v for k, v in headers.items() if k != 'Content-Disposition'})
+        return response
+
+    if FILE_DELIVERY_MODE in ('x-accel', 'x-sendfile'):
+        response = offload_response(path, mimetype, headers)
+        if response is not None:
+            return response
+
+    range_header = request.headers.get('Range')
+    if range_header and request.method in ('GET', 'HEAD') and _if_range_matches(etag, last_modified):
+        ranges = parse_byte_ranges(range_header, size)
+        if ranges is not None and len(ranges) > MAX_BYTE_RANGES:
+            ranges = None  # pedido abusivo: ignora o Range e envia tudo
+        if ranges == []:
+            response = app.response_class(status=416)
+            response.headers.update({'Content-Range': f'bytes */{size}', 'Accept-Ranges': 'bytes'})
+            return response
+        if ranges and len(ranges) == 1:
+            start, end = ranges[0]
+            headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+            return file_response(path, mimetype, headers, start=start, length=end - start + 1, status=206)
+        if ranges:
+            boundary = uuid.uuid4().hex
+            body, length = _multipart_body(path, ranges, size, mimetype, boundary)
+            response = app.response_class(body, status=206, direct_passthrough=True,
+                                          mimetype=f'multipart/byteranges; boundary={boundary}')
+            response.headers.update(headers)
+            response.headers['Accept-Ranges'] = 'bytes'
+            response.content_length = length
+            return response
+
+    return file_response(path, mimetype, headers, length=size)
+
+def resolve_access_scope():
+    """Identifica quem acessa: token de compartilhamento (?token=), JWT no
+    query param (?jwt=, para players/iframes sem header) ou Authorization.
+    Retorna (escopo, None) ou (None, resposta de erro)."""
     share_token = request.args.get('token')
     jwt_param = request.args.get('jwt')
-
-    # Resolução de permissões
-    file = None
     if share_token:
         # Acesso via compartilhamento público/privado
         share = Share.query.filter_by(token=share_token).first()
-        if not share or (share.file_id != file_id):
-            return jsonify({'error': 'Token inválido'}), 403
+        if not share:
+            return None, (jsonify({'error': 'Token inválido'}), 403)
         if share.expires_at and share.expires_at < datetime.utcnow():
-            return jsonify({'error': 'Link expirado'}), 410
-        file = share.file
-    elif jwt_param:
-        # Acesso via JWT no query param (para players/iframes sem header)
+            return None, (jsonify({'error': 'Link expirado'}), 410)
+        return ('share', share), None
+    if jwt_param:
         try:
             decoded = decode_token(jwt_param)
-            user_id = int(decoded.get('sub'))
-            file = File.query.filter_by(id=file_id, user_id=user_id).first()
-        except Exception:
-            return jsonify({'error': 'JWT inválido'}), 403
-    else:
-        # Acesso autenticado via JWT
-        try:
-            from flask_jwt_extended import verify_jwt_in_request, get_jwt_identity
-            verify_jwt_in_request()
-            user_id = int(get_jwt_identity())
-            file = File.query.filter_by(id=file_id, user_id=user_id).first()
+            return ('user', int(decoded.get('sub'))), None
         except Exception:
-            return jsonify({'error': 'Acesso negado'}), 403
+            return None, (jsonify({'error': 'JWT inválido'}), 403)
+    try:
+        from flask_jwt_extended import verify_jwt_in_request
+        verify_jwt_in_request()
+        return ('user', int(get_jwt_identity())), None
+    except Exception:
+        return None, (jsonify({'error': 'Acesso negado'}), 403)
 
+def file_access_filter(scope):
+    """Condição SQL dos arquivos visíveis no escopo. Compartilhamento de pasta
+    vale para toda a subárvore."""
+    kind, value = scope
+    if kind == 'user':
+        return File.user_id == value
+    if value.file_id:
+        return File.id == value.file_id
+    return File.folder_id.in_(folder_subtree_ids(value.folder_id))
+
+def authorize_file_access(file_id):
+    """Retorna (file, None) ou (None, resposta de erro) para stream/thumbnail."""
+    scope, error = resolve_access_scope()
+    if error:
+        return None, error
+    file = File.query.filter(File.id == file_id, file_access_filter(scope)).first()
     if not file:
-        return jsonify({'error': 'Arquivo não encontrado'}), 404
+        if scope[0] == 'share':
+            return None, (jsonify({'error': 'Token inválido'}), 403)
+        return None, (jsonify({'error': 'Arquivo não encontrado'}), 404)
     if not os.path.exists(file.file_path):
-        return jsonify({'error': 'Arquivo não existe no sistema'}), 404
+        return None, (jsonify({'error': 'Arquivo não existe no sistema'}), 404)
+    return file, None
+
+@app.route('/api/stream/<int:file_id>')
+def stream_file(file_id):
+    """Stream de arquivo com suporte a link compartilhado (token) ou JWT.
+    Se query param 'token' existir, trata como token de compartilhamento.
+    Caso contrário, exige Authorization: Bearer <JWT>.
+    Suporta Range requests para mídia.
+    """
+    if 'NO_DB_CONFIG' in globals() and NO_DB_CONFIG:
+        return jsonify({'error': 'Sistema em modo de configuração'}), 503
+    file, error = authorize_file_access(file_id)
+    if error:
+        return error
 
     # Log da atividade
     try:
@@ -1672,136 +5770,221 @@ def stream_file(file_id):
     except Exception:
         pass
 
-    # Suporte a Range requests
-    range_header = request.headers.get('Range', None)
-    if range_header:
-        byte_start = 0
-        byte_end = None
-        match = re.search(r'bytes=(\d+)-(\d*)', range_header)
-        if match:
-            byte_start = int(match.group(1))
-            if match.group(2):
-                byte_end = int(match.group(2))
-        if byte_end is None:
-            byte_end = file.file_size - 1
-
-        content_length = byte_end - byte_start + 1
-
-        def generate_range():
-            with open(file.file_path, 'rb') as f:
-                f.seek(byte_start)
-                remaining = content_length
-                while remaining > 0:
-                    chunk = f.read(min(4096, remaining))
-                    if not chunk:
-                        break
-                    remaining -= len(chunk)
-                    yield chunk
-
-        return app.response_class(
-            generate_range(),
-            status=206,
-            mimetype=file.mime_type or 'application/octet-stream',
-            headers={
-                'Content-Range': f'bytes {byte_start}-{byte_end}/{file.file_size}',
-                'Accept-Ranges': 'bytes',
-                'Content-Length': str(content_length),
-                'Content-Disposition': f'inline; filename="{file.original_name}"'
-            }
-        )
-
-    # Streaming completo (sem Range)
-    def generate():
-        with open(file.file_path, 'rb') as f:
-            while True:
-                chunk = f.read(4096)
-                if not chunk:
-                    break
-                yield chunk
-
-    return app.response_class(
-        generate(),
-        mimetype=file.mime_type or 'application/octet-stream',
-        headers={
-            'Content-Disposition': f'inline; filename="{file.original_name}"',
-            'Accept-Ranges': 'bytes',
-            'Content-Length': str(file.file_size)
-        }
+    return send_stored_file(
+        file.file_path,
+        file.mime_type or 'application/octet-stream',
+        content_disposition('inline', file.original_name),
+        etag=file.file_hash,
+        last_modified=file.updated_at
     )
 
 @app.route('/api/thumbnail/<int:file_id>')
 def get_thumbnail(file_id):
+    """Thumbnail da imagem. Query: size (64/200/800; arredonda para cima).
+    Responde WebP se o cliente aceitar. Mesmas formas de acesso do stream."""
     if 'NO_DB_CONFIG' in globals() and NO_DB_CONFIG:
         return jsonify({'error': 'Sistema em modo de configuração'}), 503
-    file = File.query.get(file_id)
+    file, error = authorize_file_access(file_id)
+    if error:
+        return error
     
-    if not file:
-        return jsonify({'error': 'Arquivo não encontrado'}), 404
+    # Thumbnail derivado do blob (hash já gravado no registro, sem reler o original)
+    if not file.file_hash:
+        file.file_hash = calculate_file_hash(file.file_path)
+        db.session.commit()
+    size = thumbnail_size_for(request.args.get('size', THUMBNAIL_DEFAULT_SIZE, type=int) or THUMBNAIL_DEFAULT_SIZE)
+    fmt = negotiate_image_format()
+    thumb_path = ensure_thumbnail(file.file_hash, file.file_path, file.mime_type, size, fmt)
     
-    # Verificar permissões (similar ao stream)
-    token = request.args.get('token')
-    if not token:
-        try:
-            from flask_jwt_extended import verify_jwt_in_request, get_jwt_identity
-            verify_jwt_in_request()
-            user_id = int(get_jwt_identity())
-            if file.user_id != user_id:
-                return jsonify({'error': 'Acesso negado'}), 403
-        except:
-            return jsonify({'error': 'Acesso negado'}), 403
-    
-    # Criar/obter thumbnail
-    thumb_path = create_thumbnail(file.file_path, file.mime_type)
-    
-    if not thumb_path or not os.path.exists(thumb_path):
+    if not thumb_path:
         # Retornar ícone padrão
         return jsonify({'error': 'Thumbnail não disponível'}), 404
     
-    return send_file(thumb_path, mimetype='image/jpeg')
+    response = send_stored_file(thumb_path, 'image/webp' if fmt == 'webp' else 'image/jpeg',
+                                etag=f"{file.file_hash}-{size}.{fmt}", last_modified=file.updated_at)
+    response.headers['Vary'] = 'Accept'
+    return response
+
+@app.route('/api/image/<int:file_id>')
+def get_resized_image(file_id):
+    """Imagem redimensionada/transcodificada. Query: w, h, fit (contain|cover),
+    q (30-95) e v (hash do conteúdo; com ele a resposta é imutável no cache do
+    navegador). WebP se o cliente aceitar. Mesmas formas de acesso do stream."""
+    if 'NO_DB_CONFIG' in globals() and NO_DB_CONFIG:
+        return jsonify({'error': 'Sistema em modo de configuração'}), 503
+    try:
+        width, height, fit, quality = parse_image_variant(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    file, error = authorize_file_access(file_id)
+    if error:
+        return error
+    if not file.mime_type or not file.mime_type.startswith('image/'):
+        return jsonify({'error': 'Arquivo não é uma imagem'}), 415
+    if not file.file_hash:
+        file.file_hash = calculate_file_hash(file.file_path)
+        db.session.commit()
+    
+    version = request.args.get('v')
+    immutable = bool(version) and file.file_hash.startswith(version) and len(version) >= 12
+    if file.mime_type in IMAGE_PASSTHROUGH_TYPES or not Image:
+        response = send_stored_file(file.file_path, file.mime_type, etag=file.file_hash, last_modified=file.updated_at)
+    else:
+        fmt = negotiate_image_format()
+        variant = f"{width}x{height}-{fit}-q{quality}.{fmt}"
+        try:
+            path = derived_cache.get_or_create(
+                'image', file.file_hash, variant,
+                lambda dest: render_resized_image(file.file_path, dest, width, height, fit, quality, fmt)
+            )
+        except Exception as e:
+            print(f"Erro ao redimensionar imagem: {e}")
+            return jsonify({'error': 'Não foi possível processar a imagem'}), 422
+        response = send_stored_file(path, 'image/webp' if fmt == 'webp' else 'image/jpeg',
+                                    etag=f"{file.file_hash}-{variant}", last_modified=file.updated_at)
+        response.headers['Vary'] = 'Accept'
+    if immutable and response.status_code in (200, 206, 304):
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return response
+
+@app.route('/api/thumbnails')
+def get_thumbnails():
+    """Thumbnails de vários arquivos em uma resposta NDJSON (uma linha por arquivo,
+    {id, mime_type, etag, data: base64} ou {id, error}), para grades de pastas.
+
+    Query: ids=1,2,3 ou folder_id (+ cursor/limit, só imagens, em ordem de id;
+    a última linha traz {next_cursor}); size como em /api/thumbnail. O acesso é
+    verificado uma vez e os registros vêm em uma única consulta."""
+    if 'NO_DB_CONFIG' in globals() and NO_DB_CONFIG:
+        return jsonify({'error': 'Sistema em modo de configuração'}), 503
+    scope, error = resolve_access_scope()
+    if error:
+        return error
+    
+    query = File.query.filter(file_access_filter(scope))
+    ids_param = request.args.get('ids')
+    folder_id = request.args.get('folder_id', type=int)
+    limit = min(THUMBNAIL_BATCH_MAX, max(1, request.args.get('limit', THUMBNAIL_BATCH_MAX, type=int)))
+    if ids_param:
+        try:
+            ids = list(dict.fromkeys(int(value) for value in ids_param.split(',') if value.strip()))
+        except ValueError:
+            return jsonify({'error': 'ids deve ser uma lista de inteiros separados por vírgula'}), 400
+        if len(ids) > THUMBNAIL_BATCH_MAX:
+            return jsonify({'error': f'Máximo de {THUMBNAIL_BATCH_MAX} ids por requisição'}), 400
+        files = {file.id: file for file in query.filter(File.id.in_(ids))}
+        rows = [files.get(file_id) or file_id for file_id in ids]
+        has_more = False
+    elif folder_id is not None:
+        query = query.filter(File.folder_id == (folder_id or None), File.mime_type.like('image/%'))
+        cursor = request.args.get('cursor')
+        if cursor:
+            try:
+                query = query.filter(File.id > decode_listing_cursor(cursor, 'id')[1])
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+        rows = query.order_by(File.id).limit(limit + 1).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+    else:
+        return jsonify({'error': 'Informe ids ou folder_id'}), 400
+    
+    size = thumbnail_size_for(request.args.get('size', THUMBNAIL_DEFAULT_SIZE, type=int) or THUMBNAIL_DEFAULT_SIZE)
+    fmt = negotiate_image_format()
+    mime_type = 'image/webp' if fmt == 'webp' else 'image/jpeg'
+    
+    def generate():
+        for file in rows:
+            if isinstance(file, int):
+                yield json.dumps({'id': file, 'error': 'Arquivo não encontrado'}) + '\n'
+                continue
+            thumb_path = None
+            if os.path.exists(file.file_path):
+                if not file.file_hash:
+                    file.file_hash = calculate_file_hash(file.file_path)
+                    db.session.commit()
+                thumb_path = ensure_thumbnail(file.file_hash, file.file_path, file.mime_type, size, fmt)
+            data = None
+            for attempt in range(2):
+                if not thumb_path:
+                    break
+                try:
+                    with open(thumb_path, 'rb') as f:
+                        data = base64.b64encode(f.read()).decode('ascii')
+                    break
+                except OSError:
+                    # Despejado do cache entre a geração e a leitura: gera de novo uma vez
+                    thumb_path = not attempt and ensure_thumbnail(file.file_hash, file.file_path, file.mime_type, size, fmt)
+            if data is None:
+                yield json.dumps({'id': file.id, 'error': 'Thumbnail não disponível'}) + '\n'
+                continue
+            yield json.dumps({'id': file.id, 'mime_type': mime_type,
+                              'etag': f"{file.file_hash}-{size}.{fmt}", 'data': data}) + '\n'
+        if folder_id is not None and not ids_param:
+            next_cursor = encode_listing_cursor('id', None, rows[-1].id) if has_more else None
+            yield json.dumps({'next_cursor': next_cursor, 'has_more': has_more}) + '\n'
+    
+    response = app.response_class(stream_with_context(generate()), mimetype='application/x-ndjson')
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.headers['Vary'] = 'Accept'
+    return response
 
 # === ROTAS DE PASTAS ===
 
 @app.route('/api/folders', methods=['GET'])
 @jwt_required()
 def list_folders():
+    """Como /api/files, com o formato de itens {type: folder|file}; mesmos
+    parâmetros de paginação (sort, order, limit, cursor) e listagem completa
+    quando nenhum deles é informado."""
     if 'NO_DB_CONFIG' in globals() and NO_DB_CONFIG:
         return jsonify({'error': 'Sistema em modo de configuração'}), 503
     user_id = int(get_jwt_identity())
     parent_id = request.args.get('parent_id', type=int)
     if parent_id == 0:
         parent_id = None
+    try:
+        sort, order, limit, after = parse_listing_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
-    folders = Folder.query.filter_by(user_id=user_id, parent_id=parent_id).all()
-    files = File.query.filter_by(user_id=user_id, folder_id=parent_id).all()
-    
-    folder_list = []
-    for folder in folders:
-        folder_list.append({
+    header = {'parent_id': parent_id, 'sort': sort, 'order': order}
+    if not after:
+        folders = db.session.query(
+            Folder.id, Folder.name, Folder.total_size, Folder.total_files, Folder.created_at, Folder.updated_at
+        ).filter_by(user_id=user_id, parent_id=parent_id).order_by(Folder.name).all()
+        header['folders'] = [{
             'id': folder.id,
             'name': folder.name,
             'type': 'folder',
+            'size': folder.total_size,
+            'file_count': folder.total_files,
             'created_at': folder.created_at.isoformat(),
             'updated_at': folder.updated_at.isoformat()
-        })
+        } for folder in folders]
+        header['total_hint'], header['total_is_exact'] = file_count_hint(user_id, parent_id)
+    
+    def fetch_page(after, size):
+        return file_listing_query(user_id, parent_id, sort, order, after).limit(size).all()
     
-    file_list = []
-    for file in files:
-        file_list.append({
+    def serialize(file):
+        return {
             'id': file.id,
             'name': file.original_name,
             'type': 'file',
             'size': file.file_size,
             'mime_type': file.mime_type,
-            'is_favorite': file.is_favorite,
+            'is_favorite': bool(file.is_favorite),
             'created_at': file.created_at.isoformat(),
             'updated_at': file.updated_at.isoformat(),
-            'is_streamable': is_streamable_file(file.mime_type)
-        })
+            'is_streamable': is_streamable_file(file.mime_type),
+            'version': content_version(file.file_hash)
+        }
     
-    return jsonify({
-        'folders': folder_list,
-        'files': file_list
-    }), 200
+    return app.response_class(
+        stream_with_context(stream_file_listing(header, fetch_page, serialize, sort, limit, after)),
+        mimetype='application/json'
+    )
 
 @app.route('/api/folders', methods=['POST'])
 @jwt_required()
@@ -1848,6 +6031,8 @@ def create_folder():
         )
         
         db.session.add(folder)
+        db.session.flush()
+        link_folder_closure(folder.id, parent_id)
         db.session.commit()
         
         # Log da atividade  
@@ -1866,34 +6051,217 @@ def create_folder():
     except Exception as e:
         return jsonify({'error': f'Erro interno: {str(e)}'}), 500
 
+@app.route('/api/folders/<int:folder_id>/stats', methods=['GET'])
+@jwt_required()
+def folder_stats(folder_id):
+    """Tamanho e contagens recursivos da pasta (totais mantidos + closure table)."""
+    if 'NO_DB_CONFIG' in globals() and NO_DB_CONFIG:
+        return jsonify({'error': 'Sistema em modo de configuração'}), 503
+    user_id = int(get_jwt_identity())
+    folder = Folder.query.filter_by(id=folder_id, user_id=user_id).first()
+    if not folder:
+        return jsonify({'error': 'Pasta não encontrada'}), 404
+    
+    folder_count, max_depth = db.session.query(
+        db.func.count(FolderClosure.descendant_id), db.func.coalesce(db.func.max(FolderClosure.depth), 0)
+    ).filter(FolderClosure.ancestor_id == folder_id, FolderClosure.depth > 0).one()
+    
+    return jsonify({
+        'folder_id': folder_id,
+        'total_size': folder.total_size,
+        'file_count': folder.total_files,
+        'folder_count': folder_count,
+        'max_depth': max_depth
+    }), 200
+
+@app.route('/api/folders/<int:folder_id>', methods=['DELETE'])
+@jwt_required()
+def delete_folder(folder_id):
+    """Exclui a pasta com toda a subárvore usando operações em conjunto
+    (IN sobre a closure table) em vez de percorrer a árvore em Python."""
+    if 'NO_DB_CONFIG' in globals() and NO_DB_CONFIG:
+        return jsonify({'error': 'Sistema em modo de configuração'}), 503
+    user_id = int(get_jwt_identity())
+    folder = Folder.query.filter_by(id=folder_id, user_id=user_id).first()
+    if not folder:
+        return jsonify({'error': 'Pasta não encontrada'}), 404
+    folder_name, folder_dir = folder.name, os.path.join(app.config['UPLOAD_FOLDER'], folder.path)
+    parent_id, removed_size, removed_files = folder.parent_id, folder.total_size, folder.total_files
+    
+    try:
+        folder_ids = [row[0] for row in db.session.execute(folder_subtree_ids(folder_id))]
+        file_ids = db.select(File.id).where(File.folder_id.in_(folder_ids))
+        
+        # Conteúdo: blobs liberados em lote (uma atualização por hash), legados removidos do disco
+        blob_refs = {}
+        legacy_paths = []
+        freed = 0
+        contents = db.session.query(File.file_path, File.file_hash, File.file_size).filter(
+            File.folder_id.in_(folder_ids)
+        ).all()
+        versions = db.session.query(FileVersion.file_path, FileVersion.file_hash).filter(
+            FileVersion.file_id.in_(file_ids)
+        ).all()
+        for row in contents:
+            freed += row.file_size or 0
+        for path, file_hash in [(r.file_path, r.file_hash) for r in contents] + [(r.file_path, r.file_hash) for r in versions]:
+            if is_blob_path(path):
+                blob_refs[file_hash] = blob_refs.get(file_hash, 0) + 1
+            else:
+                legacy_paths.append(path)
+        
+        # Dependências (evita erro de FK no MySQL)
+        for model in (Share, Comment, FileVersion):
+            model.query.filter(model.file_id.in_(file_ids)).delete(synchronize_session=False)
+        delete_execution_logs(ExecutionLog.file_id.in_(file_ids))
+        UploadSession.query.filter(UploadSession.file_id.in_(file_ids)).update({'file_id': None}, synchronize_session=False)
+        UploadSession.query.filter(UploadSession.folder_id.in_(folder_ids)).update({'folder_id': None}, synchronize_session=False)
+        Share.query.filter(Share.folder_id.in_(folder_ids)).delete(synchronize_session=False)
+        File.query.filter(File.folder_id.in_(folder_ids)).delete(synchronize_session=False)
+        FolderClosure.query.filter(FolderClosure.descendant_id.in_(folder_ids)).delete(synchronize_session=False)
+        Folder.query.filter(Folder.id.in_(folder_ids)).update({'parent_id': None}, synchronize_session=False)
+        Folder.query.filter(Folder.id.in_(folder_ids)).delete(synchronize_session=False)
+        
+        for file_hash, count in blob_refs.items():
+            release_blob(file_hash, count)
+        adjust_storage(user_id, used=-freed)
+        adjust_folder_totals(parent_id, size=-removed_size, files=-removed_files)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'Erro ao excluir pasta: {str(e)}'}), 500
+    
+    for path in legacy_paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    shutil.rmtree(folder_dir, ignore_errors=True)
+    
+    try:
+        log_activity(user_id, 'delete', 'folder', folder_id, folder_name)
+    except Exception:
+        pass
+    
+    return jsonify({
+        'message': 'Pasta excluída com sucesso',
+        'deleted_folders': len(folder_ids),
+        'freed_bytes': freed
+    }), 200
+
 # === ROTAS DE ATIVIDADES ===
 
 @app.route('/api/activities', methods=['GET'])
 @jwt_required()
 def get_activities():
+    """Feed do usuário, paginado por cursor (limit, cursor, since, until)."""
     if 'NO_DB_CONFIG' in globals() and NO_DB_CONFIG:
         return jsonify({'error': 'Sistema em modo de configuração'}), 503
     try:
         user_id = int(get_jwt_identity())
-        limit = request.args.get('limit', 50, type=int)
+        try:
+            limit, after, since, until = parse_activity_page_args()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        activities = Activity.query.filter_by(user_id=user_id).order_by(Activity.created_at.desc()).limit(limit).all()
+        query = activity_feed_query(after).filter(Activity.user_id == user_id)
+        if since:
+            query = query.filter(Activity.created_at >= since)
+        if until:
+            query = query.filter(Activity.created_at < until)
         
-        activity_list = []
-        for activity in activities:
-            activity_list.append({
+        def serialize(activity):
+            return {
                 'id': activity.id,
                 'action': activity.action,
                 'resource_type': activity.resource_type,
                 'resource_name': activity.resource_name,
                 'details': activity.details,
+                'count': activity.event_count,
                 'created_at': activity.created_at.isoformat()
-            })
+            }
         
-        return jsonify({'activities': activity_list}), 200
+        return jsonify(activity_page(query, limit, serialize)), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/admin/activities', methods=['GET'])
+@jwt_required()
+def admin_activities():
+    """Atividades de todos os usuários por período (since/until obrigatório ao
+    menos um), filtráveis por user_id e action, paginadas por cursor."""
+    if 'NO_DB_CONFIG' in globals() and NO_DB_CONFIG:
+        return jsonify({'error': 'Sistema em modo de configuração'}), 503
+    if not _require_admin():
+        return jsonify({'error': 'Acesso negado'}), 403
+    try:
+        limit, after, since, until = parse_activity_page_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not since and not until:
+        return jsonify({'error': 'Informe since e/ou until'}), 400
+    
+    query = activity_feed_query(after)
+    if since:
+        query = query.filter(Activity.created_at >= since)
+    if until:
+        query = query.filter(Activity.created_at < until)
+    if request.args.get('user_id', type=int):
+        query = query.filter(Activity.user_id == request.args.get('user_id', type=int))
+    if request.args.get('action'):
+        query = query.filter(Activity.action == request.args.get('action'))
+    
+    def serialize(activity):
+        return {
+            'id': activity.id,
+            'user_id': activity.user_id,
+            'action': activity.action,
+            'resource_type': activity.resource_type,
+            'resource_id': activity.resource_id,
+            'resource_name': activity.resource_name,
+            'ip_address': activity.ip_address,
+            'count': activity.event_count,
+            'created_at': activity.created_at.isoformat()
+        }
+    
+    return jsonify(activity_page(query, limit, serialize)), 200
+
+@app.route('/api/admin/activity-summary', methods=['GET'])
+@jwt_required()
+def admin_activity_summary():
+    """Totais diários por ação em um período: resumos arquivados + eventos
+    ainda brutos (limitados à janela de retenção)."""
+    if 'NO_DB_CONFIG' in globals() and NO_DB_CONFIG:
+        return jsonify({'error': 'Sistema em modo de configuração'}), 503
+    if not _require_admin():
+        return jsonify({'error': 'Acesso negado'}), 403
+    try:
+        since = datetime.fromisoformat(request.args['since']) if request.args.get('since') else datetime.utcnow() - timedelta(days=30)
+        until = datetime.fromisoformat(request.args['until']) if request.args.get('until') else datetime.utcnow()
+    except ValueError:
+        return jsonify({'error': 'since/until devem estar em ISO 8601'}), 400
+    user_id = request.args.get('user_id', type=int)
+    
+    totals = {}
+    rollups = db.session.query(
+        ActivityRollup.day, ActivityRollup.action, db.func.sum(ActivityRollup.event_count)
+    ).filter(ActivityRollup.day >= since.date(), ActivityRollup.day <= until.date())
+    day = db.func.date(Activity.created_at)
+    raw = db.session.query(day, Activity.action, db.func.sum(Activity.event_count)).filter(
+        Activity.created_at >= since, Activity.created_at < until
+    )
+    if user_id:
+        rollups = rollups.filter(ActivityRollup.user_id == user_id)
+        raw = raw.filter(Activity.user_id == user_id)
+    for group_day, action, count in list(rollups.group_by(ActivityRollup.day, ActivityRollup.action)) + \
+            list(raw.group_by(day, Activity.action)):
+        key = (str(group_day), action)
+        totals[key] = totals.get(key, 0) + int(count or 0)
+    
+    return jsonify({'since': since.isoformat(), 'until': until.isoformat(), 'days': [
+        {'day': key[0], 'action': key[1], 'count': count} for key, count in sorted(totals.items())
+    ]}), 200
+
 # Função para criar usuário padrão
 def create_default_user():
     """Cria usuários padrão (admin/teste) somente se não houver nenhum usuário.
@@ -1949,15 +6317,19 @@ def create_default_user():
 # sem exigir a execução manual de scripts de inicialização.
 with app.app_context():
     if not NO_DB_CONFIG:
-        db.create_all()
-        # Tenta ajustar tipos em MySQL antes de criar usuários padrão
+        # Só cria tabelas/avisa sobre migrações pendentes; ALTERs rodam via
+        # `python manage.py migrate`, uma vez por deploy
         try:
-            run_simple_migrations()
+            initialize_schema()
         except Exception as _e:
-            print(f"Aviso: migração inicial falhou: {_e}")
+            print(f"Aviso: verificação do schema falhou: {_e}")
         create_default_user()
         # Garantir que o admin existente tenha privilégio
         backfill_admin_flag()
+        # Amostragem do sistema desde o boot do processo (um amostrador por host,
+        # pelo flock em sampler.lock; os demais processos acompanham o arquivo)
+        if SYSTEM_SAMPLER_AUTOSTART:
+            system_sampler.start()
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""Benchmark da latência de execução de scripts curtos: subprocess.run com
+capture_output (implementação antiga de /api/execute) contra o runner atual
+(run_script com rlimits), partindo o interpretador na hora ou pegando um
+processo já iniciado do pool.
+
+Mede p50/p99 do tempo de parede por execução, do pedido ao fim da saída.
+Por padrão há um intervalo entre execuções (chegadas espaçadas, o caso comum);
+com --pause-ms 0 e poucos núcleos o substituto do pool disputa CPU com o
+script seguinte e a vantagem some.
+Importa o app (como manage.py): use um banco configurado ou DATABASE_URL=sqlite://.
+
+Uso:
+    python bench_execute.py [--runs 200] [--pool-size 2] [--pause-ms 200] [--languages python3,node,ruby]
+"""
+
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from app import EXECUTION_WARM_BOOTSTRAPS, InterpreterPool, OutputSpool, run_script  # noqa: E402
+
+SCRIPTS = {
+    'python3': ('curto.py', "total = sum(i * i for i in range(1000))\nprint('ok', total)\n"),
+    'node': ('curto.js', "let total = 0;\nfor (let i = 0; i < 1000; i++) total += i * i;\nconsole.log('ok', total);\n"),
+    'ruby': ('curto.rb', "total = (0...1000).sum { |i| i * i }\nputs \"ok #{total}\"\n"),
+}
+
+
+def legacy_run(command, cwd):
+    """Execução antiga: processo novo, saída toda em memória."""
+    subprocess.run(command, cwd=cwd, capture_output=True, text=True, timeout=30)
+
+
+def runner(pool):
+    def run(command, cwd):
+        spool = OutputSpool(os.path.join(cwd, 'spool'))
+        run_script(command, cwd, 30, spool, pool=pool)
+        spool.close({})
+    return run
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def measure(run, command, cwd, runs, pause):
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        run(command, cwd)
+        samples.append((time.perf_counter() - started) * 1000)
+        if pause:
+            time.sleep(pause)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=200)
+    parser.add_argument('--pool-size', type=int, default=2)
+    parser.add_argument('--pause-ms', type=int, default=200, help='Intervalo entre execuções')
+    parser.add_argument('--languages', default=','.join(SCRIPTS))
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_execute_')
+    pool = InterpreterPool(EXECUTION_WARM_BOOTSTRAPS, args.pool_size)
+    try:
+        print(f"{args.runs} execuções por caso, pool de {args.pool_size} por linguagem")
+        print(f"{'linguagem':<10} {'estratégia':<22} {'p50 ms':>8} {'p99 ms':>8} {'média ms':>9}")
+        for language in args.languages.split(','):
+            if language not in SCRIPTS or not shutil.which(language):
+                print(f"{language:<10} (não instalado)")
+                continue
+            name, source = SCRIPTS[language]
+            path = os.path.join(workdir, name)
+            with open(path, 'w') as f:
+                f.write(source)
+            command = [language, path]
+            pool.start()
+            strategies = [
+                ('subprocess.run', legacy_run),
+                ('runner (frio)', runner(None)),
+                ('runner (pool)', runner(pool)),
+            ]
+            for label, run in strategies:
+                run(command, workdir)  # aquecimento do cache de disco
+                samples = measure(run, command, workdir, args.runs, args.pause_ms / 1000)
+                print(f"{language:<10} {label:<22} {percentile(samples, 0.5):>8.1f} "
+                      f"{percentile(samples, 0.99):>8.1f} {statistics.mean(samples):>9.1f}")
+    finally:
+        pool.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
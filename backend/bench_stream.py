@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""Benchmark da entrega de arquivos: laço Python de 4 KB (implementação antiga
+de /api/stream) contra os.sendfile com offset (caminho do gunicorn via
+wsgi.file_wrapper), para resposta completa e para Range.
+
+Mede vazão e tempo de CPU da thread que envia (o worker), por GB entregue.
+
+Uso:
+    python bench_stream.py [--size-mb 512] [--block-kb 1024] [--runs 3]
+"""
+
+import argparse
+import os
+import socket
+import tempfile
+import threading
+import time
+
+
+def _drain(sock):
+    """Consome o socket como um cliente rápido (descarta os bytes)."""
+    buf = bytearray(1 << 20)
+    while sock.recv_into(buf):
+        pass
+
+
+def legacy_generator(path, start, length):
+    """Entrega antiga: gerador com leituras de 4 KB, cada uma enviada pelo servidor."""
+    def generate():
+        with open(path, 'rb') as f:
+            f.seek(start)
+            remaining = length
+            while remaining > 0:
+                chunk = f.read(min(4096, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    def send(sock):
+        for chunk in generate():
+            sock.sendall(chunk)
+    return send
+
+
+def sendfile_offset(block_size):
+    """Entrega nova: arquivo posicionado no offset e enviado com os.sendfile,
+    limitado ao Content-Length (o que o gunicorn faz com wsgi.file_wrapper)."""
+    def factory(path, start, length):
+        def send(sock):
+            with open(path, 'rb') as f:
+                sent = 0
+                while sent < length:
+                    sent += os.sendfile(sock.fileno(), f.fileno(), start + sent, min(block_size, length - sent))
+        return send
+    return factory
+
+
+def measure(factory, path, start, length):
+    server, client = socket.socketpair()
+    reader = threading.Thread(target=_drain, args=(client,))
+    reader.start()
+    send = factory(path, start, length)
+    wall = time.perf_counter()
+    cpu = time.thread_time()
+    send(server)
+    cpu = time.thread_time() - cpu
+    wall = time.perf_counter() - wall
+    server.close()
+    reader.join()
+    client.close()
+    return wall, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size-mb', type=int, default=512)
+    parser.add_argument('--block-kb', type=int, default=1024)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    size = args.size_mb * 1024 * 1024
+    fd, path = tempfile.mkstemp(prefix='bench_stream_')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            block = os.urandom(1024 * 1024)
+            for _ in range(args.size_mb):
+                f.write(block)
+
+        cases = [
+            ('completo', 0, size),
+            ('range (metade final)', size // 2, size - size // 2),
+        ]
+        strategies = [
+            ('gerador 4 KB', legacy_generator),
+            (f'sendfile {args.block_kb} KB', sendfile_offset(args.block_kb * 1024)),
+        ]
+        print(f"Arquivo: {args.size_mb} MB, {args.runs} execuções (melhor resultado)")
+        print(f"{'caso':<22} {'estratégia':<18} {'MB/s':>10} {'CPU s/GB':>10}")
+        for label, start, length in cases:
+            for name, factory in strategies:
+                best = min((measure(factory, path, start, length) for _ in range(args.runs)), key=lambda r: r[0])
+                wall, cpu = best
+                gb = length / (1024 ** 3)
+                print(f"{label:<22} {name:<18} {length / wall / 1024 ** 2:>10.0f} {cpu / gb:>10.3f}")
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,15 @@
+"""Fixtures compartilhadas pelos testes do backend."""
+
+import pytest
+
+
+@pytest.fixture
+def login():
+    """Faz login pelo cliente de teste e devolve os cabeçalhos com o token."""
+    def _login(client, username="admin", password="admin123"):
+        response = client.post(
+            "/api/login", json={"username": username, "password": password}
+        )
+        assert response.status_code == 200
+        return {"Authorization": f"Bearer {response.get_json()['access_token']}"}
+    return _login
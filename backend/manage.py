@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""Tarefas de manutenção do Chiapetta Cloud.
+
+Uso:
+    python manage.py migrate [--status] [--target N]
+    python manage.py backfill-blobs [--batch 200]
+    python manage.py reconcile-usage
+    python manage.py refresh-storage-report
+    python manage.py rebuild-folder-closure
+    python manage.py rebuild-folder-totals
+    python manage.py archive-activities [--days 90]
+    python manage.py prune-derived
+    python manage.py purge-jobs [--days 7]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+# Tarefas curtas (muitas vezes no cron, como outro usuário) não amostram o sistema
+os.environ.setdefault('SYSTEM_SAMPLER_AUTOSTART', '0')
+from app import app, db, File, FileVersion, NO_DB_CONFIG  # noqa: E402
+from app import MIGRATIONS, SchemaMigration, run_migrations  # noqa: E402
+from app import acquire_blob, adjust_folder_totals, adjust_storage, archive_activities, blob_path, calculate_file_hash, derived_cache, is_blob_path, purge_finished_jobs, rebuild_folder_closure, rebuild_folder_totals, reconcile_storage_usage, refresh_storage_report  # noqa: E402
+
+
+def backfill_blobs(batch=200):
+    """Move arquivos legados (um arquivo por registro no diretório do usuário)
+    para o store de blobs. Conteúdo repetido passa a ocupar um único blob."""
+    migrated = reclaimed = 0
+    for model in (File, FileVersion):
+        last_id = 0
+        while True:
+            rows = model.query.filter(model.id > last_id).order_by(model.id).limit(batch).all()
+            if not rows:
+                break
+            for row in rows:
+                last_id = row.id
+                if is_blob_path(row.file_path) or not os.path.exists(row.file_path):
+                    continue
+                file_hash = calculate_file_hash(row.file_path)
+                size = os.path.getsize(row.file_path)
+                if os.path.exists(blob_path(file_hash)):
+                    reclaimed += size
+                row.file_path = acquire_blob(file_hash, size, row.file_path)
+                if model is File and size != row.file_size:
+                    adjust_storage(row.user_id, used=size - row.file_size)
+                    adjust_folder_totals(row.folder_id, size=size - row.file_size)
+                row.file_hash = file_hash
+                row.file_size = size
+                db.session.commit()
+                migrated += 1
+            db.session.expunge_all()
+    print(f"Registros migrados para o store de blobs: {migrated}")
+    print(f"Espaço recuperado com deduplicação: {reclaimed} bytes")
+
+
+def migrate(status=False, target=None):
+    """Aplica (ou lista, com --status) as migrações versionadas do schema."""
+    db.create_all()
+    applied = {row.version: row for row in SchemaMigration.query.all()}
+    if status:
+        for version, description, _ in MIGRATIONS:
+            row = applied.get(version)
+            state = f"aplicada em {row.applied_at:%Y-%m-%d %H:%M} ({row.duration_ms} ms)" if row else "pendente"
+            print(f"{version:>4}  {description:<60} {state}")
+        return
+    started = time.perf_counter()
+    done = run_migrations(target=target)
+    if not done:
+        print("Schema já está na versão mais recente.")
+    else:
+        print(f"{len(done)} migração(ões) aplicada(s) em {time.perf_counter() - started:.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tarefas de manutenção do Chiapetta Cloud')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('migrate', help='Aplica as migrações versionadas do schema')
+    p.add_argument('--status', action='store_true', help='Só lista versões aplicadas/pendentes')
+    p.add_argument('--target', type=int, help='Para na versão indicada')
+
+    p = sub.add_parser('backfill-blobs', help='Migra arquivos legados para o store de blobs deduplicado')
+    p.add_argument('--batch', type=int, default=200)
+
+    sub.add_parser('reconcile-usage', help='Recalcula os contadores de uso/reserva de quota')
+    sub.add_parser('refresh-storage-report', help='Recalcula o relatório de armazenamento do admin')
+    sub.add_parser('rebuild-folder-closure', help='Reconstrói a hierarquia materializada de pastas')
+    p = sub.add_parser('archive-activities', help='Resume em activity_rollup e apaga atividades antigas')
+    p.add_argument('--days', type=int, help='Retenção em dias (padrão ACTIVITY_RETENTION_DAYS)')
+    p.add_argument('--batch', type=int, default=5000)
+    sub.add_parser('rebuild-folder-totals', help='Recalcula tamanho/arquivos agregados de todas as pastas')
+    sub.add_parser('prune-derived', help='Aplica o orçamento do cache de derivados e apaga arquivos fora do índice')
+    p = sub.add_parser('purge-jobs', help='Apaga jobs concluídos antigos da fila')
+    p.add_argument('--days', type=int, help='Retenção em dias (padrão JOB_RETENTION_DAYS)')
+
+    args = parser.parse_args()
+    if NO_DB_CONFIG:
+        print("Banco de dados não configurado. Conclua o setup antes de rodar tarefas.")
+        return 1
+
+    with app.app_context():
+        if args.command == 'migrate':
+            migrate(status=args.status, target=args.target)
+        elif args.command == 'backfill-blobs':
+            backfill_blobs(batch=args.batch)
+        elif args.command == 'reconcile-usage':
+            started = time.perf_counter()
+            reconcile_storage_usage()
+            print(f"Contadores de armazenamento recalculados em {time.perf_counter() - started:.2f}s")
+        elif args.command == 'refresh-storage-report':
+            started = time.perf_counter()
+            refresh_storage_report()
+            print(f"Relatório de armazenamento atualizado em {time.perf_counter() - started:.2f}s")
+        elif args.command == 'rebuild-folder-closure':
+            count = rebuild_folder_closure()
+            print(f"Closure de pastas reconstruída: {count} linhas")
+        elif args.command == 'archive-activities':
+            started = time.perf_counter()
+            archived, touched = archive_activities(days=args.days, batch=args.batch)
+            print(f"{archived} atividades arquivadas em {touched} resumos diários ({time.perf_counter() - started:.2f}s)")
+        elif args.command == 'rebuild-folder-totals':
+            started = time.perf_counter()
+            count = rebuild_folder_totals()
+            print(f"Totais de {count} pastas recalculados em {time.perf_counter() - started:.2f}s")
+        elif args.command == 'prune-derived':
+            freed = derived_cache.prune_untracked()
+            evicted = derived_cache.evict_if_needed()
+            print(f"Cache de derivados: {freed} bytes fora do índice removidos, {evicted} artefatos evictados")
+        elif args.command == 'purge-jobs':
+            print(f"{purge_finished_jobs(days=args.days)} job(s) concluído(s) removido(s)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
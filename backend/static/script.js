@@ -367,10 +367,17 @@ async function executeFile(fileId, filename) {
         const data = await response.json();
         
         if (response.ok) {
-            document.getElementById('execution-stdout').textContent = data.output || 'Nenhuma saída';
-            document.getElementById('execution-stderr').textContent = data.error || 'Nenhum erro';
-            document.getElementById('execution-exitcode').textContent = data.exit_code;
-            showToast('Arquivo executado com sucesso', 'success');
+            // A execução roda em background: a saída chega por polling do log (ou SSE)
+            const result = await followExecution(data.execution_id);
+            document.getElementById('execution-exitcode').textContent = result.exit_code ?? result.status;
+            if (!document.getElementById('execution-stdout').textContent) {
+                document.getElementById('execution-stdout').textContent = 'Nenhuma saída';
+            }
+            if (result.status === 'done') {
+                showToast('Arquivo executado com sucesso', 'success');
+            } else {
+                showToast('Execução não concluída: ' + result.status, 'error');
+            }
         } else {
             document.getElementById('execution-stdout').textContent = '';
             document.getElementById('execution-stderr').textContent = data.error;
@@ -385,6 +392,117 @@ async function executeFile(fileId, filename) {
     }
 }
 
+// Só o final da saída fica na tela (o log completo está no servidor)
+const EXECUTION_VIEW_LIMIT = 200 * 1024;
+// Saída ao vivo por Server-Sent Events prende uma conexão (e uma thread do
+// gunicorn) durante toda a execução; por padrão a tela consulta o log por polling
+const EXECUTION_USE_SSE = false;
+const EXECUTION_POLL_MIN = 500;
+const EXECUTION_POLL_MAX = 3000;
+
+function executionView() {
+    const stdout = document.getElementById('execution-stdout');
+    const stderr = document.getElementById('execution-stderr');
+    stdout.textContent = 'Na fila...';
+    stderr.textContent = '';
+    const view = {
+        started: false,
+        queued(position) {
+            if (!view.started) stdout.textContent = `Na fila (posição ${position || 1})...`;
+        },
+        running() {
+            if (!view.started) stdout.textContent = '';
+        },
+        append(stream, text) {
+            if (!view.started) {
+                view.started = true;
+                stdout.textContent = '';
+            }
+            const element = stream === 'out' ? stdout : stderr;
+            const content = element.textContent + text;
+            element.textContent = content.length > EXECUTION_VIEW_LIMIT ? content.slice(-EXECUTION_VIEW_LIMIT) : content;
+        },
+        finish() {
+            if (!view.started) stdout.textContent = '';
+        }
+    };
+    return view;
+}
+
+function followExecution(executionId) {
+    return EXECUTION_USE_SSE ? followExecutionStream(executionId) : pollExecution(executionId);
+}
+
+async function pollExecution(executionId) {
+    const view = executionView();
+    const headers = { 'Authorization': `Bearer ${authToken}` };
+    const getJson = async (url) => {
+        const response = await fetch(url, { headers });
+        if (!response.ok) throw new Error('Erro ao consultar execução');
+        return response.json();
+    };
+    const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+    let delay = EXECUTION_POLL_MIN;
+    let segment = 0;
+    let line = 0;
+    let settle = 0;
+    while (true) {
+        const index = await getJson(`${API_BASE_URL}/executions/${executionId}/log`);
+        let received = 0;
+        if (index.status === 'queued') {
+            const execution = await getJson(`${API_BASE_URL}/executions/${executionId}`);
+            view.queued(execution.queue_position);
+        } else {
+            view.running();
+        }
+        // Lê do ponto em que parou: o resto do segmento atual e os seguintes
+        while (segment < index.segments.length) {
+            const response = await fetch(`${API_BASE_URL}/executions/${executionId}/log/${segment}?after=${line}`, { headers });
+            if (!response.ok) throw new Error('Erro ao ler a saída');
+            const records = (await response.text()).split('\n').filter(Boolean);
+            for (const record of records) {
+                const { s, d } = JSON.parse(record);
+                view.append(s, d);
+            }
+            line += records.length;
+            received += records.length;
+            if (segment === index.segments.length - 1) break;
+            segment += 1;
+            line = 0;
+        }
+        // O status final vai ao banco pouco antes de o spool ser fechado (done.json)
+        const finished = !['queued', 'running'].includes(index.status);
+        if (index.complete || (finished && (!index.segments.length || ++settle > 3))) break;
+        delay = received ? EXECUTION_POLL_MIN : Math.min(delay * 2, EXECUTION_POLL_MAX);
+        await sleep(delay);
+    }
+    view.finish();
+    return getJson(`${API_BASE_URL}/executions/${executionId}`);
+}
+
+function followExecutionStream(executionId) {
+    const view = executionView();
+    return new Promise((resolve, reject) => {
+        const source = new EventSource(`${API_BASE_URL}/executions/${executionId}/stream?jwt=${encodeURIComponent(authToken)}`);
+        source.addEventListener('status', (e) => {
+            const status = JSON.parse(e.data);
+            if (status.status === 'queued') view.queued(status.queue_position);
+            else view.running();
+        });
+        source.addEventListener('stdout', (e) => view.append('out', JSON.parse(e.data)));
+        source.addEventListener('stderr', (e) => view.append('err', JSON.parse(e.data)));
+        source.addEventListener('end', (e) => {
+            source.close();
+            view.finish();
+            resolve(JSON.parse(e.data));
+        });
+        source.onerror = () => {
+            // Reconexão é automática (retoma do último evento); sem conexão alguma, desiste
+            if (source.readyState === EventSource.CLOSED) reject(new Error('Conexão perdida'));
+        };
+    });
+}
+
 async function deleteFile(fileId) {
     if (!confirm('Tem certeza que deseja excluir este arquivo?')) return;
     
@@ -601,16 +601,34 @@ function showSection(sectionName) {
 }
 
 // Gerenciamento de arquivos e pastas
+const FILES_PAGE_SIZE = 200;
+let filesLoadSeq = 0;
+
 async function loadFiles(folderId = 0) {
+    // Cada carregamento invalida a paginação de carregamentos anteriores
+    const loadSeq = ++filesLoadSeq;
     try {
-        const response = await makeAuthenticatedRequest(`/api/files?folder_id=${folderId}`);
+        const baseUrl = `/api/files?folder_id=${folderId}&limit=${FILES_PAGE_SIZE}`;
+        const response = await makeAuthenticatedRequest(baseUrl);
         
         if (response.ok) {
             const data = await response.json();
+            if (loadSeq !== filesLoadSeq) return;
+            // Primeira página já é exibida; as seguintes são anexadas em background
             displayFiles(data.files || []);
             displayFolders(data.folders || []);
             updateBreadcrumb(data.path || []);
             currentFolderId = folderId;
+            
+            let cursor = data.next_cursor;
+            while (cursor && loadSeq === filesLoadSeq) {
+                const pageResp = await makeAuthenticatedRequest(`${baseUrl}&cursor=${encodeURIComponent(cursor)}`);
+                if (!pageResp.ok) break;
+                const page = await pageResp.json();
+                if (loadSeq !== filesLoadSeq) return;
+                appendFiles(page.files || []);
+                cursor = page.next_cursor;
+            }
         } else {
             showNotification('Erro ao carregar arquivos', 'error');
         }
@@ -621,6 +639,14 @@ async function loadFiles(folderId = 0) {
     }
 }
 
+function appendFiles(files) {
+    const grid = document.getElementById('files-grid');
+    const fragment = document.createDocumentFragment();
+    files.forEach(file => fragment.appendChild(createFileCard(file)));
+    grid.appendChild(fragment);
+    loadGridThumbnails(files);
+}
+
 function displayFiles(files) {
     const grid = document.getElementById('files-grid');
     const emptyState = document.getElementById('empty-state');
@@ -641,6 +667,51 @@ function displayFiles(files) {
         const fileCard = createFileCard(file);
         grid.appendChild(fileCard);
     });
+    loadGridThumbnails(files);
+}
+
+// Thumbnails da grade: um pedido NDJSON por lote em vez de um por imagem
+const THUMBNAIL_BATCH_SIZE = 200;
+
+async function loadGridThumbnails(files) {
+    const ids = files
+        .filter(file => (file.mime_type || '').startsWith('image/') || isImageFile(file.filename))
+        .map(file => file.id);
+    for (let i = 0; i < ids.length; i += THUMBNAIL_BATCH_SIZE) {
+        const batch = ids.slice(i, i + THUMBNAIL_BATCH_SIZE);
+        try {
+            const response = await makeAuthenticatedRequest(
+                `/api/thumbnails?size=200&ids=${batch.join(',')}`,
+                { headers: { 'Accept': 'application/x-ndjson, image/webp' } }
+            );
+            if (!response.ok || !response.body) continue;
+            // Cada linha é aplicada assim que chega, sem esperar o lote inteiro
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            while (true) {
+                const { done, value } = await reader.read();
+                if (value) buffer += decoder.decode(value, { stream: true });
+                let newline;
+                while ((newline = buffer.indexOf('\n')) >= 0) {
+                    const line = buffer.slice(0, newline);
+                    buffer = buffer.slice(newline + 1);
+                    if (line) applyGridThumbnail(JSON.parse(line));
+                }
+                if (done) break;
+            }
+        } catch (error) {
+            // Sem thumbnail o card continua com o ícone do tipo de arquivo
+            if (error.message === 'Token expirado') return;
+        }
+    }
+}
+
+function applyGridThumbnail(tile) {
+    if (!tile.data) return;
+    const icon = document.querySelector(`.file-card[data-file-id="${tile.id}"] .file-icon`);
+    if (!icon) return;
+    icon.innerHTML = `<img class="file-thumb" src="data:${tile.mime_type};base64,${tile.data}" alt="" loading="lazy">`;
 }
 
 function displayFolders(folders) {
@@ -725,7 +796,7 @@ function createFolderCard(folder) {
         </div>
         <div class="folder-name" title="${folder.name}">${folder.name}</div>
         <div class="file-info">
-            <span>Pasta</span>
+            <span>${folder.size !== undefined ? `${formatFileSize(folder.size)} · ${folder.file_count} arq.` : 'Pasta'}</span>
             <span>${date}</span>
         </div>
     `;
@@ -878,6 +949,11 @@ async function uploadSingleFile(file, progressContainer) {
     const progressBar = progressDiv.querySelector('.progress-bar');
     const progressStatus = progressDiv.querySelector('.progress-status');
     
+    // Arquivos grandes usam sessões de upload em partes (paralelas e retomáveis)
+    if (file.size >= CHUNKED_UPLOAD_THRESHOLD) {
+        return uploadChunkedFile(file, progressBar, progressStatus);
+    }
+    
     const formData = new FormData();
     formData.append('file', file);
     if (currentFolderId > 0) {
@@ -920,6 +996,95 @@ async function uploadSingleFile(file, progressContainer) {
     }
 }
 
+// === UPLOAD EM PARTES (RESUMABLE) ===
+const CHUNKED_UPLOAD_THRESHOLD = 64 * 1024 * 1024;  // 64MB
+const CHUNKED_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024;  // 8MB
+const CHUNKED_UPLOAD_PARALLEL = 4;
+
+function chunkedUploadKey(file) {
+    return `chunked-upload:${currentFolderId}:${file.name}:${file.size}:${file.lastModified}`;
+}
+
+async function uploadChunkedFile(file, progressBar, progressStatus) {
+    const storageKey = chunkedUploadKey(file);
+    try {
+        // Retomar sessão anterior do mesmo arquivo, se ainda existir
+        let session = null;
+        const previousId = localStorage.getItem(storageKey);
+        if (previousId) {
+            const resp = await makeAuthenticatedRequest(`/api/uploads/${previousId}`);
+            if (resp.ok) {
+                session = await resp.json();
+                if (session.status !== 'active') session = null;
+            }
+        }
+        if (!session) {
+            const resp = await makeAuthenticatedRequest('/api/uploads', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({
+                    filename: file.name,
+                    size: file.size,
+                    folder_id: currentFolderId > 0 ? currentFolderId : null,
+                    chunk_size: CHUNKED_UPLOAD_CHUNK_SIZE
+                })
+            });
+            session = await resp.json();
+            if (!resp.ok) throw new Error(session.error || 'Falha ao iniciar upload');
+            localStorage.setItem(storageKey, session.upload_id);
+        }
+        
+        const received = new Set();
+        (session.received_ranges || []).forEach(([start, end]) => {
+            for (let i = start; i <= end; i++) received.add(i);
+        });
+        const pending = [];
+        for (let i = 0; i < session.total_chunks; i++) {
+            if (!received.has(i)) pending.push(i);
+        }
+        
+        let done = received.size;
+        const updateProgress = () => {
+            const percent = session.total_chunks ? Math.round((done / session.total_chunks) * 100) : 100;
+            progressBar.style.width = percent + '%';
+            progressStatus.textContent = percent + '%';
+        };
+        updateProgress();
+        
+        const worker = async () => {
+            while (pending.length > 0) {
+                const index = pending.shift();
+                const start = index * session.chunk_size;
+                const blob = file.slice(start, Math.min(start + session.chunk_size, file.size));
+                const resp = await makeAuthenticatedRequest(`/api/uploads/${session.upload_id}/chunks/${index}`, {
+                    method: 'PUT',
+                    headers: { 'Content-Type': 'application/octet-stream' },
+                    body: blob
+                });
+                if (!resp.ok) {
+                    const err = await resp.json().catch(() => ({}));
+                    throw new Error(err.error || `Falha na parte ${index}`);
+                }
+                done++;
+                updateProgress();
+            }
+        };
+        await Promise.all(Array.from({ length: CHUNKED_UPLOAD_PARALLEL }, worker));
+        
+        progressStatus.textContent = 'Finalizando...';
+        const resp = await makeAuthenticatedRequest(`/api/uploads/${session.upload_id}/complete`, { method: 'POST' });
+        const result = await resp.json();
+        if (!resp.ok) throw new Error(result.error || 'Falha ao finalizar upload');
+        
+        localStorage.removeItem(storageKey);
+        progressStatus.textContent = 'Concluído';
+        progressBar.style.backgroundColor = 'var(--accent-color)';
+    } catch (error) {
+        progressStatus.textContent = 'Erro: ' + error.message;
+        progressBar.style.backgroundColor = 'var(--danger-color)';
+    }
+}
+
 // Utilitários
 function getFileIcon(filename) {
     const ext = filename.split('.').pop().toLowerCase();
@@ -1101,6 +1266,30 @@ async function deleteFile(fileId) {
     }
 }
 
+async function deleteFolder(folderId, folderName = '') {
+    if (!confirm(`Excluir a pasta "${folderName}" e todo o seu conteúdo? Esta ação não pode ser desfeita.`)) {
+        return;
+    }
+    try {
+        const response = await makeAuthenticatedRequest(`/api/folders/${folderId}`, {
+            method: 'DELETE'
+        });
+        
+        if (response.ok) {
+            showNotification('Pasta excluída com sucesso', 'success');
+            loadFiles(currentFolderId);
+            refreshUserQuota();
+        } else {
+            const err = await response.json().catch(() => ({}));
+            showNotification('Erro ao excluir: ' + (err.error || response.statusText), 'error');
+        }
+    } catch (e) {
+        if (e.message !== 'Token expirado') {
+            showNotification('Erro de conexão: ' + e.message, 'error');
+        }
+    }
+}
+
 // Carregar outras seções
 async function loadUserInfo() {
     try {
@@ -1205,6 +1394,7 @@ async function loadSystemInfo() {
 
         if (response.ok) {
             const data = await response.json();
+            await loadSystemHistory();
             updateSystemCharts(data);
             // Boot do refresco periódico (a cada 5s)
             if (!window.__sysInfoInterval) {
@@ -1219,6 +1409,52 @@ async function loadSystemInfo() {
 // ===== Gráficos de Sistema (Chart.js) =====
 let cpuChart, memChart, diskChart;
 let cpuDataHistory = [];
+let cpuLabels = [];
+// Faixa do gráfico de CPU: '5m' acompanha ao vivo; as demais vêm do histórico
+let systemRange = '5m';
+let systemHistoryLoadedAt = 0;
+let lastSampleAt = null;
+const SYSTEM_HISTORY_POINTS = 60;
+const SYSTEM_HISTORY_REFRESH_MS = 60000;
+
+function formatSampleTime(epochSeconds) {
+    const date = new Date(epochSeconds * 1000);
+    if (systemRange === '7d') {
+        return date.toLocaleDateString([], { day: '2-digit', month: '2-digit' }) + ' ' +
+            date.toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' });
+    }
+    return date.toLocaleTimeString([], { hour: '2-digit', minute: '2-digit', second: systemRange === '5m' ? '2-digit' : undefined });
+}
+
+async function loadSystemHistory() {
+    try {
+        const response = await fetch(`/api/system-info/history?range=${systemRange}&points=${SYSTEM_HISTORY_POINTS}`, {
+            headers: { 'Authorization': `Bearer ${authToken}` }
+        });
+        if (!response.ok || !ensureCharts()) return;
+        const { series } = await response.json();
+        cpuDataHistory = series.cpu.map(value => Number(value.toFixed(1)));
+        cpuLabels = series.t.map(formatSampleTime);
+        lastSampleAt = null;
+        systemHistoryLoadedAt = Date.now();
+        cpuChart.options.scales.x.display = systemRange !== '5m';
+        renderCpuChart();
+    } catch (e) {
+        console.error('Erro ao carregar histórico do sistema:', e);
+    }
+}
+
+function changeSystemRange() {
+    const select = document.getElementById('system-range');
+    systemRange = select ? select.value : '5m';
+    loadSystemHistory();
+}
+
+function renderCpuChart() {
+    cpuChart.data.labels = cpuLabels;
+    cpuChart.data.datasets[0].data = cpuDataHistory;
+    cpuChart.update('none');
+}
 
 function ensureCharts() {
     const cpuCtx = document.getElementById('cpuChart');
@@ -1244,7 +1480,7 @@ function ensureCharts() {
                 maintainAspectRatio: false,
                 scales: {
                     y: { min: 0, max: 100, ticks: { callback: (v)=> v + '%'} },
-                    x: { display: false }
+                    x: { display: false, ticks: { maxTicksLimit: 6, maxRotation: 0 } }
                 },
                 plugins: { legend: { display: false } }
             }
@@ -1291,13 +1527,21 @@ function ensureCharts() {
 
 function updateSystemCharts(data) {
     if (!ensureCharts()) return;
-    // CPU histórico
-    cpuDataHistory.push(Number(data.cpu_usage.toFixed(1)));
-    if (cpuDataHistory.length > 60) cpuDataHistory.shift();
-    const labels = Array(cpuDataHistory.length).fill('');
-    cpuChart.data.labels = labels;
-    cpuChart.data.datasets[0].data = cpuDataHistory;
-    cpuChart.update('none');
+    // CPU ao vivo: uma amostra nova por intervalo do amostrador do servidor
+    if (systemRange === '5m' && data.sampled_at !== lastSampleAt) {
+        lastSampleAt = data.sampled_at;
+        cpuDataHistory.push(Number(data.cpu_usage.toFixed(1)));
+        cpuLabels.push(formatSampleTime(Date.parse(data.sampled_at) / 1000));
+        if (cpuDataHistory.length > SYSTEM_HISTORY_POINTS) {
+            cpuDataHistory.shift();
+            cpuLabels.shift();
+        }
+        renderCpuChart();
+    }
+    const ioStats = document.getElementById('io-stats');
+    if (ioStats && data.io) {
+        ioStats.textContent = `Disco: ${formatFileSize(data.io.read_bps)}/s leitura, ${formatFileSize(data.io.write_bps)}/s escrita | Rede: ${formatFileSize(data.io.net_recv_bps)}/s entrada, ${formatFileSize(data.io.net_sent_bps)}/s saída`;
+    }
 
     // Memória
     const memUsed = data.memory.percent;
@@ -1330,6 +1574,9 @@ async function refreshSystemCharts() {
             const data = await response.json();
             updateSystemCharts(data);
         }
+        if (systemRange !== '5m' && Date.now() - systemHistoryLoadedAt > SYSTEM_HISTORY_REFRESH_MS) {
+            await loadSystemHistory();
+        }
     } catch (e) {
         // silencioso
     }
@@ -1667,12 +1914,14 @@ async function previewImage(fileData) {
     showModal('file-preview-modal');
 
     try {
-        const url = `/api/stream/${fileData.id}?jwt=${encodeURIComponent(authToken)}`;
+        const original = `/api/stream/${fileData.id}?jwt=${encodeURIComponent(authToken)}`;
+        const url = previewImageUrl(fileData);
         // Reset zoom
         imageZoom = 1;
         body.innerHTML = `
             <div class="file-preview-content">
-                <img src="${url}" class="preview-image" alt="${fileData.filename}">
+                <img src="${url}" data-original="${original}" class="preview-image" alt="${fileData.filename}"
+                     onerror="if (this.src !== this.dataset.original) this.src = this.dataset.original">
                 <div class="image-controls">
                     <button class="btn" onclick="zoomImage(0.8)" title="Reduzir">
                         <i class="fas fa-search-minus"></i>
@@ -1862,11 +2111,24 @@ function updatePreviewInfo(fileData) {
 // Funções de controle de imagem
 let imageZoom = 1;
 
+// Versão redimensionada para a tela (WebP quando suportado); o original só é
+// baixado ao ampliar a imagem
+function previewImageUrl(fileData) {
+    const ratio = window.devicePixelRatio || 1;
+    const width = Math.ceil(window.innerWidth * ratio);
+    const height = Math.ceil(window.innerHeight * ratio);
+    const version = fileData.version ? `&v=${fileData.version}` : '';
+    return `/api/image/${fileData.id}?w=${width}&h=${height}${version}&jwt=${encodeURIComponent(authToken)}`;
+}
+
 function zoomImage(factor) {
     const img = document.querySelector('.preview-image');
     if (img) {
         imageZoom *= factor;
         img.style.transform = `scale(${imageZoom})`;
+        if (imageZoom > 1 && img.dataset.original && img.src !== img.dataset.original) {
+            img.src = img.dataset.original;
+        }
     }
 }
 
@@ -2078,7 +2340,7 @@ function moveToTrash() {
     if (ctx.type === 'file') {
         deleteFile(ctx.id);
     } else {
-        showNotification('Excluir pasta não implementado.', 'info');
+        deleteFolder(ctx.id, ctx.name);
     }
 }
 
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+"""Endpoints administrativos usando o cliente de teste do Flask."""
+
+import io
+import json
+import queue
+import subprocess
+import threading
+import time
+from datetime import datetime, timedelta
+import os
+import sys
+
+sys.path.append(os.path.dirname(__file__))
+from PIL import Image  # noqa: E402
+import app as app_module  # noqa: E402
+from app import app, db, Activity, ActivityRollup, ActivityWriter, archive_activities, HOT_PATH_INDEXES, activity_writer, MIGRATIONS, _schema_indexes, refresh_storage_report, run_migrations, schema_version  # noqa: E402
+
+
+def test_storage_report_totals_and_breakdown(login):
+    """Relatório materializado com totais, categorias e maiores arquivos."""
+    client = app.test_client()
+    headers = login(client)
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 64), (200, 30, 30)).save(buffer, "PNG")
+    content = buffer.getvalue()
+    upload = client.post(
+        "/api/upload",
+        headers=headers,
+        data={"folder_id": "0", "file": (io.BytesIO(content), "relatorio.png")},
+        content_type="multipart/form-data",
+    )
+    assert upload.status_code == 201
+    file_id = upload.get_json()["file_id"]
+
+    with app.app_context():
+        refresh_storage_report()
+
+    response = client.get(
+        "/api/admin/storage-report?sort=total_bytes&order=desc&per_page=10",
+        headers=headers,
+    )
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data["stale"] is False
+    admin = next(u for u in data["users"] if u["username"] == "admin")
+    assert admin["by_category"]["image"]["bytes"] >= len(content)
+    assert any(f["id"] == file_id for f in admin["largest_files"])
+    assert admin["total_bytes"] == sum(c["bytes"] for c in admin["by_category"].values())
+
+    # Usuário comum não acessa o relatório
+    user_headers = login(client, "teste", "teste123")
+    assert client.get("/api/admin/storage-report", headers=user_headers).status_code == 403
+
+    assert client.delete(f"/api/delete/{file_id}", headers=headers).status_code == 200
+
+
+def test_migrations_recorded_and_idempotent():
+    """Banco novo nasce na última versão; passos reexecutados não falham e os
+    backfills (SQL fixo da versão) batem com os contadores mantidos pelo app."""
+    with app.app_context():
+        assert schema_version() == MIGRATIONS[-1][0]
+        assert run_migrations() == []
+        counters = sorted(db.session.query(app_module.User.id, app_module.User.storage_used, app_module.User.storage_reserved))
+        totals = sorted(db.session.query(app_module.Folder.id, app_module.Folder.total_size, app_module.Folder.total_files))
+        closure = db.session.query(app_module.FolderClosure).count()
+        with db.engine.connect() as conn:
+            for _, _, step in MIGRATIONS:
+                step(conn)
+                conn.commit()
+            for name, table, _ in HOT_PATH_INDEXES:
+                assert name in _schema_indexes(conn, table)
+        db.session.expire_all()
+        assert sorted(db.session.query(app_module.User.id, app_module.User.storage_used, app_module.User.storage_reserved)) == counters
+        assert sorted(db.session.query(app_module.Folder.id, app_module.Folder.total_size, app_module.Folder.total_files)) == totals
+        assert db.session.query(app_module.FolderClosure).count() == closure
+
+
+def test_activity_writer_coalesces_stream_events(login):
+    """Ranges repetidos do mesmo stream viram uma linha com contador."""
+    client = app.test_client()
+    headers = login(client)
+    response = client.post(
+        "/api/upload",
+        headers=headers,
+        data={"file": (io.BytesIO(b"0123456789" * 100), "scrub.bin")},
+        content_type="multipart/form-data",
+    )
+    file_id = response.get_json()["file_id"]
+    for start in range(0, 500, 100):
+        ranged = client.get(f"/api/stream/{file_id}", headers={**headers, "Range": f"bytes={start}-{start + 99}"})
+        assert ranged.status_code == 206
+    activity_writer.flush()
+    for start in range(0, 300, 100):
+        client.get(f"/api/stream/{file_id}", headers={**headers, "Range": f"bytes={start}-{start + 99}"})
+    activity_writer.flush()
+
+    with app.app_context():
+        streams = Activity.query.filter_by(action="stream", resource_id=file_id, resource_name="scrub.bin").all()
+        assert [a.event_count for a in streams] == [8]
+        assert Activity.query.filter_by(action="upload", resource_id=file_id, resource_name="scrub.bin").count() == 1
+
+    stats = client.get("/api/admin/activity-writer", headers=headers).get_json()
+    assert stats["coalesced"] >= 7 and stats["dropped"] == 0
+    assert client.delete(f"/api/delete/{file_id}", headers=headers).status_code == 200
+
+
+def test_activity_writer_drops_when_full():
+    """Fila cheia descarta e conta, sem bloquear quem registra."""
+    writer = ActivityWriter(max_queue=1, flush_events=10, flush_interval=60, coalesce_window=timedelta(minutes=5))
+    writer._ensure_started = lambda: None  # sem thread consumindo: a fila só enche
+    writer._queue = queue.Queue(maxsize=1)
+    writer._queue.put_nowait({"placeholder": True})
+    assert writer.submit({"user_id": 1, "created_at": datetime.utcnow()}) is False
+    assert writer.stats["dropped"] == 1
+
+    # Contadores sob trava: submissões concorrentes não se perdem
+    def submit_many():
+        for _ in range(2000):
+            writer.submit({"user_id": 1, "created_at": datetime.utcnow()})
+
+    threads = [threading.Thread(target=submit_many) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert writer.stats_snapshot()["dropped"] == 8001
+
+
+def test_activity_retention_rollup_and_feed(login):
+    """Eventos antigos viram resumos diários; feed e consulta admin por cursor."""
+    client = app.test_client()
+    headers = login(client)
+    old = datetime.utcnow() - timedelta(days=200)
+    with app.app_context():
+        for i in range(3):
+            db.session.add(Activity(user_id=2, action="download", resource_type="file", resource_id=99,
+                                    resource_name="antigo.txt", event_count=2, created_at=old + timedelta(minutes=i)))
+        for i in range(5):
+            db.session.add(Activity(user_id=1, action="feed", resource_type="file", resource_id=i,
+                                    resource_name=f"f{i}.txt", created_at=datetime.utcnow() - timedelta(seconds=i)))
+        db.session.commit()
+        assert archive_activities(days=90, batch=2) == (3, 2)
+        assert Activity.query.filter(Activity.created_at < datetime.utcnow() - timedelta(days=90)).count() == 0
+        rollup = ActivityRollup.query.filter_by(user_id=2, action="download").one()
+        assert rollup.event_count == 6 and rollup.day == old.date()
+
+    seen = []
+    url = "/api/activities?limit=2"
+    while url:
+        page = client.get(url, headers=headers).get_json()
+        seen.extend(a["resource_name"] for a in page["activities"] if a["action"] == "feed")
+        url = f"/api/activities?limit=2&cursor={page['next_cursor']}" if page["next_cursor"] else None
+    assert seen == [f"f{i}.txt" for i in range(5)]
+
+    since = (old - timedelta(days=1)).isoformat()
+    summary = client.get(f"/api/admin/activity-summary?since={since}&user_id=2", headers=headers).get_json()
+    assert summary["days"] == [{"day": old.date().isoformat(), "action": "download", "count": 6}]
+
+    recent = client.get(f"/api/admin/activities?since={since}&action=feed&limit=3", headers=headers).get_json()
+    assert len(recent["activities"]) == 3 and recent["next_cursor"]
+    assert client.get("/api/admin/activities", headers=headers).status_code == 400
+
+
+def test_system_sampler_ring_file_and_history(monkeypatch, tmp_path):
+    """Um amostrador grava; outro processo acompanha o arquivo; o histórico é
+    reduzido e vem do disco quando o buffer em memória não cobre o intervalo."""
+    samples = iter(range(100))
+
+    def fake_sample():
+        index = next(samples)
+        return (1000.0 + 5 * index, float(index), 50.0, 8e9, 4e9, 10.0, 1e12, 1e11, 9e11, 0, 0, 0, index * 10.0)
+
+    leader = app_module.SystemSampler(str(tmp_path), 5, memory_samples=4, disk_samples=16)
+    follower = app_module.SystemSampler(str(tmp_path), 5, memory_samples=4, disk_samples=16)
+    monkeypatch.setattr(leader, "sample", fake_sample)
+    monkeypatch.setattr(follower, "sample", lambda: (_ for _ in ()).throw(AssertionError("não deve amostrar")))
+
+    for _ in range(20):
+        leader.tick()
+    follower.tick()
+    assert leader.leader and not follower.leader
+    assert len(leader.ring) == 4 and leader.latest()["cpu"] == 19.0
+    assert follower.latest() == leader.latest() and follower.ring.last_seq == 19
+
+    # Buffer circular: só as 4 últimas em memória; o arquivo guarda 16 (seq 4..19)
+    assert [row[1] for row in leader.ring.rows(0, 10 ** 6)] == [16.0, 17.0, 18.0, 19.0]
+    recent = follower.history(1080.0, 1095.0, 2)
+    assert recent["series"]["cpu"] == [16.5, 18.5] and recent["series"]["cpu_max"] == [17.0, 19.0]
+    older = follower.history(1000.0, 1100.0, 10)
+    assert older["series"]["t"][0] == 1020.0  # seq 0..3 já foram sobrescritas
+    assert sum(1 for _ in older["series"]["cpu"]) == 8 and older["series"]["net_recv_bps"][0] == 45.0
+
+    # Amostrador sai: o outro processo assume e continua a sequência
+    leader._lock_file.close()
+    monkeypatch.setattr(follower, "sample", fake_sample)
+    follower.tick()
+    assert follower.leader and follower.ring.last_seq == 20
+
+
+def test_system_info_answers_from_latest_sample(monkeypatch, tmp_path, login):
+    """/api/system-info não mede nada na requisição; o histórico aceita faixas."""
+    def blocking(*args, **kwargs):
+        raise AssertionError("cpu_percent bloqueante não deve ser chamado")
+    monkeypatch.setattr(app_module.psutil, "cpu_percent", blocking)
+    # A amostragem começa no boot do processo, antes de qualquer requisição
+    assert app_module.system_sampler._thread.is_alive()
+    # Sem amostras, a leitura mede na hora sem mexer na referência do amostrador
+    idle = app_module.SystemSampler(str(tmp_path), 5, memory_samples=4, disk_samples=16)
+    assert idle.latest()["mem_total"] > 0 and idle._previous is None
+    client = app.test_client()
+    headers = login(client)
+
+    started = time.perf_counter()
+    response = client.get("/api/system-info", headers=headers)
+    data = response.get_json()
+    assert response.status_code == 200 and 0 <= data["cpu_usage"] <= 100
+    assert data["memory"]["total"] > 0 and data["disk"]["total"] > 0 and "read_bps" in data["io"]
+    again = client.get("/api/system-info", headers=headers)
+    assert time.perf_counter() - started < 1 and again.get_json()["sampled_at"]
+
+    history = client.get("/api/system-info/history?range=15m&points=30", headers=headers).get_json()
+    assert history["step"] == 30 and len(history["series"]["t"]) >= 1
+    assert client.get("/api/system-info/history?range=2y", headers=headers).status_code == 400
+    assert client.get("/api/system-info/history?since=ontem", headers=headers).status_code == 400
+
+
+def test_metrics_registry_aggregates_processes(tmp_path):
+    """Snapshots de outros processos somam no /metrics; os de processos
+    encerrados vão para o arquivo e continuam contando uma única vez."""
+    registry = app_module.MetricsRegistry(str(tmp_path), flush_interval=3600)
+    registry.counter("teste_requisicoes_total", "Requisições.")
+    registry.histogram("teste_latencia_seconds", "Latência.", (0.1, 1))
+    registry.inc("teste_requisicoes_total", rota="/a")
+    registry.observe("teste_latencia_seconds", 0.05, rota="/a")
+    registry.observe("teste_latencia_seconds", 3, rota="/a")
+
+    def snapshot(proc, count):
+        started = app_module.psutil.Process(proc.pid).create_time()
+        values = [["teste_requisicoes_total", [["rota", "/a"]], count],
+                  ["teste_latencia_seconds", [["rota", "/a"]], [0, count, 0.5 * count, count]]]
+        (tmp_path / f"{proc.pid}.json").write_text(
+            json.dumps({"pid": proc.pid, "started_at": started, "values": values}))
+
+    alive = subprocess.Popen(["sleep", "30"])
+    finished = subprocess.Popen(["sleep", "30"])
+    try:
+        snapshot(alive, 5)
+        snapshot(finished, 7)
+        (tmp_path / f"{finished.pid}.json.tmp").write_text("{")
+        finished.kill()
+        finished.wait()
+
+        text = registry.render([("teste_fila", "Fila.", [({"tipo": "x"}, 2)])])
+        assert 'teste_requisicoes_total{rota="/a"} 13' in text
+        assert 'teste_latencia_seconds_bucket{rota="/a",le="0.1"} 1' in text
+        assert 'teste_latencia_seconds_bucket{rota="/a",le="1"} 13' in text
+        assert 'teste_latencia_seconds_bucket{rota="/a",le="+Inf"} 14' in text
+        assert 'teste_latencia_seconds_count{rota="/a"} 14' in text
+        assert "# TYPE teste_fila gauge" in text and 'teste_fila{tipo="x"} 2' in text
+        assert not (tmp_path / f"{finished.pid}.json").exists() and (tmp_path / "archive.json").exists()
+        assert not (tmp_path / f"{finished.pid}.json.tmp").exists()
+        assert 'teste_requisicoes_total{rota="/a"} 13' in registry.render()
+    finally:
+        alive.kill()
+        alive.wait()
+    registry.inc("teste_requisicoes_total", rota="/a")
+    assert 'teste_requisicoes_total{rota="/a"} 14' in registry.render()
+    registry.flush()
+    assert json.loads((tmp_path / f"{app_module.os.getpid()}.json").read_text())["values"]
+
+
+def test_metrics_endpoint_instruments_routes(monkeypatch, login):
+    """/metrics expõe latência por rota, consultas SQL, bytes entregues e
+    recebidos, cache de derivados, pool do banco e fila de jobs."""
+    client = app.test_client()
+    headers = login(client)
+    buffer = io.BytesIO()
+    Image.new("RGB", (300, 200), (20, 90, 200)).save(buffer, "JPEG")
+    upload = client.post("/api/upload", headers=headers,
+                         data={"file": (io.BytesIO(buffer.getvalue()), "metricas.jpg")},
+                         content_type="multipart/form-data")
+    file_id = upload.get_json()["file_id"]
+    assert client.get("/api/files", headers=headers).status_code == 200
+    download = client.get(f"/api/download/{file_id}", headers=headers)
+    for _ in range(2):
+        assert client.get(f"/api/thumbnail/{file_id}?size=64", headers=headers).status_code == 200
+
+    text = client.get("/metrics").data.decode()
+    assert 'chiapetta_http_requests_total{method="GET",route="/api/files",status="200"}' in text
+    assert 'chiapetta_http_request_duration_seconds_bucket{method="GET",route="/api/files",le="+Inf"}' in text
+    assert 'chiapetta_http_request_sql_queries_count{route="/api/files"}' in text
+    assert 'chiapetta_streamed_bytes_total{endpoint="download_file",status="200"}' in text
+    assert len(download.data) <= _metric(text, 'chiapetta_streamed_bytes_total{endpoint="download_file",status="200"}')
+    assert _metric(text, 'chiapetta_upload_bytes_total{endpoint="upload_file"}') >= len(buffer.getvalue())
+    assert _metric(text, 'chiapetta_derived_cache_lookups_total{kind="thumb",result="hit"}') >= 1
+    assert _metric(text, "chiapetta_db_pool_checkout_seconds_count") > 0
+    assert "# TYPE chiapetta_job_queue_depth gauge" in text
+
+    # Sem token: só conexões diretas do próprio host
+    assert client.get("/metrics", environ_base={"REMOTE_ADDR": "10.0.0.5"}).status_code == 403
+    assert client.get("/metrics", headers={"X-Forwarded-For": "203.0.113.9"}).status_code == 403
+
+    monkeypatch.setattr(app_module, "METRICS_TOKEN", "segredo")
+    assert client.get("/metrics").status_code == 403
+    assert client.get("/metrics", headers={"Authorization": "Bearer segredo"}).status_code == 200
+    assert client.delete(f"/api/delete/{file_id}", headers=headers).status_code == 200
+
+
+def _metric(text, series):
+    """Valor de uma série na exposição em texto."""
+    for line in text.splitlines():
+        if line.startswith(series + " "):
+            return float(line.rsplit(" ", 1)[1])
+    raise AssertionError(f"série ausente: {series}")
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+"""Fila de jobs em background usando o cliente de teste do Flask."""
+
+import gzip
+import io
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.dirname(__file__))
+from PIL import Image  # noqa: E402
+import app as app_module  # noqa: E402
+from app import app, db, Job, claim_jobs, enqueue_job, job_handler, work_once  # noqa: E402
+
+
+def test_upload_enqueues_enrichment_job(login):
+    """Upload grava o job na mesma transação; o worker gera thumbnails e EXIF."""
+    client = app.test_client()
+    headers = login(client)
+    buffer = io.BytesIO()
+    exif = Image.Exif()
+    exif[0x0110] = "Camera Teste"
+    Image.new("RGB", (900, 600), (20, 40, 200)).save(buffer, "JPEG", exif=exif)
+    upload = client.post(
+        "/api/upload",
+        headers=headers,
+        data={"file": (io.BytesIO(buffer.getvalue()), "enriquecer.jpg")},
+        content_type="multipart/form-data",
+    )
+    assert upload.status_code == 201
+    file_id = upload.get_json()["file_id"]
+
+    with app.app_context():
+        job = Job.query.filter_by(kind="enrich_file", payload=json.dumps({"file_id": file_id})).order_by(Job.id.desc()).first()
+        assert job.status == "queued"
+        job.run_after = datetime.utcnow() - timedelta(days=365)  # na frente de jobs de outros testes
+        db.session.commit()
+        assert work_once("teste:1", kinds=["enrich_file"], batch=1) == 1
+
+        job = db.session.get(Job, job.id)
+        assert job.status == "done" and job.attempts == 1
+        assert json.loads(job.result)["thumbnails"] == list(app_module.THUMBNAIL_SIZES)
+        file = db.session.get(app_module.File, file_id)
+        info = json.loads(file.media_info)
+        assert info["width"] == 900 and info["camera_model"] == "Camera Teste"
+        assert os.path.exists(app_module.thumbnail_path(file.file_hash, 200, "jpg"))
+
+    stats = client.get("/api/admin/jobs", headers=headers).get_json()
+    assert stats["completed"] >= 1 and stats["run_seconds"]["max"] >= 0
+    assert client.delete(f"/api/delete/{file_id}", headers=headers).status_code == 200
+
+
+def test_retry_backoff_permanent_failure_and_lease():
+    """Falha temporária volta para a fila com backoff; permanente vai para failed;
+    job preso em running com lease vencido é retomado."""
+    calls = []
+
+    @job_handler("teste_instavel")
+    def flaky(payload, job):
+        calls.append(job.attempts)
+        if len(calls) == 1:
+            raise RuntimeError("indisponível")
+        return {"ok": True}
+
+    @job_handler("teste_quebrado")
+    def broken(payload, job):
+        raise app_module.PermanentJobError("entrada inválida")
+
+    with app.app_context():
+        flaky_job = enqueue_job("teste_instavel", {"n": 1})
+        broken_job = enqueue_job("teste_quebrado")
+        unknown_job = enqueue_job("teste_inexistente")
+        db.session.commit()
+        kinds = ["teste_instavel", "teste_quebrado", "teste_inexistente"]
+        assert work_once("teste:1", kinds=kinds, batch=10) == 3
+
+        flaky_job = db.session.get(Job, flaky_job.id)
+        assert flaky_job.status == "queued" and "indisponível" in flaky_job.last_error
+        assert flaky_job.run_after > datetime.utcnow() + timedelta(seconds=4)
+        assert db.session.get(Job, broken_job.id).status == "failed"
+        assert "desconhecido" in db.session.get(Job, unknown_job.id).last_error
+
+        # Ainda em backoff: ninguém pega
+        assert claim_jobs("teste:2", kinds=kinds) == []
+        flaky_job.run_after = datetime.utcnow()
+        db.session.commit()
+        assert work_once("teste:1", kinds=kinds) == 1
+        assert db.session.get(Job, flaky_job.id).status == "done" and calls == [1, 2]
+
+        stuck = enqueue_job("teste_instavel")
+        db.session.commit()
+        assert [job.id for job in claim_jobs("teste:morto", kinds=kinds)] == [stuck.id]
+        assert claim_jobs("teste:2", kinds=kinds) == []
+        Job.query.filter_by(id=stuck.id).update({"locked_at": datetime.utcnow() - timedelta(hours=1)})
+        db.session.commit()
+        reclaimed = claim_jobs("teste:2", kinds=kinds)
+        assert [job.id for job in reclaimed] == [stuck.id] and reclaimed[0].attempts == 2
+        assert app_module.run_job(reclaimed[0], "teste:2") == "done"
+
+
+def _upload_script(client, headers, name, source):
+    response = client.post(
+        "/api/upload",
+        headers=headers,
+        data={"file": (io.BytesIO(source.encode()), name)},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 201
+    return response.get_json()["file_id"]
+
+
+def test_execution_runs_as_job_with_metrics(monkeypatch, login):
+    """/api/execute responde 202 na hora; o worker grava saída, espera, tempo e memória."""
+    client = app.test_client()
+    headers = login(client)
+    file_id = _upload_script(client, headers, "memoria.py",
+                             "import sys\nbuf = bytearray(30 * 1024 * 1024)\nprint('ok', len(buf))\n"
+                             "print('aviso', file=sys.stderr)\n")
+    slow_id = _upload_script(client, headers, "lento.py", "import time\ntime.sleep(10)\n")
+
+    submitted = client.post(f"/api/execute/{file_id}", headers=headers)
+    assert submitted.status_code == 202
+    execution_id = submitted.get_json()["execution_id"]
+    status = client.get(f"/api/executions/{execution_id}", headers=headers).get_json()
+    assert status["status"] == "queued" and status["queue_position"] >= 1
+
+    with app.app_context():
+        assert work_once("teste:1", kinds=["execute"]) == 1
+    result = client.get(f"/api/executions/{execution_id}", headers=headers).get_json()
+    assert result["status"] == "done" and result["exit_code"] == 0
+    assert result["output"].startswith("ok 31457280") and "aviso" in result["error"]
+    assert result["queue_wait_ms"] >= 0 and result["run_ms"] > 0
+    assert result["peak_memory_kb"] > 30 * 1024
+
+    monkeypatch.setattr(app_module, "EXECUTION_TIMEOUT", 1)
+    slow = client.post(f"/api/execute/{slow_id}", headers=headers).get_json()
+    with app.app_context():
+        assert work_once("teste:1", kinds=["execute"]) == 1
+    result = client.get(f"/api/executions/{slow['execution_id']}", headers=headers).get_json()
+    assert result["status"] == "timeout" and result["run_ms"] < 5000
+
+    other = login(client, "teste", "teste123")
+    assert client.get(f"/api/executions/{execution_id}", headers=other).status_code == 404
+    for deleted in (file_id, slow_id):
+        assert client.delete(f"/api/delete/{deleted}", headers=headers).status_code == 200
+
+
+def test_execution_fair_queuing_and_caps(monkeypatch, login):
+    """Um usuário com muitas execuções não bloqueia os outros; limites por usuário e global."""
+    monkeypatch.setitem(app_module.JOB_CONCURRENCY_LIMITS, "execute", (2, 1))
+    client = app.test_client()
+    admin = login(client)
+    user = login(client, "teste", "teste123")
+    admin_file = _upload_script(client, admin, "fila_admin.py", "print('admin')\n")
+    user_file = _upload_script(client, user, "fila_user.py", "print('user')\n")
+
+    admin_runs = [client.post(f"/api/execute/{admin_file}", headers=admin).get_json()["job_id"] for _ in range(3)]
+    user_run = client.post(f"/api/execute/{user_file}", headers=user).get_json()["job_id"]
+
+    with app.app_context():
+        # Um job por reserva, mesmo com limit maior; o segundo usuário passa na
+        # frente dos outros jobs do admin
+        first = claim_jobs("teste:1", kinds=["execute"], limit=5)
+        assert [job.id for job in first] == [admin_runs[0]]
+        second = claim_jobs("teste:2", kinds=["execute"], limit=5)
+        assert [job.id for job in second] == [user_run]
+        # Limite global (2) atingido pelos jobs reservados
+        assert claim_jobs("teste:3", kinds=["execute"], limit=5) == []
+        for job in first + second:
+            app_module.run_job(job, job.locked_by)
+        third = claim_jobs("teste:1", kinds=["execute"], limit=5)
+        assert [job.id for job in third] == [admin_runs[1]]
+        # Limite por usuário (1): o admin já tem um job em execução
+        assert claim_jobs("teste:2", kinds=["execute"], limit=5) == []
+        app_module.run_job(third[0], "teste:1")
+        assert work_once("teste:1", kinds=["execute"]) == 1
+
+    assert client.delete(f"/api/delete/{admin_file}", headers=admin).status_code == 200
+    assert client.delete(f"/api/delete/{user_file}", headers=user).status_code == 200
+
+
+def test_execution_output_spool_segments_and_cap(monkeypatch, login):
+    """Saída grande vai comprimida para segmentos; o banco guarda só o final;
+    passando do limite o processo é encerrado."""
+    client = app.test_client()
+    headers = login(client)
+    chatty = _upload_script(client, headers, "verboso.py",
+                            "import sys\nfor i in range(20000):\n    print(f'linha {i:05d} ' + 'x' * 40)\n"
+                            "print('erro final', file=sys.stderr)\n")
+    endless = _upload_script(client, headers, "infinito.py", "while True:\n    print('y' * 1000)\n")
+
+    execution_id = client.post(f"/api/execute/{chatty}", headers=headers).get_json()["execution_id"]
+    with app.app_context():
+        assert work_once("teste:1", kinds=["execute"]) == 1
+    result = client.get(f"/api/executions/{execution_id}", headers=headers).get_json()
+    assert result["status"] == "done" and result["log_bytes"] == 20000 * 53 + len("erro final\n")
+    assert result["output"].startswith("[...]") and result["output"].endswith("linha 19999 " + "x" * 40 + "\n")
+    assert len(result["output"]) < 70 * 1024 and "erro final" in result["error"]
+
+    index = client.get(f"/api/executions/{execution_id}/log", headers=headers).get_json()
+    assert index["complete"] and len(index["segments"]) == result["log_segments"] > 1
+    raw = client.get(index["segments"][0]["url"], headers={**headers, "Accept-Encoding": "gzip"})
+    assert raw.headers["Content-Encoding"] == "gzip"
+    first = [json.loads(line) for line in gzip.decompress(raw.data).decode().splitlines()]
+    assert first[0] == {"s": "out", "d": first[0]["d"]} and first[0]["d"].startswith("linha 00000")
+    plain = client.get(index["segments"][-1]["url"], headers=headers)
+    assert "Content-Encoding" not in plain.headers
+    records = [json.loads(line) for line in plain.data.decode().splitlines()]
+    assert records[-1] == {"s": "err", "d": "erro final\n"}
+    # Polling: ?after=N devolve só as linhas novas (sem gzip, mesmo se aceito)
+    tail = client.get(index["segments"][-1]["url"] + f"?after={len(records) - 1}",
+                      headers={**headers, "Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in tail.headers
+    assert [json.loads(line) for line in tail.data.decode().splitlines()] == records[-1:]
+
+    monkeypatch.setattr(app_module, "EXECUTION_OUTPUT_LIMIT", 200 * 1024)
+    capped_id = client.post(f"/api/execute/{endless}", headers=headers).get_json()["execution_id"]
+    with app.app_context():
+        assert work_once("teste:1", kinds=["execute"]) == 1
+    capped = client.get(f"/api/executions/{capped_id}", headers=headers).get_json()
+    assert capped["status"] == "output_limit" and capped["output_truncated"]
+    assert capped["log_bytes"] == 200 * 1024 and capped["run_ms"] < 10000
+
+    with app.app_context():
+        log_dir = app_module.execution_log_dir(execution_id)
+    assert os.path.isdir(log_dir)
+    for file_id in (chatty, endless):
+        assert client.delete(f"/api/delete/{file_id}", headers=headers).status_code == 200
+    assert not os.path.exists(log_dir)
+
+
+def _sse_events(response):
+    """Eventos SSE (id, event, data) de uma resposta em streaming."""
+    buffer = ""
+    for chunk in response.response:
+        buffer += chunk.decode() if isinstance(chunk, bytes) else chunk
+        while "\n\n" in buffer:
+            block, buffer = buffer.split("\n\n", 1)
+            fields = dict(line.split(": ", 1) for line in block.splitlines() if ": " in line and not line.startswith(":"))
+            if "event" in fields:
+                yield fields.get("id"), fields["event"], json.loads(fields["data"])
+
+
+def test_execution_output_streams_live(tmp_path, login):
+    """stdout chega ao cliente enquanto o processo ainda roda; Last-Event-ID retoma."""
+    client = app.test_client()
+    headers = login(client)
+    flag = tmp_path / "continuar"
+    script = _upload_script(client, headers, "ao_vivo.py",
+                            "import os, sys, time\nprint('inicio', flush=True)\n"
+                            f"for _ in range(200):\n    if os.path.exists({str(flag)!r}):\n        break\n    time.sleep(0.05)\n"
+                            "print('fim')\nprint('aviso', file=sys.stderr)\n")
+    execution_id = client.post(f"/api/execute/{script}", headers=headers).get_json()["execution_id"]
+
+    def run_worker():
+        with app.app_context():
+            work_once("teste:1", kinds=["execute"])
+    worker = threading.Thread(target=run_worker)
+    worker.start()
+
+    token = headers["Authorization"].split()[1]
+    stream = client.get(f"/api/executions/{execution_id}/stream?jwt={token}", buffered=False)
+    assert stream.mimetype == "text/event-stream"
+    seen = []
+    text = {"stdout": "", "stderr": ""}
+    started = time.monotonic()
+    for event_id, event, data in _sse_events(stream):
+        seen.append((event_id, event, data))
+        if event in text:
+            text[event] += data
+        if text["stdout"] == "inicio\n" and not flag.exists():
+            # Processo ainda esperando o sinal: a saída chegou ao vivo
+            flag.write_text("ok")
+        if event == "end":
+            break
+    stream.close()
+    worker.join()
+    assert time.monotonic() - started < 8
+    assert text == {"stdout": "inicio\nfim\n", "stderr": "aviso\n"}
+    assert seen[-1][1] == "end" and seen[-1][2]["status"] == "done" and seen[-1][2]["exit_code"] == 0
+
+    outputs = [(event_id, data) for event_id, event, data in seen if event in text]
+    resumed = client.get(f"/api/executions/{execution_id}/stream?jwt={token}",
+                         headers={"Last-Event-ID": outputs[0][0]}, buffered=False)
+    replay = [data for _, event, data in _sse_events(resumed) if event in text]
+    assert replay == [data for _, data in outputs[1:]]
+    assert client.delete(f"/api/delete/{script}", headers=headers).status_code == 200
+
+
+def test_warm_interpreter_pool_and_resource_limits(monkeypatch, tmp_path):
+    """Interpretador pré-iniciado roda o script como programa principal; CPU,
+    memória e tamanho de arquivo são limitados por rlimit."""
+    workdir = tmp_path / "trabalho"
+    workdir.mkdir()
+    (workdir / "vizinho.py").write_text("VALOR = 42\n")
+    # Conteúdo no blob (sem extensão, fora da pasta); o script enxerga o caminho lógico
+    blob = tmp_path / "blob" / ("ab" * 32)
+    blob.parent.mkdir()
+    blob.write_text("import os, sys, vizinho\n"
+                    "print(__name__, __file__, sys.argv[0], os.getcwd(), vizinho.VALOR, repr(sys.stdin.read()))\n"
+                    "sys.exit(3)\n")
+    script = workdir / "principal.py"
+
+    def run(path, name, pool=None, timeout=10, interpreter="python3", logical=None):
+        spool = app_module.OutputSpool(str(tmp_path / "spool" / name))
+        result = app_module.run_script([interpreter, str(path)], str(workdir), timeout, spool, pool=pool,
+                                       script=str(logical) if logical else None)
+        return result, spool
+
+    pool = app_module.InterpreterPool(app_module.EXECUTION_WARM_BOOTSTRAPS, 1)
+    try:
+        cold, spool = run(blob, "frio", pool, logical=script)
+        assert cold["warm"] is False and cold["exit_code"] == 3  # pool vazio: processo iniciado na hora
+        expected = f"__main__ {script} {script} {workdir} 42 ''\n"
+        assert spool.tail("out") == expected
+        warm, spool = run(blob, "quente", pool, logical=script)
+        assert warm["warm"] and warm["exit_code"] == 3
+        assert spool.tail("out") == expected
+        assert pool.stats == {"warm": 1, "cold": 1}
+    finally:
+        pool.close()
+
+    (workdir / "vizinho.js").write_text("module.exports = 7;\n")
+    node_blob = tmp_path / "blob" / ("cd" * 32)
+    node_blob.write_text("console.log(__filename, require.main === module, require('./vizinho.js'));\n")
+    result, spool = run(node_blob, "node", interpreter="node", logical=workdir / "principal.js")
+    assert spool.tail("out") == f"{workdir / 'principal.js'} true 7\n"
+
+    monkeypatch.setattr(app_module, "EXECUTION_CPU_LIMIT", 1)
+    burn = tmp_path / "cpu.py"
+    burn.write_text("while True:\n    pass\n")
+    result, _ = run(burn, "cpu")
+    assert result["cpu_limit"] and not result["timed_out"] and result["cpu_ms"] >= 900
+
+    monkeypatch.setattr(app_module, "EXECUTION_MEMORY_LIMIT", 64 * 1024 * 1024)
+    hog = tmp_path / "memoria.py"
+    hog.write_text("buf = bytearray(256 * 1024 * 1024)\n")
+    result, spool = run(hog, "memoria")
+    assert result["exit_code"] == 1 and "MemoryError" in spool.tail("err")
+
+    monkeypatch.setattr(app_module, "EXECUTION_FILE_SIZE_LIMIT", 1024 * 1024)
+    writer = tmp_path / "arquivo.py"
+    writer.write_text("open('grande.bin', 'wb').write(b'x' * 2 * 1024 * 1024)\n")
+    result, spool = run(writer, "arquivo")
+    assert result["exit_code"] == 1 and "File too large" in spool.tail("err")
+    assert (workdir / "grande.bin").stat().st_size == 1024 * 1024
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""Thumbnails e imagens derivadas usando o cliente de teste do Flask."""
+
+import base64
+import io
+import json
+import os
+import sys
+import threading
+
+sys.path.append(os.path.dirname(__file__))
+from PIL import Image  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+import app as app_module  # noqa: E402
+from app import app, thumbnail_path  # noqa: E402
+
+
+def _jpeg(width=1600, height=1200, color=(200, 30, 30)):
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, height), color).save(buffer, "JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def _upload(client, headers, content, name):
+    response = client.post(
+        "/api/upload",
+        headers=headers,
+        data={"file": (io.BytesIO(content), name)},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 201
+    return response.get_json()["file_id"]
+
+
+def test_thumbnail_sizes_formats_and_hash_key(monkeypatch, login):
+    """Tamanhos fixos, WebP por Accept e cache por hash sem reler o original."""
+    client = app.test_client()
+    headers = login(client)
+    file_id = _upload(client, headers, _jpeg(), "foto.jpg")
+
+    def no_rehash(path):
+        raise AssertionError("thumbnail não deve recalcular o hash do original")
+    monkeypatch.setattr(app_module, "calculate_file_hash", no_rehash)
+
+    small = client.get(f"/api/thumbnail/{file_id}?size=50", headers=headers)
+    assert small.status_code == 200 and small.mimetype == "image/jpeg"
+    assert max(Image.open(io.BytesIO(small.data)).size) == 64
+
+    webp = client.get(f"/api/thumbnail/{file_id}?size=800", headers={**headers, "Accept": "image/webp,*/*"})
+    assert webp.mimetype == "image/webp" and webp.headers["Vary"] == "Accept"
+    image = Image.open(io.BytesIO(webp.data))
+    assert image.format == "WEBP" and image.size == (800, 600)
+
+    cached = client.get(f"/api/thumbnail/{file_id}?size=800",
+                        headers={**headers, "Accept": "image/webp", "If-None-Match": webp.headers["ETag"]})
+    assert cached.status_code == 304
+
+    user_headers = login(client, "teste", "teste123")
+    assert client.get(f"/api/thumbnail/{file_id}", headers=user_headers).status_code == 404
+    assert client.get(f"/api/thumbnail/{file_id}?token=invalido").status_code == 403
+
+    assert client.delete(f"/api/delete/{file_id}", headers=headers).status_code == 200
+
+
+def test_batch_thumbnails_ndjson(monkeypatch, login):
+    """Vários thumbnails em uma resposta NDJSON, por ids ou por pasta com cursor."""
+    client = app.test_client()
+    headers = login(client)
+    folder = client.post("/api/folders", headers=headers, json={"name": "Galeria lote"})
+    folder_id = folder.get_json()["folder_id"]
+
+    ids = []
+    for index, color in enumerate([(250, 0, 0), (0, 250, 0), (0, 0, 250)]):
+        response = client.post(
+            "/api/upload", headers=headers,
+            data={"file": (io.BytesIO(_jpeg(640, 480, color)), f"lote{index}.jpg"), "folder_id": str(folder_id)},
+            content_type="multipart/form-data",
+        )
+        ids.append(response.get_json()["file_id"])
+    text_id = _upload(client, headers, b"texto", "nota.txt")
+
+    queries = []
+    with app.app_context():
+        engine = app_module.db.engine
+
+    def listener(conn, cursor, statement, *args):
+        queries.append(statement)
+    event.listen(engine, "before_cursor_execute", listener)
+    try:
+        response = client.get(f"/api/thumbnails?size=64&ids={ids[0]},{text_id},{ids[1]},999999",
+                              headers={**headers, "Accept": "image/webp"})
+    finally:
+        event.remove(engine, "before_cursor_execute", listener)
+    assert response.status_code == 200 and response.mimetype == "application/x-ndjson"
+    tiles = [json.loads(line) for line in response.data.decode().splitlines()]
+    assert [tile["id"] for tile in tiles] == [ids[0], text_id, ids[1], 999999]
+    assert "error" in tiles[1] and "error" in tiles[3]
+    image = Image.open(io.BytesIO(base64.b64decode(tiles[0]["data"])))
+    assert image.format == "WEBP" and max(image.size) == 64
+    assert sum(1 for sql in queries if "FROM file" in sql) == 1
+
+    first = client.get(f"/api/thumbnails?folder_id={folder_id}&limit=2", headers=headers)
+    lines = [json.loads(line) for line in first.data.decode().splitlines()]
+    assert [tile["id"] for tile in lines[:-1]] == ids[:2] and lines[-1]["has_more"]
+    rest = client.get(f"/api/thumbnails?folder_id={folder_id}&limit=2&cursor={lines[-1]['next_cursor']}",
+                      headers=headers)
+    lines = [json.loads(line) for line in rest.data.decode().splitlines()]
+    assert [tile["id"] for tile in lines[:-1]] == ids[2:] and lines[-1]["next_cursor"] is None
+
+    # Thumbnail despejado entre a geração e a leitura: gera de novo; se sumir
+    # sempre, só aquele id vira erro e os seguintes continuam chegando
+    real_ensure = app_module.ensure_thumbnail
+
+    def evicted(*args):
+        path = real_ensure(*args)
+        os.remove(path)
+        return path
+
+    calls = []
+
+    def evicted_once(*args):
+        calls.append(args)
+        return evicted(*args) if len(calls) == 1 else real_ensure(*args)
+
+    monkeypatch.setattr(app_module, "ensure_thumbnail", evicted_once)
+    tiles = [json.loads(line) for line in client.get(f"/api/thumbnails?ids={ids[0]}", headers=headers).data.decode().splitlines()]
+    assert "data" in tiles[0] and len(calls) == 2
+    monkeypatch.setattr(app_module, "ensure_thumbnail", evicted)
+    tiles = [json.loads(line) for line in client.get(f"/api/thumbnails?ids={ids[0]},{ids[1]}", headers=headers).data.decode().splitlines()]
+    assert [tile["id"] for tile in tiles] == ids[:2] and all("error" in tile for tile in tiles)
+    monkeypatch.setattr(app_module, "ensure_thumbnail", real_ensure)
+
+    user_headers = login(client, "teste", "teste123")
+    foreign = client.get(f"/api/thumbnails?ids={ids[0]}", headers=user_headers)
+    assert "error" in json.loads(foreign.data.decode().splitlines()[0])
+    assert client.get("/api/thumbnails", headers=headers).status_code == 400
+
+    assert client.delete(f"/api/folders/{folder_id}", headers=headers).status_code == 200
+    assert client.delete(f"/api/delete/{text_id}", headers=headers).status_code == 200
+
+
+def test_concurrent_thumbnail_requests_render_once(monkeypatch, tmp_path):
+    """Pedidos simultâneos do mesmo thumbnail ausente geram uma única vez."""
+    source = tmp_path / "origem.jpg"
+    source.write_bytes(_jpeg(900, 900, (10, 120, 10)))
+    file_hash = "f" * 64
+    monkeypatch.setattr(app_module.derived_cache, "root", str(tmp_path / "derived"))
+
+    renders = []
+    original = app_module.render_thumbnail
+
+    def counting_render(*args):
+        renders.append(args)
+        original(*args)
+    monkeypatch.setattr(app_module, "render_thumbnail", counting_render)
+
+    results = []
+
+    def request_thumbnail():
+        with app.app_context():
+            results.append(app_module.ensure_thumbnail(file_hash, str(source), "image/jpeg", 200))
+    threads = [threading.Thread(target=request_thumbnail) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(renders) == 1
+    assert set(results) == {app_module.thumbnail_path(file_hash, 200, "jpg")}
+    assert os.path.exists(thumbnail_path(file_hash, 200, "jpg"))
+    # O lock de geração é um arquivo estável, nunca apagado após o flock
+    key = app_module.derived_cache.key_for("thumb", file_hash, "200.jpg")
+    assert os.path.exists(app_module.derived_cache.lock_path_for(key))
+    assert not os.path.exists(thumbnail_path(file_hash, 200, "jpg") + ".lock")
+    with app.app_context():
+        assert app_module.derived_cache.invalidate(file_hash) == 1
+        app_module.db.session.commit()
+
+
+def test_derived_cache_budget_eviction_and_invalidation(monkeypatch, tmp_path, login):
+    """Orçamento em bytes com evicção LRU, invalidação por blob e taxa de acerto."""
+    cache = app_module.DerivedCache(str(tmp_path / "derived"), max_bytes=2500)
+    sums = []
+    original_total = cache.total_bytes
+
+    def counting_total():
+        sums.append(1)
+        return original_total()
+    monkeypatch.setattr(cache, "total_bytes", counting_total)
+
+    def produce(data):
+        def write(dest):
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            with open(dest, "wb") as f:
+                f.write(data)
+        return write
+
+    with app.app_context():
+        first = cache.get_or_create("teste", "a" * 64, "v1", produce(b"x" * 1000))
+        second = cache.get_or_create("teste", "b" * 64, "v1", produce(b"y" * 1000))
+        assert cache.get_or_create("teste", "a" * 64, "v1", produce(b"?")) == first
+        # Abaixo do orçamento o total vem da soma local: um único SUM no banco
+        assert len(sums) == 1
+        cache.flush_touches()
+        # Estoura o orçamento: sai o menos recentemente usado (b), não o recém-lido (a)
+        third = cache.get_or_create("teste", "c" * 64, "v1", produce(b"z" * 1000))
+        assert os.path.exists(first) and os.path.exists(third)
+        assert not os.path.exists(second)
+
+        report = cache.report()
+        assert report["total_bytes"] == 2000 and report["evicted"] == 1
+        assert report["hits"] == 1 and report["misses"] == 3 and report["hit_ratio"] == 0.25
+
+        assert cache.invalidate("a" * 64) == 1
+        app_module.db.session.commit()
+        assert not os.path.exists(first)
+        assert cache.invalidate("c" * 64) == 1
+        app_module.db.session.commit()
+        assert cache.report()["total_bytes"] == 0
+
+    client = app.test_client()
+    headers = login(client)
+    report = client.get("/api/admin/derived-cache", headers=headers)
+    assert report.status_code == 200 and "hit_ratio" in report.get_json()
+
+
+def test_resized_image_variants_and_immutable_cache(login):
+    """Redimensiona sem ampliar, negocia WebP e marca como imutável com ?v=<hash>."""
+    client = app.test_client()
+    headers = login(client)
+    file_id = _upload(client, headers, _jpeg(1600, 1200), "grande.jpg")
+    listing = client.get("/api/files", headers=headers).get_json()
+    version = next(item["version"] for item in listing["files"] if item["id"] == file_id)
+
+    contain = client.get(f"/api/image/{file_id}?w=500&v={version}", headers=headers)
+    assert contain.status_code == 200 and contain.mimetype == "image/jpeg"
+    assert Image.open(io.BytesIO(contain.data)).size == (512, 384)  # w arredondado para 512
+    assert "immutable" in contain.headers["Cache-Control"]
+
+    cover = client.get(f"/api/image/{file_id}?w=300&h=300&fit=cover&q=60",
+                       headers={**headers, "Accept": "image/webp"})
+    image = Image.open(io.BytesIO(cover.data))
+    assert image.format == "WEBP" and image.size == (320, 320)
+    assert cover.headers["Vary"] == "Accept" and "immutable" not in cover.headers["Cache-Control"]
+
+    # Sem ampliar: caixa maior que o original mantém o tamanho (cover reduz a caixa)
+    big = client.get(f"/api/image/{file_id}?w=4000", headers=headers)
+    assert Image.open(io.BytesIO(big.data)).size == (1600, 1200)
+    wide = client.get(f"/api/image/{file_id}?w=3200&h=1600&fit=cover", headers=headers)
+    assert Image.open(io.BytesIO(wide.data)).size == (1600, 800)
+
+    stale = client.get(f"/api/image/{file_id}?w=500&v=0000000000000000", headers=headers)
+    assert "immutable" not in stale.headers["Cache-Control"]
+    again = client.get(f"/api/image/{file_id}?w=500&v={version}",
+                       headers={**headers, "If-None-Match": contain.headers["ETag"]})
+    assert again.status_code == 304
+
+    assert client.get(f"/api/image/{file_id}", headers=headers).status_code == 400
+    assert client.get(f"/api/image/{file_id}?w=100&fit=cover", headers=headers).status_code == 400
+    user_headers = login(client, "teste", "teste123")
+    assert client.get(f"/api/image/{file_id}?w=100", headers=user_headers).status_code == 404
+
+    with app.app_context():
+        file_hash = app_module.db.session.get(app_module.File, file_id).file_hash
+        assert app_module.DerivedAsset.query.filter_by(kind="image", source_hash=file_hash).count() == 4
+    assert client.delete(f"/api/delete/{file_id}", headers=headers).status_code == 200
+    with app.app_context():
+        assert app_module.DerivedAsset.query.filter_by(source_hash=file_hash).count() == 0
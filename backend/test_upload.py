@@ -1,13 +1,16 @@
 #!/usr/bin/env python3
 """Integração básica do fluxo de upload usando o cliente de teste do Flask."""
 
+import hashlib
 import io
+import json
 import os
 import sys
 from datetime import datetime
 
 sys.path.append(os.path.dirname(__file__))
-from app import app  # noqa: E402
+import app as app_module  # noqa: E402
+from app import app, db, ContentBlob, File, User, rebuild_folder_totals, reconcile_storage_usage, release_blob  # noqa: E402
 
 
 def test_upload_and_list():
@@ -54,5 +57,537 @@ def test_upload_and_list():
     assert user_info.status_code == 200
 
 
+def test_upload_streams_hash_size_and_mime(login):
+    """Hash, tamanho e MIME vêm da mesma passagem de escrita do upload."""
+    client = app.test_client()
+    headers = login(client)
+
+    content = b"%PDF-1.4\n" + os.urandom(3 * 1024 * 1024)
+    upload_response = client.post(
+        "/api/upload",
+        headers=headers,
+        data={"folder_id": "0", "file": (io.BytesIO(content), "stream_test.pdf")},
+        content_type="multipart/form-data",
+    )
+    assert upload_response.status_code == 201
+    file_id = upload_response.get_json()["file_id"]
+
+    with app.app_context():
+        db_file = File.query.get(file_id)
+        assert db_file.file_size == len(content)
+        assert db_file.file_hash == hashlib.sha256(content).hexdigest()
+        assert db_file.mime_type == "application/pdf"
+        with open(db_file.file_path, "rb") as f:
+            assert f.read() == content
+
+    assert client.delete(f"/api/delete/{file_id}", headers=headers).status_code == 200
+
+
+def test_resumable_upload_session_out_of_order(login):
+    """Partes em qualquer ordem, retomada pelo estado da sessão e finalização."""
+    client = app.test_client()
+    headers = login(client)
+
+    content = os.urandom(2500)
+    create = client.post(
+        "/api/uploads",
+        headers=headers,
+        json={"filename": "sessao.bin", "size": len(content), "chunk_size": 1000},
+    )
+    assert create.status_code == 201
+    session = create.get_json()
+    upload_id = session["upload_id"]
+    assert session["total_chunks"] == 3
+
+    def put(index):
+        chunk = content[index * 1000:(index + 1) * 1000]
+        return client.put(
+            f"/api/uploads/{upload_id}/chunks/{index}",
+            headers={**headers, "X-Chunk-SHA256": hashlib.sha256(chunk).hexdigest()},
+            data=chunk,
+        )
+
+    assert put(2).status_code == 200
+    assert put(0).status_code == 200
+    assert put(0).status_code == 200  # retry idempotente
+
+    status = client.get(f"/api/uploads/{upload_id}", headers=headers).get_json()
+    assert status["received_ranges"] == [[0, 0], [2, 2]]
+    assert client.post(f"/api/uploads/{upload_id}/complete", headers=headers).status_code == 409
+
+    assert put(1).status_code == 200
+    complete = client.post(
+        f"/api/uploads/{upload_id}/complete",
+        headers=headers,
+        json={"sha256": hashlib.sha256(content).hexdigest()},
+    )
+    assert complete.status_code == 201
+    file_id = complete.get_json()["file_id"]
+
+    with app.app_context():
+        db_file = File.query.get(file_id)
+        assert db_file.file_size == len(content)
+        with open(db_file.file_path, "rb") as f:
+            assert f.read() == content
+
+    assert client.delete(f"/api/delete/{file_id}", headers=headers).status_code == 200
+
+
+def test_identical_uploads_share_one_blob(login):
+    """Conteúdo idêntico é armazenado uma vez e só sai com a última referência."""
+    client = app.test_client()
+    headers = login(client)
+
+    content = os.urandom(4096)
+    file_ids = []
+    for name in ("copia_a.bin", "copia_b.bin"):
+        response = client.post(
+            "/api/upload",
+            headers=headers,
+            data={"folder_id": "0", "file": (io.BytesIO(content), name)},
+            content_type="multipart/form-data",
+        )
+        assert response.status_code == 201
+        file_ids.append(response.get_json()["file_id"])
+
+    file_hash = hashlib.sha256(content).hexdigest()
+    with app.app_context():
+        first, second = (File.query.get(i) for i in file_ids)
+        assert first.file_path == second.file_path
+        assert ContentBlob.query.get(file_hash).ref_count == 2
+        blob_file = first.file_path
+
+    assert client.delete(f"/api/delete/{file_ids[0]}", headers=headers).status_code == 200
+    assert os.path.exists(blob_file)
+
+    # Última referência liberada numa transação desfeita: o conteúdo continua lá
+    with app.app_context():
+        assert release_blob(file_hash)
+        with db.session.begin_nested():
+            pass
+        assert not os.path.exists(blob_file)
+        db.session.rollback()
+    assert os.path.exists(blob_file)
+    with app.app_context():
+        assert ContentBlob.query.get(file_hash).ref_count == 1
+
+    assert client.delete(f"/api/delete/{file_ids[1]}", headers=headers).status_code == 200
+    assert not os.path.exists(blob_file)
+    with app.app_context():
+        assert ContentBlob.query.get(file_hash) is None
+
+
+def test_precheck_creates_known_content_without_transfer(monkeypatch, login):
+    """Hash já conhecido vira arquivo sem envio de bytes; desconhecido volta como missing."""
+    client = app.test_client()
+    headers = login(client)
+
+    content = os.urandom(2048)
+    upload = client.post(
+        "/api/upload",
+        headers=headers,
+        data={"folder_id": "0", "file": (io.BytesIO(content), "original.bin")},
+        content_type="multipart/form-data",
+    )
+    assert upload.status_code == 201
+    original_id = upload.get_json()["file_id"]
+
+    file_hash = hashlib.sha256(content).hexdigest()
+    response = client.post(
+        "/api/upload/precheck",
+        headers=headers,
+        json={"files": [
+            {"sha256": file_hash, "size": len(content), "filename": "instantaneo.bin"},
+            {"sha256": "0" * 64, "size": 10, "filename": "novo.bin"},
+        ]},
+    )
+    assert response.status_code == 200
+    results = response.get_json()["results"]
+    assert [r["status"] for r in results] == ["created", "missing"]
+
+    instant_id = results[0]["file_id"]
+    with app.app_context():
+        assert File.query.get(instant_id).file_path == File.query.get(original_id).file_path
+        assert ContentBlob.query.get(file_hash).ref_count == 2
+
+    # Outro usuário não descobre nem copia o conteúdo só pelo hash
+    other = login(client, "teste", "teste123")
+    item = {"sha256": file_hash, "size": len(content), "filename": "alheio.bin"}
+    response = client.post("/api/upload/precheck", headers=other, json={"files": [item]})
+    assert response.get_json()["results"][0]["status"] == "missing"
+
+    # Escopo global: desafio igual para hash existente ou não; só a prova libera
+    monkeypatch.setattr(app_module, "INSTANT_UPLOAD_SCOPE", "global")
+    unknown = {"sha256": "1" * 64, "size": len(content), "filename": "x.bin"}
+    response = client.post("/api/upload/precheck", headers=other, json={"files": [item, unknown]})
+    results = response.get_json()["results"]
+    assert [r["status"] for r in results] == ["challenge", "challenge"]
+    challenge = results[0]["challenge"]
+    proof = app_module.possession_proof(
+        challenge["nonce"], content[challenge["offset"]:challenge["offset"] + challenge["length"]]
+    )
+    forged = client.post("/api/upload/precheck", headers=other, json={"files": [{**item, "proof": "0" * 64}]})
+    assert forged.get_json()["results"][0]["status"] == "missing"
+    proven = client.post("/api/upload/precheck", headers=other, json={"files": [{**item, "proof": proof}]})
+    proven_result = proven.get_json()["results"][0]
+    assert proven_result["status"] == "created"
+    assert client.delete(f"/api/delete/{proven_result['file_id']}", headers=other).status_code == 200
+
+    for file_id in (original_id, instant_id):
+        assert client.delete(f"/api/delete/{file_id}", headers=headers).status_code == 200
+
+
+def test_storage_counter_and_session_reservation(login):
+    """Uso mantido incrementalmente e sessões reservando quota até finalizar/cancelar."""
+    client = app.test_client()
+    headers = login(client)
+
+    def usage():
+        return client.get("/api/user-info", headers=headers).get_json()["storage_used"]
+
+    before = usage()
+    content = os.urandom(5000)
+    upload = client.post(
+        "/api/upload",
+        headers=headers,
+        data={"folder_id": "0", "file": (io.BytesIO(content), "contador.bin")},
+        content_type="multipart/form-data",
+    )
+    assert upload.status_code == 201
+    assert usage() == before + len(content)
+
+    with app.app_context():
+        admin = User.query.filter_by(username="admin").first()
+        remaining = admin.storage_quota - admin.storage_used - admin.storage_reserved
+        reserved_before = admin.storage_reserved
+
+    # Sessão que ocupa todo o espaço livre bloqueia a próxima até ser cancelada
+    first = client.post("/api/uploads", headers=headers, json={"filename": "a.bin", "size": remaining})
+    assert first.status_code == 201
+    second = client.post("/api/uploads", headers=headers, json={"filename": "b.bin", "size": 1})
+    assert second.status_code == 413
+    upload_id = first.get_json()["upload_id"]
+    assert client.delete(f"/api/uploads/{upload_id}", headers=headers).status_code == 200
+
+    with app.app_context():
+        assert db.session.get(User, admin.id).storage_reserved == reserved_before
+        reconcile_storage_usage()
+        assert db.session.get(User, admin.id).storage_used == before + len(content)
+
+    file_id = upload.get_json()["file_id"]
+    assert client.delete(f"/api/delete/{file_id}", headers=headers).status_code == 200
+    assert usage() == before
+
+
+def test_stale_finalizing_session_expires(login):
+    """Finalização interrompida devolve a reserva e bloqueia novas partes."""
+    client = app.test_client()
+    headers = login(client)
+
+    created = client.post("/api/uploads", headers=headers, json={"filename": "preso.bin", "size": 10})
+    assert created.status_code == 201
+    upload_id = created.get_json()["upload_id"]
+    with app.app_context():
+        admin = User.query.filter_by(username="admin").first()
+        admin_id, reserved = admin.id, admin.storage_reserved
+        app_module.UploadSession.query.filter_by(id=upload_id).update({
+            "status": "finalizing",
+            "finalizing_since": datetime.utcnow() - app_module.UPLOAD_SESSION_FINALIZE_TIMEOUT / 2,
+        })
+        db.session.commit()
+
+    # Finalização em andamento: nenhuma parte entra no arquivo
+    chunk = client.put(f"/api/uploads/{upload_id}/chunks/0", headers=headers, data=b"0123456789")
+    assert chunk.status_code == 409
+
+    with app.app_context():
+        app_module.UploadSession.query.filter_by(id=upload_id).update({
+            "finalizing_since": datetime.utcnow() - app_module.UPLOAD_SESSION_FINALIZE_TIMEOUT * 2,
+        })
+        db.session.commit()
+        app_module.cleanup_expired_upload_sessions()
+        assert db.session.get(app_module.UploadSession, upload_id).status == "expired"
+        assert db.session.get(User, admin_id).storage_reserved == reserved - 10
+
+
+def test_session_expired_or_failing_during_finalization(monkeypatch, login):
+    """Sessão expirada durante o hash não move nada; falha depois do rename
+    marca a sessão como failed. Em ambos os casos a reserva volta e nenhum
+    arquivo ou blob fica para trás."""
+    client = app.test_client()
+    headers = login(client)
+    real_hash = app_module.calculate_file_hash
+
+    def session_with_content():
+        content = os.urandom(1000)
+        created = client.post("/api/uploads", headers=headers, json={"filename": "final.bin", "size": len(content)})
+        upload_id = created.get_json()["upload_id"]
+        assert client.put(f"/api/uploads/{upload_id}/chunks/0", headers=headers, data=content).status_code == 200
+        return upload_id, hashlib.sha256(content).hexdigest()
+
+    def counters():
+        with app.app_context():
+            admin = User.query.filter_by(username="admin").first()
+            return admin.storage_used, admin.storage_reserved, File.query.count()
+
+    def expire_while_hashing(path):
+        digest = real_hash(path)
+        app_module.UploadSession.query.filter_by(id=upload_id).update({
+            "finalizing_since": datetime.utcnow() - app_module.UPLOAD_SESSION_FINALIZE_TIMEOUT * 2,
+        })
+        db.session.commit()
+        app_module.cleanup_expired_upload_sessions()
+        return digest
+
+    before = counters()
+    upload_id, file_hash = session_with_content()
+    monkeypatch.setattr(app_module, "calculate_file_hash", expire_while_hashing)
+    assert client.post(f"/api/uploads/{upload_id}/complete", headers=headers).status_code == 409
+    monkeypatch.setattr(app_module, "calculate_file_hash", real_hash)
+    assert counters() == before
+    with app.app_context():
+        assert db.session.get(app_module.UploadSession, upload_id).status == "expired"
+        assert db.session.get(ContentBlob, file_hash) is None
+    assert not os.path.exists(app_module.blob_path(file_hash))
+
+    def broken_totals(*args, **kwargs):
+        raise RuntimeError("falha simulada")
+
+    upload_id, file_hash = session_with_content()
+    monkeypatch.setattr(app_module, "adjust_folder_totals", broken_totals)
+    assert client.post(f"/api/uploads/{upload_id}/complete", headers=headers).status_code == 500
+    assert counters() == before
+    with app.app_context():
+        assert db.session.get(app_module.UploadSession, upload_id).status == "failed"
+        assert db.session.get(ContentBlob, file_hash) is None
+    assert not os.path.exists(app_module.blob_path(file_hash))
+    assert client.post(f"/api/uploads/{upload_id}/complete", headers=headers).status_code == 409
+
+
+def test_file_listing_keyset_pagination(monkeypatch, login):
+    """Páginas por cursor cobrem todos os arquivos, sem repetição, na ordem pedida."""
+    client = app.test_client()
+    headers = login(client)
+
+    folder = client.post("/api/folders", headers=headers, json={"name": "paginacao"})
+    assert folder.status_code == 201
+    folder_id = folder.get_json()["folder_id"]
+
+    file_ids = []
+    for i in range(5):
+        response = client.post(
+            "/api/upload",
+            headers=headers,
+            data={"folder_id": str(folder_id), "file": (io.BytesIO(b"x" * (i + 1)), f"item_{i}.txt")},
+            content_type="multipart/form-data",
+        )
+        assert response.status_code == 201
+        file_ids.append(response.get_json()["file_id"])
+
+    seen = []
+    url = f"/api/files?folder_id={folder_id}&sort=size&order=desc&limit=2"
+    page = client.get(url, headers=headers).get_json()
+    assert page["total_hint"] == 5 and page["total_is_exact"]
+    while True:
+        seen.extend(f["size"] for f in page["files"])
+        if not page["next_cursor"]:
+            break
+        page = client.get(f"{url}&cursor={page['next_cursor']}", headers=headers).get_json()
+        assert "folders" not in page
+    assert seen == [5, 4, 3, 2, 1]
+
+    assert client.get(f"{url}&cursor=invalido", headers=headers).status_code == 400
+
+    # Sem limit nem cursor a listagem vem completa, buscada em blocos
+    monkeypatch.setattr(app_module, "LISTING_DEFAULT_LIMIT", 2)
+    full = client.get(f"/api/files?folder_id={folder_id}&sort=size&order=desc", headers=headers).get_json()
+    assert [f["size"] for f in full["files"]] == [5, 4, 3, 2, 1]
+    assert full["next_cursor"] is None and "folders" in full
+
+    # Falha no meio da resposta ainda fecha o JSON, com cursor para retomar
+    with app.app_context():
+        admin_id = User.query.filter_by(username="admin").first().id
+        calls = []
+
+        def flaky_fetch(after, size):
+            calls.append(after)
+            if len(calls) > 1:
+                raise RuntimeError("conexão perdida")
+            return app_module.file_listing_query(admin_id, folder_id, "size", "desc", after).limit(size).all()
+
+        body = json.loads("".join(app_module.stream_file_listing({"sort": "size"}, flaky_fetch, lambda r: r.id, "size")))
+    assert body["returned"] == 2 and "error" in body and body["next_cursor"]
+    for file_id in file_ids:
+        assert client.delete(f"/api/delete/{file_id}", headers=headers).status_code == 200
+
+
+def test_folder_closure_breadcrumb_and_recursive_ops(login):
+    """Breadcrumb, listagem/tamanho recursivos e exclusão de subárvore via closure table."""
+    client = app.test_client()
+    headers = login(client)
+    before = client.get("/api/user-info", headers=headers).get_json()["storage_used"]
+
+    parent_id = None
+    chain = []
+    for depth in range(4):
+        response = client.post("/api/folders", headers=headers, json={"name": f"nivel_{depth}", "parent_id": parent_id})
+        assert response.status_code == 201
+        parent_id = response.get_json()["folder_id"]
+        chain.append(parent_id)
+        upload = client.post(
+            "/api/upload",
+            headers=headers,
+            data={"folder_id": str(parent_id), "file": (io.BytesIO(b"n" * (depth + 10)), f"arq_{depth}.txt")},
+            content_type="multipart/form-data",
+        )
+        assert upload.status_code == 201
+
+    page = client.get(f"/api/files?folder_id={chain[-1]}", headers=headers).get_json()
+    assert [p["id"] for p in page["path"]] == chain
+
+    page = client.get(f"/api/files?folder_id={chain[1]}&recursive=1", headers=headers).get_json()
+    assert sorted(f["filename"] for f in page["files"]) == ["arq_1.txt", "arq_2.txt", "arq_3.txt"]
+
+    stats = client.get(f"/api/folders/{chain[0]}/stats", headers=headers).get_json()
+    assert stats["file_count"] == 4 and stats["folder_count"] == 3
+    assert stats["total_size"] == 10 + 11 + 12 + 13 and stats["max_depth"] == 3
+    with app.app_context():
+        rebuild_folder_totals()
+    assert client.get(f"/api/folders/{chain[0]}/stats", headers=headers).get_json() == stats
+    assert client.get(f"/api/folders/{chain[1]}/stats", headers=headers).get_json()["total_size"] == 11 + 12 + 13
+
+    response = client.delete(f"/api/folders/{chain[1]}", headers=headers)
+    assert response.status_code == 200
+    assert response.get_json()["deleted_folders"] == 3
+    stats = client.get(f"/api/folders/{chain[0]}/stats", headers=headers).get_json()
+    assert stats["file_count"] == 1 and stats["folder_count"] == 0
+    root = next(f for f in client.get("/api/folders", headers=headers).get_json()["folders"] if f["id"] == chain[0])
+    assert root["size"] == 10 and root["file_count"] == 1
+    assert client.get(f"/api/folders/{chain[2]}/stats", headers=headers).status_code == 404
+
+    assert client.delete(f"/api/folders/{chain[0]}", headers=headers).status_code == 200
+    assert client.get("/api/user-info", headers=headers).get_json()["storage_used"] == before
+
+
+def test_stream_and_download_ranges(login):
+    """Download completo, stream com Range e nome de arquivo não ASCII."""
+    client = app.test_client()
+    headers = login(client)
+    content = bytes(range(256)) * 64
+    response = client.post(
+        "/api/upload",
+        headers=headers,
+        data={"file": (io.BytesIO(content), "vídeo.bin")},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 201
+    file_id = response.get_json()["file_id"]
+
+    download = client.get(f"/api/download/{file_id}", headers=headers)
+    assert download.status_code == 200 and download.data == content
+    assert download.headers["Content-Disposition"].startswith("attachment;")
+    assert "filename*=UTF-8''v%C3%ADdeo.bin" in download.headers["Content-Disposition"]
+
+    partial = client.get(f"/api/stream/{file_id}", headers={**headers, "Range": "bytes=100-1099"})
+    assert partial.status_code == 206
+    assert partial.data == content[100:1100]
+    assert partial.headers["Content-Range"] == f"bytes 100-1099/{len(content)}"
+    assert partial.headers["Content-Length"] == "1000"
+
+    tail = client.get(f"/api/stream/{file_id}", headers={**headers, "Range": "bytes=16000-"})
+    assert tail.status_code == 206 and tail.data == content[16000:]
+
+
+    suffix = client.get(f"/api/stream/{file_id}", headers={**headers, "Range": "bytes=-10"})
+    assert suffix.status_code == 206 and suffix.data == content[-10:]
+
+    unsatisfiable = client.get(f"/api/stream/{file_id}", headers={**headers, "Range": f"bytes={len(content)}-"})
+    assert unsatisfiable.status_code == 416
+    assert unsatisfiable.headers["Content-Range"] == f"bytes */{len(content)}"
+
+    assert client.delete(f"/api/delete/{file_id}", headers=headers).status_code == 200
+
+
+def test_conditional_requests_and_multirange(login):
+    """ETag forte do hash, 304, If-Range e multipart/byteranges."""
+    client = app.test_client()
+    headers = login(client)
+    content = os.urandom(5000)
+    response = client.post(
+        "/api/upload",
+        headers=headers,
+        data={"file": (io.BytesIO(content), "cond.bin")},
+        content_type="multipart/form-data",
+    )
+    file_id = response.get_json()["file_id"]
+    url = f"/api/stream/{file_id}"
+
+    full = client.get(url, headers=headers)
+    etag = full.headers["ETag"]
+    assert etag == f'"{hashlib.sha256(content).hexdigest()}"'
+    assert full.headers["Last-Modified"]
+
+    assert client.get(url, headers={**headers, "If-None-Match": etag}).status_code == 304
+    assert client.get(url, headers={**headers, "If-None-Match": f"W/{etag}"}).status_code == 304
+    assert client.get(url, headers={**headers, "If-None-Match": '"outro"'}).status_code == 200
+    not_modified = client.get(url, headers={**headers, "If-Modified-Since": full.headers["Last-Modified"]})
+    assert not_modified.status_code == 304
+    assert client.get(f"/api/download/{file_id}", headers={**headers, "If-Match": '"outro"'}).status_code == 412
+
+    ranged = client.get(url, headers={**headers, "Range": "bytes=0-9", "If-Range": etag})
+    assert ranged.status_code == 206 and ranged.data == content[:10]
+    stale = client.get(url, headers={**headers, "Range": "bytes=0-9", "If-Range": '"antigo"'})
+    assert stale.status_code == 200 and stale.data == content
+
+    multi = client.get(url, headers={**headers, "Range": "bytes=0-9,100-109,-5"})
+    assert multi.status_code == 206
+    assert multi.mimetype == "multipart/byteranges"
+    boundary = multi.mimetype_params["boundary"]
+    assert int(multi.headers["Content-Length"]) == len(multi.data)
+    parts = multi.data.split(f"--{boundary}".encode())[1:-1]
+    bodies = [part.split(b"\r\n\r\n", 1)[1][:-2] for part in parts]
+    assert bodies == [content[:10], content[100:110], content[-5:]]
+    assert b"Content-Range: bytes 100-109/5000" in parts[1]
+
+    merged = client.get(url, headers={**headers, "Range": "bytes=0-9,5-19"})
+    assert merged.status_code == 206 and merged.data == content[:20]
+    assert client.get(url, headers={**headers, "Range": "bytes=abc"}).status_code == 200
+
+    assert client.delete(f"/api/delete/{file_id}", headers=headers).status_code == 200
+
+
+def test_proxy_offload_headers(monkeypatch, login):
+    """Modos x-accel/x-sendfile: só cabeçalhos, bytes enviados pelo proxy."""
+    import app as app_module
+
+    client = app.test_client()
+    headers = login(client)
+    response = client.post(
+        "/api/upload",
+        headers=headers,
+        data={"file": (io.BytesIO(b"offload"), "proxy.txt")},
+        content_type="multipart/form-data",
+    )
+    file_id = response.get_json()["file_id"]
+    with app.app_context():
+        stored = db.session.get(File, file_id).file_path
+
+    monkeypatch.setattr(app_module, "FILE_DELIVERY_MODE", "x-accel")
+    offloaded = client.get(f"/api/stream/{file_id}", headers={**headers, "Range": "bytes=0-1"})
+    assert offloaded.status_code == 200 and offloaded.data == b""
+    relative = os.path.relpath(stored, app_module.UPLOAD_FOLDER)
+    assert offloaded.headers["X-Accel-Redirect"] == "/_protected/" + relative
+    assert offloaded.headers["Content-Disposition"] == 'inline; filename="proxy.txt"'
+    assert offloaded.mimetype == "text/plain"
+
+    monkeypatch.setattr(app_module, "FILE_DELIVERY_MODE", "x-sendfile")
+    download = client.get(f"/api/download/{file_id}", headers=headers)
+    assert download.headers["X-Sendfile"] == stored
+    assert download.headers["Content-Disposition"].startswith("attachment;")
+
+    monkeypatch.setattr(app_module, "FILE_DELIVERY_MODE", "direct")
+    assert client.delete(f"/api/delete/{file_id}", headers=headers).status_code == 200
+
+
 if __name__ == "__main__":
     test_upload_and_list()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""Worker da fila de jobs em background (tabela job).
+
+Cada processo reserva jobs com SELECT ... FOR UPDATE SKIP LOCKED, executa e
+grava o resultado; falhas são repetidas com backoff exponencial. Pode rodar
+em várias máquinas/processos ao mesmo tempo.
+
+Uso:
+    python worker.py [--processes 2] [--kinds enrich_file] [--batch 5] [--poll 1.0]
+    python worker.py --once        # processa o que estiver pronto e sai
+"""
+
+import argparse
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from app import app, db, NO_DB_CONFIG  # noqa: E402
+from app import execution_pool, job_worker_id, system_sampler, work_once  # noqa: E402
+
+
+def run_worker(kinds, batch, poll, once=False):
+    """Laço de um processo worker: processa lotes até receber SIGTERM/SIGINT."""
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda *_: stopping.append(True))
+    signal.signal(signal.SIGINT, lambda *_: stopping.append(True))
+    # Conexões herdadas do processo pai não podem ser compartilhadas após o fork
+    with app.app_context():
+        db.engine.dispose(close=False)
+    worker_id = job_worker_id()
+    if not once:
+        # Após o fork (--processes > 1) o filho inicia a sua thread de amostragem
+        # e pode assumi-la se o processo pai sair
+        system_sampler.start()
+    if not once and (kinds is None or 'execute' in kinds):
+        execution_pool().start()  # interpretadores prontos antes da primeira execução
+    processed = 0
+    while not stopping:
+        with app.app_context():
+            try:
+                count = work_once(worker_id, kinds, batch)
+            except Exception as e:
+                db.session.rollback()
+                print(f"[{worker_id}] erro ao processar a fila: {e}", flush=True)
+                count = 0
+        processed += count
+        if not count:
+            if once:
+                break
+            time.sleep(poll)
+    execution_pool().close()
+    print(f"[{worker_id}] encerrado após {processed} job(s)", flush=True)
+    return processed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Worker da fila de jobs do Chiapetta Cloud')
+    parser.add_argument('--processes', type=int, default=int(os.environ.get('JOB_WORKER_PROCESSES', 2)))
+    parser.add_argument('--kinds', help='Tipos de job separados por vírgula (padrão: todos)')
+    parser.add_argument('--batch', type=int, default=5, help='Jobs reservados por consulta')
+    parser.add_argument('--poll', type=float, default=1.0, help='Espera (s) quando a fila está vazia')
+    parser.add_argument('--once', action='store_true', help='Processa os jobs prontos e sai (um processo)')
+    args = parser.parse_args()
+    if NO_DB_CONFIG:
+        print("Banco de dados não configurado. Conclua o setup antes de iniciar o worker.")
+        return 1
+
+    kinds = [kind.strip() for kind in args.kinds.split(',')] if args.kinds else None
+    if args.once or args.processes <= 1:
+        run_worker(kinds, args.batch, args.poll, once=args.once)
+        return 0
+
+    context = multiprocessing.get_context('fork')
+    children = [
+        context.Process(target=run_worker, args=(kinds, args.batch, args.poll), name=f'job-worker-{index}')
+        for index in range(args.processes)
+    ]
+    for child in children:
+        child.start()
+
+    def stop(*_):
+        for child in children:
+            if child.is_alive():
+                child.terminate()  # SIGTERM: termina o job atual e sai
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for child in children:
+        child.join()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
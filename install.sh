@@ -86,8 +86,17 @@ echo "📍 Acesse: http://localhost:5000"
 echo "⏹️  Para parar: Ctrl+C"
 echo ""
 
-# Iniciar aplicação
 cd backend
+
+# Migrações de schema pendentes (o app só avisa, não migra sozinho)
+python manage.py migrate || exit 1
+
+# Workers da fila de jobs (pós-upload e execução de scripts)
+python worker.py &
+WORKER_PID=$!
+trap 'kill $WORKER_PID 2>/dev/null' EXIT
+
+# Iniciar aplicação
 python app.py
 EOF
 
@@ -110,9 +119,21 @@ echo "📍 Rodando em: http://0.0.0.0:5000"
 echo "⏹️  Para parar: Ctrl+C"
 echo ""
 
-# Iniciar com Gunicorn
 cd backend
-gunicorn -w 4 -b 0.0.0.0:5000 app:app --access-logfile ../logs/access.log --error-logfile ../logs/error.log
+
+# Migrações antes de subir app e workers: um banco atualizado sem elas quebra
+# nas primeiras consultas às colunas/tabelas novas
+python manage.py migrate || exit 1
+
+# Workers da fila de jobs: sem eles uploads não são enriquecidos e execuções
+# ficam em 'queued' para sempre
+python worker.py --processes "${JOB_WORKER_PROCESSES:-2}" >> ../logs/worker.log 2>&1 &
+WORKER_PID=$!
+trap 'kill $WORKER_PID 2>/dev/null' EXIT
+
+# Iniciar com Gunicorn (threads: downloads longos e acompanhamento de execuções
+# não prendem um processo inteiro)
+gunicorn -w 4 -k gthread --threads 8 -b 0.0.0.0:5000 app:app --access-logfile ../logs/access.log --error-logfile ../logs/error.log
 EOF
 
 chmod +x start_production.sh
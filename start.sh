@@ -21,5 +21,15 @@ echo "📍 Aplicação disponível em: http://127.0.0.1:5000"
 echo "⏹️  Para parar: Ctrl+C"
 echo ""
 
+# Migrações de schema pendentes (o app só avisa, não migra sozinho)
+echo "🗄️  Aplicando migrações do banco..."
+python manage.py migrate || exit 1
+
+# Workers da fila de jobs (pós-upload e execução de scripts)
+echo "⚙️  Iniciando workers de background..."
+python worker.py &
+WORKER_PID=$!
+trap 'kill $WORKER_PID 2>/dev/null' EXIT
+
 # Iniciar aplicação
 python app.py